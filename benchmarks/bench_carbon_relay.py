@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+"""
+Drive the carbon relay on localhost with several plaintext senders and
+measure how many points per second make it into a stand-in KairosDB.
+
+    PYTHONPATH=. python benchmarks/bench_carbon_relay.py [points_per_sender] [senders]
+"""
+
+import socket
+import sys
+import threading
+import time
+
+import pyKairosDB
+from pyKairosDB import carbon_relay
+from pyKairosDB import graphite
+from pyKairosDB.testing import StandInKairosDB
+
+points_per_sender = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+senders = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+lines_per_send = 500
+
+server = StandInKairosDB().start()
+conn = pyKairosDB.connect("127.0.0.1", str(server.port))
+schemas = [graphite.StorageSchema("carbon", r"^carbon\.", "60:90d"),
+           graphite.StorageSchema("default", ".*", "10s:6h,60s:1d")]
+relay = carbon_relay.CarbonRelay(conn, schemas, pervasive_tags={"graphite" : "true"},
+                                 interface="127.0.0.1", line_port=0, pickle_port=None,
+                                 batch_size=5000, writer_threads=4).start()
+
+def send(sender):
+    s = socket.create_connection(relay.address("line"))
+    now = int(time.time())
+    for start in range(0, points_per_sender, lines_per_send):
+        s.sendall("".join("bench.host{0}.metric{1} {2} {3}\n".format(sender, n % 100, n, now + n)
+                          for n in range(start, min(start + lines_per_send, points_per_sender))))
+    s.close()
+
+total = points_per_sender * senders
+start_time = time.time()
+threads = [threading.Thread(target=send, args=(n,)) for n in range(senders)]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+while server.points_received < total:
+    time.sleep(0.01)
+elapsed = time.time() - start_time
+relay.stop()
+server.stop()
+
+print "{0} points from {1} senders in {2:.2f}s: {3:.0f} points/s".format(total, senders, elapsed, total / elapsed)
+print "relay stats: {0}".format(relay.stats)
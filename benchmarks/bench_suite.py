@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the client against an in-process stand-in KairosDB, so the
+numbers don't depend on a real cluster being reachable.
+
+Each benchmark runs in its own child process, which starts its own
+stand-in server, so that its memory peak isn't mixed up with the
+others'.  The results can be saved as a JSON baseline, and a later run
+compared with it; a metric that's worse than the baseline by more than
+the threshold is reported as a regression, and the exit status is 1.
+
+    PYTHONPATH=. python benchmarks/bench_suite.py [--only write,read_decode] [--quick]
+        [--save baseline.json] [--compare baseline.json] [--threshold 10]
+
+The benchmarks are:
+
+    write               write_metrics() throughput in batches of 1000 points
+    write_telnet        the same, through a telnet.TelnetTransport
+    write_pipelined     the same, through a pipelined_writer.PipelinedWriter, with 20ms of server latency
+    bulk_load           bulk_load.bulk_load() with one worker process and with one per core
+    read_decode         read_absolute() of a large result, and how fast it's decoded
+    latest              get_latest() of 1000 series, against reading their last hour with read_relative()
+    recent_reads        reading back the last 5 minutes of what was just written, with and without a recent.RecentStore
+    graphite_convert    graphite_metric_list_with_retentions_to_kairosdb_list() throughput
+    graphite_render     graphite.read_absolute() latency, tags query and data query together
+    rollup_render       rollup.read_absolute() of a long range from a rollup, against graphite.read_absolute()
+    wildcard_expansion  expand_graphite_wildcard_metric_name() across namespace sizes
+    metadata            the version, metric names, tag names and tag values requests
+    delete              delete_datapoints() and delete_metric() latency
+
+The stand-in is written in python and shares the CPU with the client,
+so the numbers are for comparing one version of the client with
+another on the same machine, not for sizing a KairosDB cluster.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import pyKairosDB
+from pyKairosDB import bulk_load
+from pyKairosDB import graphite
+from pyKairosDB import pipelined_writer
+from pyKairosDB import recent
+from pyKairosDB import rollup
+from pyKairosDB import telnet
+from pyKairosDB.testing import StandInKairosDB
+
+HIGHER = "higher"
+LOWER  = "lower"
+
+
+def current_rss_kb():
+    """The resident set size now, from /proc on Linux, or the peak so far elsewhere"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]
+
+def latencies(prefix, samples, results):
+    """Add the p50, p95 and max of samples, in milliseconds, to results"""
+    results[prefix + "_p50_ms"] = (percentile(samples, 50) * 1000, LOWER)
+    results[prefix + "_p95_ms"] = (percentile(samples, 95) * 1000, LOWER)
+    results[prefix + "_max_ms"] = (max(samples) * 1000, LOWER)
+
+def timed(f, *args, **kwargs):
+    start = time.time()
+    f(*args, **kwargs)
+    return time.time() - start
+
+def fill(server, names, points_per_name, tags, interval=10):
+    """Store datapoints in the stand-in directly, which is much quicker than writing them"""
+    now_ms = int(time.time()) * 1000
+    for name in names:
+        server.datapoints[name] = [ [now_ms - n * interval * 1000, float(n), tags]
+                                    for n in range(points_per_name) ]
+
+
+def bench_write(server, conn, quick):
+    batches = 20 if quick else 200
+    batch_size = 1000
+    now = time.time()
+    metric_lists = [ [{"name" : "bench.write.m{0}".format(n % 100), "timestamp" : now - n,
+                       "value" : n, "tags" : {"host" : "h{0}".format(b % 10)}} for n in range(batch_size)]
+                     for b in range(batches) ]
+    start = time.time()
+    for metrics in metric_lists:
+        conn.write_metrics(metrics)
+    if conn.write_transport is not None:
+        conn.write_transport.sync() # until the server has all of it, as an HTTP write would
+    elapsed = time.time() - start
+    encode = conn.instrumentation.snapshot()["write"]["phases"]["encode"]
+    return {"points_per_s" : (batches * batch_size / elapsed, HIGHER),
+            "encode_points_per_s" : (batches * batch_size / encode, HIGHER)}
+
+def bench_write_telnet(server, conn, quick):
+    conn.write_transport = telnet.TelnetTransport(server.host, server.telnet_port)
+    try:
+        return bench_write(server, conn, quick)
+    finally:
+        conn.write_transport.close()
+
+def bench_write_pipelined(server, conn, quick):
+    batches = 20 if quick else 200
+    batch_size = 1000
+    now = time.time()
+    metric_lists = [ [{"name" : "bench.write.m{0}".format(n % 100), "timestamp" : now - n,
+                       "value" : n, "tags" : {"host" : "h{0}".format(b % 10)}} for n in range(batch_size)]
+                     for b in range(batches) ]
+    results = dict()
+    server.latency = 0.02 # so there's a network wait to overlap with
+    for mode, in_flight in (("sequential", 1), ("pipelined", 4)):
+        lists = [ [dict(m) for m in metrics] for metrics in metric_lists ] # encoding changes the timestamps
+        start = time.time()
+        with pipelined_writer.PipelinedWriter(conn, max_in_flight=in_flight) as w:
+            for metrics in lists:
+                w.submit(metrics)
+        results[mode + "_points_per_s"] = (batches * batch_size / (time.time() - start), HIGHER)
+    return results
+
+def bench_bulk_load(server, conn, quick):
+    points = 100000 if quick else 1000000
+    now = time.time()
+    def metrics():
+        for n in xrange(points):
+            yield {"name" : "bench.bulk.m{0}".format(n % 100), "timestamp" : now - n,
+                   "value" : n, "tags" : {"host" : "h{0}".format(n % 10)}}
+    results = dict()
+    # The stand-in decodes every request in this process, so the load as a whole can't
+    # go faster than it; the encode rate per worker shows how the client side scales.
+    for label, processes in (("1_process", 1), ("all_cores", multiprocessing.cpu_count())):
+        server.datapoints.clear()
+        result = bulk_load.bulk_load(conn, metrics(), processes=processes)
+        results[label + "_points_per_s"] = (result.points_per_second, HIGHER)
+        results[label + "_encode_points_per_s"] = (result.points / result.encode_seconds * processes, HIGHER)
+    return results
+
+def bench_read_decode(server, conn, quick):
+    points = 20000 if quick else 200000
+    fill(server, ["bench.read"], points, {"host" : "a"}, interval=1)
+    samples = [ timed(conn.read_absolute, ["bench.read"], 0) for n in range(3 if quick else 5) ]
+    read = conn.instrumentation.snapshot()["read"]
+    results = {"points_per_s" : (read["points"] / read["seconds"], HIGHER),
+               "decode_points_per_s" : (read["points"] / (read["phases"]["decode"] + read["phases"]["timestamps"]), HIGHER),
+               "response_mb" : (read["response_bytes"] / float(read["count"]) / 2 ** 20, LOWER)}
+    latencies("read", samples, results)
+    return results
+
+def bench_latest(server, conn, quick):
+    names = [ "bench.latest.m{0}".format(n) for n in range(1000) ]
+    fill(server, names, 360, {"host" : "a"}) # an hour of a datapoint every 10 seconds
+    repeats = 3 if quick else 10
+    results = dict()
+    latencies("window", [ timed(conn.read_relative, names, (1, "hours")) for n in range(repeats) ], results)
+    window = conn.instrumentation.snapshot()["read"]
+    conn.instrumentation.reset()
+    latencies("latest", [ timed(conn.get_latest, names, lookback=(1, "hours")) for n in range(repeats) ], results)
+    latest = conn.instrumentation.snapshot()["read"]
+    results["window_response_kb"] = (window["response_bytes"] / 1024.0 / repeats, LOWER)
+    results["latest_response_kb"] = (latest["response_bytes"] / 1024.0 / repeats, LOWER)
+    return results
+
+def bench_recent_reads(server, conn, quick):
+    names = [ "bench.recent.m{0}".format(n) for n in range(100) ]
+    results = dict()
+    for label, store in (("kairosdb", None), ("store", recent.RecentStore(horizon=600))):
+        server.datapoints.clear()
+        start = time.time() + 1 # after the store starts covering the metrics
+        writing = pyKairosDB.connect(server.host, str(server.port), recent_store=store)
+        for second in range(300):
+            writing.write_metrics([ {"name" : name, "timestamp" : start + second, "value" : second,
+                                     "tags" : {"host" : "a"}} for name in names ])
+        samples = [ timed(lambda: [ writing.read_absolute([name], start, start + 300) for name in names ])
+                    for n in range(3 if quick else 10) ]
+        latencies(label + "_evaluate", samples, results)
+    results["store_hits"] = (store.stats["hits"], HIGHER)
+    return results
+
+def bench_graphite_convert(server, conn, quick):
+    batches = 20 if quick else 200
+    batch_size = 1000
+    now = time.time()
+    schemas = [graphite.StorageSchema("carbon", r"^carbon\.", "60:90d"),
+               graphite.StorageSchema("cpu", r"\.cpu\.", "10s:6h,1m:7d"),
+               graphite.StorageSchema("default", ".*", "1m:1d,5m:4w")]
+    batch_list = [ [ ("servers.web{0:03d}.{1}.value".format(n % 500, ("cpu", "mem", "disk:sda")[n % 3]), now - n, n)
+                     for n in range(b, b + batch_size) ] for b in range(batches) ]
+    convert = graphite.graphite_metric_list_with_retentions_to_kairosdb_list
+    for batch in batch_list[:2]: # so the caches are warm, as they are in a long-running relay
+        list(convert(batch, schemas, {"graphite" : "true"}))
+    start = time.time()
+    for batch in batch_list:
+        list(convert(batch, schemas, {"graphite" : "true"}))
+    return {"points_per_s" : (batches * batch_size / (time.time() - start), HIGHER)}
+
+def bench_graphite_render(server, conn, quick):
+    names = [ "bench.render.host{0}.load".format(n) for n in range(10) ]
+    fill(server, names, 6 * 60 * 24, {graphite.RETENTION_TAG : "10s_1d"})
+    end = int(time.time())
+    start = end - 86400
+    samples = [ timed(graphite.read_absolute, conn, names[n % len(names)], start, end)
+                for n in range(20 if quick else 100) ]
+    results = dict()
+    latencies("render", samples, results)
+    return results
+
+def bench_rollup_render(server, conn, quick):
+    days = 7 if quick else 30
+    schemas = [graphite.StorageSchema("load", r"\.load$", "60s:{0}d,1h:1y".format(days))]
+    fill(server, ["bench.rollup.load"], days * 24 * 60, {graphite.RETENTION_TAG : "60s_{0}d".format(days)}, interval=60)
+    end = int(time.time()) // 3600 * 3600
+    start = end - days * 86400
+    server.datapoints[rollup.rollup_name("bench.rollup.load", 3600)] = [
+        [t * 1000, 1.0, {graphite.RETENTION_TAG : "1h_1y"}] for t in range(start, end - 3600, 3600) ]
+    repeats = 3 if quick else 10
+    results = dict()
+    for label, read in (("raw", lambda: graphite.read_absolute(conn, "bench.rollup.load", start, end)),
+                        ("planned", lambda: rollup.read_absolute(conn, "bench.rollup.load", start, end, schemas,
+                                                                 max_points=1000))):
+        latencies(label, [ timed(read) for n in range(repeats) ], results)
+    return results
+
+def bench_wildcard_expansion(server, conn, quick):
+    results = dict()
+    sizes = (1000, 10000) if quick else (1000, 10000, 100000)
+    patterns = {"star"   : "servers.*.cpu.user",
+                "braces" : "servers.{web,db}00[0-4]*.{cpu,memory}.*",
+                "prefix" : "servers.web0001.*.*"}
+    for size in sizes:
+        server.datapoints.clear()
+        kinds = ("web", "db", "cache", "queue")
+        for n in range(size / 10):
+            for metric in ("cpu.user", "cpu.system", "cpu.idle", "memory.used", "memory.free",
+                           "disk.read", "disk.write", "net.in", "net.out", "load.1m"):
+                server.datapoints["servers.{0}{1:04d}.{2}".format(kinds[n % 4], n / 4, metric)] = []
+        graphite.expand_graphite_wildcard_metric_name.cache_timestamp = 0
+        results["index_{0}_ms".format(size)] = (
+            timed(graphite.expand_graphite_wildcard_metric_name, conn, "servers.*") * 1000, LOWER)
+        for label, pattern in sorted(patterns.items()):
+            repeats = 20
+            elapsed = timed(lambda: [ graphite.expand_graphite_wildcard_metric_name(conn, pattern)
+                                      for n in range(repeats) ])
+            results["{0}_{1}_ms".format(label, size)] = (elapsed / repeats * 1000, LOWER)
+    return results
+
+def bench_metadata(server, conn, quick):
+    fill(server, [ "bench.meta.m{0}".format(n) for n in range(1000) ], 1, {"host" : "a", "dc" : "east"})
+    results = dict()
+    for name, f in (("version", conn.server_version), ("metric_names", conn.metric_names),
+                    ("tag_names", conn.tag_names), ("tag_values", conn.tag_values)):
+        samples = [ timed(f, ttl=0) for n in range(20 if quick else 100) ]
+        latencies(name, samples, results)
+    return results
+
+def bench_delete(server, conn, quick):
+    count = 20 if quick else 100
+    names = [ "bench.delete.m{0}".format(n) for n in range(count) ]
+    fill(server, names, 100, {"host" : "a"})
+    results = dict()
+    latencies("delete_datapoints", [ timed(conn.delete_datapoints, [name], 0, time.time() - 500)
+                                     for name in names ], results)
+    latencies("delete_metric", [ timed(conn.delete_metrics, [name]) for name in names ], results)
+    return results
+
+BENCHMARKS = [("write", bench_write), ("write_telnet", bench_write_telnet),
+              ("write_pipelined", bench_write_pipelined), ("bulk_load", bench_bulk_load),
+              ("read_decode", bench_read_decode), ("latest", bench_latest), ("recent_reads", bench_recent_reads),
+              ("graphite_convert", bench_graphite_convert),
+              ("graphite_render", bench_graphite_render), ("rollup_render", bench_rollup_render),
+              ("wildcard_expansion", bench_wildcard_expansion),
+              ("metadata", bench_metadata), ("delete", bench_delete)]
+
+
+def run_one(benchmark, quick, answer):
+    server = StandInKairosDB(telnet_port=0).start()
+    try:
+        conn = pyKairosDB.connect("127.0.0.1", str(server.port))
+        rss_before = current_rss_kb()
+        results = benchmark(server, conn, quick)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is inherited from the parent at fork, so the growth is what this benchmark added
+        results["peak_rss_mb"] = (peak / 1024.0, LOWER)
+        results["rss_growth_mb"] = (max(0, peak - rss_before) / 1024.0, LOWER)
+        answer.put(dict((k, {"value" : round(v, 3), "better" : better}) for k, (v, better) in results.items()))
+    except Exception, e:
+        answer.put({"error" : repr(e)})
+        raise
+    finally:
+        server.stop()
+
+def run(names, quick):
+    results = dict()
+    for name, benchmark in BENCHMARKS:
+        if names and name not in names:
+            continue
+        answer = multiprocessing.Queue()
+        child = multiprocessing.Process(target=run_one, args=(benchmark, quick, answer))
+        child.start()
+        results[name] = answer.get()
+        child.join()
+        print_results(name, results[name])
+    return results
+
+def print_results(name, results):
+    print name
+    for metric, result in sorted(results.items()):
+        if metric == "error":
+            print "    failed: {0}".format(result)
+        else:
+            print "    {0:<28} {1:>14,.3f}".format(metric, result["value"])
+
+def compare(results, baseline, threshold):
+    """
+    :rtype: list
+    :return: (benchmark, metric, baseline value, value, percent worse) for each regression
+    """
+    regressions = list()
+    print "\ncompared with the baseline ({0}% threshold):".format(threshold)
+    for name, metrics in sorted(results.items()):
+        for metric, result in sorted(metrics.items()):
+            old = baseline.get(name, {}).get(metric)
+            if metric == "error" or old is None or not old["value"]:
+                continue
+            change = (result["value"] - old["value"]) * 100.0 / old["value"]
+            worse = change if result["better"] == LOWER else -change
+            flag = ""
+            if worse > threshold:
+                flag = "  REGRESSION"
+                regressions.append((name, metric, old["value"], result["value"], worse))
+            print "    {0}.{1:<28} {2:>12,.3f} -> {3:>12,.3f} ({4:+.1f}%){5}".format(
+                name, metric, old["value"], result["value"], change, flag)
+    return regressions
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark pyKairosDB against a stand-in KairosDB")
+    parser.add_argument("--only", help="comma-separated benchmarks to run, of: " +
+                        ", ".join(name for name, b in BENCHMARKS))
+    parser.add_argument("--quick", action="store_true", help="smaller data, for a quick check")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare the results with this JSON baseline")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="percent by which a metric may be worse than the baseline (default 10)")
+    args = parser.parse_args(argv)
+
+    names = args.only.split(",") if args.only else None
+    results = run(names, args.quick)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"python" : sys.version.split()[0], "quick" : args.quick, "results" : results},
+                      f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("quick") != args.quick:
+            print "\nthe baseline was run with quick={0}, the comparison may not be meaningful".format(
+                baseline.get("quick"))
+        if compare(results, baseline["results"], args.threshold):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
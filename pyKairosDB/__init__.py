@@ -1,8 +1,12 @@
 import connection
+import cluster
 import util
+import instrumentation
 import metadata
+import telnet
+import transport
 
-def connect(server='localhost', port='8080', ssl=False):
+def connect(server='localhost', port='8080', ssl=False, **kwargs):
     """
     :type server: str
     :param server: the host to connect to that is running KairosDB
@@ -15,10 +19,25 @@ def connect(server='localhost', port='8080', ssl=False):
     :return: A connection object to the database
 
     This wraps the pyKairosDB.connection.KairosDBConnection constructor and returns an
-    instance of that class.
+    instance of that class.  Any other keyword arguments, e.g. the timeouts, are passed to it.
+    Nothing is sent to the server until the connection is used.
     """
-    return connection.KairosDBConnection(server, port, ssl)
+    return connection.KairosDBConnection(server, port, ssl, **kwargs)
 
+def connect_cluster(nodes, ssl=False, **kwargs):
+    """
+    :type nodes: list
+    :param nodes: the nodes to connect to, as (server, port) tuples or "server:port" strings
+    :type ssl: bool
+    :param ssl: Whether or not to use ssl for the connections.
+
+    :rtype: KairosDBCluster
+    :return: A connection object that spreads requests across the nodes
+
+    This wraps the pyKairosDB.cluster.KairosDBCluster constructor, and any other keyword
+    arguments are passed to it.
+    """
+    return cluster.KairosDBCluster(nodes, ssl, **kwargs)
 
 
-__all__ = ["connect", "util", "metadata"]
\ No newline at end of file
+__all__ = ["connect", "connect_cluster", "util", "metadata", "transport", "instrumentation", "telnet"]
\ No newline at end of file
@@ -0,0 +1,291 @@
+# -*- python -*-
+
+"""
+StatsD-style aggregation in the client, so that a service that
+observes something thousands of times a second writes a handful of
+datapoints per interval instead of every observation::
+
+    agg = aggregator.Aggregator(conn, interval=10, tags={"host" : "web01"}).start()
+    agg.increment("requests")
+    agg.gauge("queue.depth", len(queue))
+    agg.timing("request.time", elapsed)
+    agg.set("users", user_id)
+    with agg.timer("db.query"):
+        ...
+
+Observations are accumulated in memory per (name, tags), and each
+interval the accumulated values are written as one batch with
+writer.write_metrics_list().  For each kind of metric the series
+written are::
+
+    counter  <name>.count (the sum of the increments), <name>.rate (per second)
+    gauge    <name> (the last value set)
+    timer    <name>.count, .sum, .min, .max, .mean, .p50 .p90 .p99 (per percentiles)
+    set      <name>.count (how many distinct values were seen)
+
+A series that wasn't touched in an interval isn't written.  Timer
+percentiles are estimated from a uniform random sample of at most
+reservoir_size observations per series, so a timer's memory doesn't
+grow with how often it's used; count, sum, min, max and mean are
+exact.
+"""
+
+import logging
+import random
+import threading
+import time
+
+import requests
+
+from . import writer
+
+LOG = logging.getLogger(__name__)
+
+PERCENTILES = (50, 90, 99)
+
+
+class _Timer(object):
+    """The observations of one timer series in one interval"""
+
+    __slots__ = ("count", "sum", "min", "max", "sample", "size")
+
+    def __init__(self, size):
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.sample = list()
+        self.size = size
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if len(self.sample) < self.size:
+            self.sample.append(value)
+        else:
+            # reservoir sampling: every observation so far is equally likely to be in the sample
+            n = random.randint(0, self.count - 1)
+            if n < self.size:
+                self.sample[n] = value
+
+    def percentile(self, p):
+        ordered = sorted(self.sample)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]
+
+
+class _Timing(object):
+    """A context manager that records how long its block took with Aggregator.timing()"""
+
+    def __init__(self, aggregator, name, tags):
+        self.aggregator = aggregator
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.aggregator.timing(self.name, time.time() - self.start, self.tags)
+        return False
+
+
+class Aggregator(object):
+    """
+    :type conn: KairosDBConnection
+    :param conn: the connection the aggregates are written to
+
+    :type interval: float
+    :param interval: seconds between flushes, when it's started
+
+    :type tags: dict
+    :param tags: tags written with every series, merged under the tags given with each observation
+
+    :type percentiles: tuple
+    :param percentiles: the timer percentiles that are written, 0-100
+
+    :type reservoir_size: int
+    :param reservoir_size: the most observations of each timer that are kept per interval to
+        estimate the percentiles
+
+    The counters in stats are observations (calls that were aggregated),
+    flushes, written (datapoints written) and write_errors.
+    """
+
+    def __init__(self, conn, interval=10, tags=None, percentiles=PERCENTILES, reservoir_size=1024):
+        self.conn = conn
+        self.interval = interval
+        self.tags = tags or {}
+        self.percentiles = percentiles
+        self.reservoir_size = reservoir_size
+        self.stats = {"observations" : 0, "flushes" : 0, "written" : 0, "write_errors" : 0}
+        self._lock = threading.Lock()
+        self._series_tags = dict() # series key to the merged tags it's written with
+        self._reset()
+        self._last_flush = time.time()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _reset(self):
+        self._counters = dict()
+        self._gauges = dict()
+        self._timers = dict()
+        self._sets = dict()
+
+    def _key(self, name, tags):
+        key = writer.series_key(name, tags or {})
+        if key not in self._series_tags:
+            merged = dict(self.tags)
+            merged.update(tags or {})
+            self._series_tags[key] = merged
+        return key
+
+    def increment(self, name, value=1, tags=None, sample_rate=1.0):
+        """
+        :type name: str
+        :param name: the counter
+
+        :type value: float
+        :param value: how much to add to it
+
+        :type tags: dict
+        :param tags: the series' own tags
+
+        :type sample_rate: float
+        :param sample_rate: the fraction of events that the caller reports, 0-1.  The value is
+            scaled up by it, as StatsD does.
+        """
+        with self._lock:
+            key = self._key(name, tags)
+            self._counters[key] = self._counters.get(key, 0) + value / sample_rate
+            self.stats["observations"] += 1
+
+    def gauge(self, name, value, tags=None):
+        """
+        :type value: float
+        :param value: the gauge's value now.  The last one set in an interval is written.
+        """
+        with self._lock:
+            self._gauges[self._key(name, tags)] = value
+            self.stats["observations"] += 1
+
+    def timing(self, name, value, tags=None):
+        """
+        :type value: float
+        :param value: how long something took, in whatever unit the caller uses for the series
+        """
+        with self._lock:
+            key = self._key(name, tags)
+            t = self._timers.get(key)
+            if t is None:
+                t = self._timers[key] = _Timer(self.reservoir_size)
+            t.add(value)
+            self.stats["observations"] += 1
+
+    def timer(self, name, tags=None):
+        """
+        :rtype: context manager
+        :return: something that records how long its block took, in seconds, with timing()
+        """
+        return _Timing(self, name, tags)
+
+    def set(self, name, value, tags=None):
+        """
+        :type value: object
+        :param value: something hashable, e.g. a user id.  The number of distinct values seen
+            in an interval is written.
+        """
+        with self._lock:
+            key = self._key(name, tags)
+            s = self._sets.get(key)
+            if s is None:
+                s = self._sets[key] = set()
+            s.add(value)
+            self.stats["observations"] += 1
+
+    def metrics(self, now=None):
+        """
+        :rtype: list
+        :return: the aggregates of the interval since the last call, per writer.write_metrics_list().
+            The accumulated observations are cleared.
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            counters, gauges, timers, sets = self._counters, self._gauges, self._timers, self._sets
+            series_tags = self._series_tags
+            self._reset()
+            # forget the tags of series that weren't used in this interval, so they can't pile up
+            self._series_tags = dict((key, series_tags[key]) for d in (counters, gauges, timers, sets) for key in d)
+            elapsed = max(now - self._last_flush, 1e-9)
+            self._last_flush = now
+        metrics = list()
+
+        def add(key, suffix, value):
+            name = key[0] if suffix is None else "{0}.{1}".format(key[0], suffix)
+            metrics.append({"name" : name, "timestamp" : now, "value" : value, "tags" : series_tags[key]})
+
+        for key, count in counters.iteritems():
+            add(key, "count", count)
+            add(key, "rate", count / elapsed)
+        for key, value in gauges.iteritems():
+            add(key, None, value)
+        for key, t in timers.iteritems():
+            add(key, "count", t.count)
+            add(key, "sum", t.sum)
+            add(key, "min", t.min)
+            add(key, "max", t.max)
+            add(key, "mean", t.sum / t.count)
+            for p in self.percentiles:
+                add(key, "p{0}".format(p), t.percentile(p))
+        for key, values in sets.iteritems():
+            add(key, "count", len(values))
+        return metrics
+
+    def flush(self):
+        """
+        Write the aggregates of the interval since the last flush.
+        Failures are logged and counted, and the interval is not retried.
+        """
+        metrics = self.metrics()
+        with self._lock:
+            self.stats["flushes"] += 1
+        if not metrics:
+            return
+        try:
+            r = writer.write_metrics_list(self.conn, metrics)
+            ok = r.status_code == 204
+            if not ok:
+                LOG.warning("Writing aggregates failed. Status code: %s, content: %s", r.status_code, r.content)
+        except requests.RequestException, e:
+            LOG.warning("Writing aggregates failed: %s", e)
+            ok = False
+        with self._lock:
+            if ok:
+                self.stats["written"] += len(metrics)
+            else:
+                self.stats["write_errors"] += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def stop(self):
+        """
+        Stop flushing, after one last flush.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
@@ -0,0 +1,316 @@
+# -*- python -*-
+
+"""
+Loading very large numbers of datapoints, e.g. for a backfill, with a
+pool of processes.
+
+write_metrics_list() converts the timestamps and builds the JSON body
+in one process, so a backfill is limited to what one core can encode.
+bulk_load() shards the datapoints across a multiprocessing.Pool, and
+each worker encodes and posts its own chunks::
+
+    result = bulk_load.bulk_load(conn, metrics_from_somewhere(), processes=8)
+    print result.points, result.failed_points, result.points_per_second
+
+The datapoints aren't pickled to the workers.  The parent copies them
+into column buffers (timestamps, values and a series number for each
+datapoint) in shared memory that the workers inherited when the pool
+was started, and a task is only the range of a chunk in a buffer plus
+the chunk's few distinct series (a name and its tags).  There are two
+sets of buffers, so the parent fills one while the workers encode and
+post the other.
+
+The parent still touches each datapoint once, to copy it into the
+buffers, which is several times cheaper than encoding it; that's what
+eventually limits how far this scales with more processes.
+
+Values are held as doubles, so integers beyond 2 ** 53 lose
+precision.  The connection's write_transport isn't used, every chunk is
+posted as JSON to the REST API, and its recent_store forgets the metrics
+that are loaded rather than keeping them.
+"""
+
+import array
+import ctypes
+import json
+import logging
+import multiprocessing
+import time
+from multiprocessing import sharedctypes
+
+import requests
+
+from . import instrumentation
+from . import transport
+from . import util
+
+LOG = logging.getLogger(__name__)
+
+MAX_ERRORS = 10 # how many error messages a BulkLoadResult keeps
+
+
+class BulkLoadResult(object):
+    """
+    The combined outcome of a bulk_load().
+
+    points and failed_points count datapoints; requests and
+    failed_requests count the chunks posted.  status_codes maps each
+    status code the server answered with to how many chunks got it, and
+    errors holds the first MAX_ERRORS failures, described as strings.
+    encode_seconds and network_seconds are summed across the workers,
+    so with several processes they add up to more than seconds, the
+    time the whole load took.
+    """
+
+    def __init__(self):
+        self.points = 0
+        self.failed_points = 0
+        self.requests = 0
+        self.failed_requests = 0
+        self.request_bytes = 0
+        self.encode_seconds = 0.0
+        self.network_seconds = 0.0
+        self.seconds = 0.0
+        self.status_codes = dict()
+        self.errors = list()
+
+    @property
+    def ok(self):
+        """Whether every chunk was accepted"""
+        return self.failed_requests == 0
+
+    @property
+    def points_per_second(self):
+        if not self.seconds:
+            return 0.0
+        return self.points / self.seconds
+
+    def add(self, chunk):
+        """
+        :type chunk: dict
+        :param chunk: what a worker reports for one chunk: points, request_bytes, status_code
+            (None if there was no answer), error, encode_seconds and network_seconds
+        """
+        self.requests += 1
+        self.request_bytes += chunk["request_bytes"]
+        self.encode_seconds += chunk["encode_seconds"]
+        self.network_seconds += chunk["network_seconds"]
+        if chunk["status_code"] is not None:
+            self.status_codes[chunk["status_code"]] = self.status_codes.get(chunk["status_code"], 0) + 1
+        if chunk["error"] is None:
+            self.points += chunk["points"]
+            return
+        self.failed_points += chunk["points"]
+        self.failed_requests += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append(chunk["error"])
+
+    def __repr__(self):
+        return "<BulkLoadResult {0} points, {1} failed, {2:.1f}s>".format(
+            self.points, self.failed_points, self.seconds)
+
+
+class _Buffers(object):
+    """One set of column buffers in shared memory, big enough for a block of datapoints"""
+
+    def __init__(self, size):
+        self.timestamps = sharedctypes.RawArray(ctypes.c_double, size)
+        self.values = sharedctypes.RawArray(ctypes.c_double, size)
+        self.integers = sharedctypes.RawArray(ctypes.c_byte, size) # whether the value is written as an integer
+        self.series = sharedctypes.RawArray(ctypes.c_int, size)
+
+    def fill(self, columns):
+        """Copy array.arrays of the same types into the start of the buffers"""
+        for name in ("timestamps", "values", "integers", "series"):
+            source = columns[name]
+            address, length = source.buffer_info()
+            ctypes.memmove(getattr(self, name), address, length * source.itemsize)
+
+
+def _new_columns():
+    return {"timestamps" : array.array("d"), "values" : array.array("d"),
+            "integers" : array.array("b"), "series" : array.array("i")}
+
+def _series_prefix(name, tags):
+    return '{"name": %s, "tags": %s, "timestamp": ' % (json.dumps(name), json.dumps(tags))
+
+
+# State inherited by each worker process when the pool starts
+_worker_conn = None
+_worker_buffers = None
+
+def _init_worker(conn, buffers):
+    global _worker_conn, _worker_buffers
+    _worker_conn = conn
+    _worker_buffers = buffers
+
+def _encode_chunk(buffers, start, end, series):
+    timestamps = buffers.timestamps[start:end]
+    values = buffers.values[start:end]
+    integers = buffers.integers[start:end]
+    indexes = buffers.series[start:end]
+    parts = list()
+    append = parts.append
+    for n in xrange(end - start):
+        if integers[n]:
+            append('%s%d, "value": %d}' % (series[indexes[n]], timestamps[n] * 1000, values[n]))
+        else:
+            append('%s%d, "value": %r}' % (series[indexes[n]], timestamps[n] * 1000, values[n]))
+    return "[" + ", ".join(parts) + "]"
+
+def _load_chunk(task):
+    which, start, end, series = task
+    chunk = {"points" : end - start, "request_bytes" : 0, "status_code" : None, "error" : None,
+             "encode_seconds" : 0.0, "network_seconds" : 0.0}
+    began = time.time()
+    body = _encode_chunk(_worker_buffers[which], start, end, series)
+    sent = time.time()
+    chunk["encode_seconds"] = sent - began
+    chunk["request_bytes"] = len(body)
+    try:
+        r = transport.request(_worker_conn, "POST", _worker_conn.write_url, body)
+        chunk["status_code"] = r.status_code
+        if r.status_code != 204:
+            chunk["error"] = "status code {0}: {1}".format(r.status_code, r.content[:200])
+    except requests.RequestException, e:
+        chunk["error"] = repr(e)
+    chunk["network_seconds"] = time.time() - sent
+    return chunk
+
+
+def _blocks(metrics, block_points, chunk_points):
+    """
+    Yield (columns, chunks) for each block of up to block_points datapoints, where chunks is a
+    list of (start, end, series prefixes), and each chunk numbers its own series from 0.
+    """
+    prefixes = util.LRUCache(100000) # (name, tags) to its prefix, across blocks
+    columns = _new_columns()
+    chunks = list()
+    chunk_start = 0
+    chunk_series = dict()
+    chunk_prefixes = list()
+    position = 0
+    for m in metrics:
+        name = m["name"]
+        tags = m["tags"]
+        key = (name, tuple(tags.iteritems()))
+        index = chunk_series.get(key)
+        if index is None:
+            prefix = prefixes.get(key)
+            if prefix is None:
+                prefix = _series_prefix(name, tags)
+                prefixes.put(key, prefix)
+            index = chunk_series[key] = len(chunk_prefixes)
+            chunk_prefixes.append(prefix)
+        value = m["value"]
+        if isinstance(value, (int, long)):
+            columns["integers"].append(1)
+        elif isinstance(value, float):
+            columns["integers"].append(0)
+        else:
+            raise TypeError("{0} has a value that isn't a number: {1!r}".format(name, value))
+        columns["values"].append(value)
+        columns["timestamps"].append(m["timestamp"])
+        columns["series"].append(index)
+        position += 1
+        if position - chunk_start == chunk_points:
+            chunks.append((chunk_start, position, chunk_prefixes))
+            chunk_start = position
+            chunk_series = dict()
+            chunk_prefixes = list()
+            if position == block_points:
+                yield columns, chunks
+                columns = _new_columns()
+                chunks = list()
+                chunk_start = position = 0
+    if position > chunk_start:
+        chunks.append((chunk_start, position, chunk_prefixes))
+    if chunks:
+        yield columns, chunks
+
+def _forgetting(store, metrics):
+    """Yield the metrics, having the store forget each name the first time it's seen"""
+    seen = set()
+    for m in metrics:
+        if m["name"] not in seen:
+            seen.add(m["name"])
+            store.forget([m["name"]])
+        yield m
+
+def bulk_load(conn, metrics, processes=None, chunk_points=20000, block_points=1000000, progress_callback=None):
+    """
+    :type conn: KairosDBConnection
+    :param conn: the connection (or cluster) to write to
+
+    :type metrics: iterable
+    :param metrics: dicts, per writer.write_metrics_list().  It can be a generator, it's read a
+        block at a time and isn't changed.
+
+    :type processes: int
+    :param processes: how many worker processes encode and post chunks.  None for one per core.
+
+    :type chunk_points: int
+    :param chunk_points: how many datapoints are posted in each request
+
+    :type block_points: int
+    :param block_points: how many datapoints each set of shared buffers holds.  Two blocks
+        are in memory at once.  It's rounded down to a multiple of chunk_points.
+
+    :type progress_callback: callable
+    :param progress_callback: called with the BulkLoadResult so far after each block
+
+    :rtype: BulkLoadResult
+    :return: how many datapoints were written, and what failed
+
+    :raises: TypeError if a value isn't a number.  The blocks before it have been loaded.
+
+    A chunk that the server doesn't accept is counted as failed and the
+    load carries on; check result.ok, or result.errors, at the end.  Each
+    chunk is recorded as a write in the connection's instrumentation.
+    """
+    block_points = max(chunk_points, block_points - block_points % chunk_points)
+    if getattr(conn, "recent_store", None) is not None:
+        metrics = _forgetting(conn.recent_store, metrics)
+    result = BulkLoadResult()
+    started = time.time()
+    buffers = [_Buffers(block_points), _Buffers(block_points)]
+    pool = multiprocessing.Pool(processes, _init_worker, (conn, buffers))
+    pending = [None, None]
+
+    def collect(which):
+        if pending[which] is None:
+            return
+        for chunk in pending[which].get():
+            result.add(chunk)
+            _record(conn, chunk)
+        pending[which] = None
+        result.seconds = time.time() - started
+        if progress_callback is not None:
+            progress_callback(result)
+
+    try:
+        for n, (columns, chunks) in enumerate(_blocks(metrics, block_points, chunk_points)):
+            which = n % 2
+            collect(which) # its buffers are free once the workers are done with them
+            buffers[which].fill(columns)
+            tasks = [ (which, start, end, series) for start, end, series in chunks ]
+            pending[which] = pool.map_async(_load_chunk, tasks, chunksize=1)
+        for which in (0, 1):
+            collect(which)
+    finally:
+        pool.terminate()
+        pool.join()
+    result.seconds = time.time() - started
+    return result
+
+def _record(conn, chunk):
+    instruments = getattr(conn, "instrumentation", None)
+    if instruments is None:
+        return
+    op = instrumentation.Operation(instruments, "write")
+    op.request_bytes = chunk["request_bytes"]
+    op.points = chunk["points"]
+    op.add_phase("encode", chunk["encode_seconds"])
+    op.add_phase("network", chunk["network_seconds"])
+    error = None if chunk["error"] is None else requests.RequestException(chunk["error"])
+    instruments.record(op, chunk["encode_seconds"] + chunk["network_seconds"], error)
@@ -0,0 +1,454 @@
+# -*- python -*-
+
+"""
+A relay that accepts metrics using carbon's protocols and writes them
+to KairosDB, so that carbon senders can be pointed at KairosDB
+without a separate relay.
+
+Three listeners are provided, all optional:
+
+* the plaintext protocol over TCP (carbon's line receiver, port 2003)::
+
+    metric.name value timestamp\\n
+
+* the same plaintext protocol over UDP
+
+* the pickle protocol over TCP (port 2004): a 4-byte big-endian
+  length followed by a pickled list of (name, (timestamp, value))
+
+Every metric is tagged with its graphite retention by matching the
+storage schemas, per graphite.graphite_metric_list_with_retentions_to_kairosdb_list().
+
+Received points are collected into batches of batch_size points (or
+whatever arrived in flush_interval seconds) and the batches are put on
+a queue of at most max_queued_batches that the writer threads take
+from.  When KairosDB can't keep up and the queue is full, the TCP
+listeners stop reading from their sockets until there's room again,
+which pushes back on the senders the way carbon does.  UDP can't push
+back, so datagrams that arrive while the queue is full are dropped and
+counted.
+"""
+
+import cPickle
+import logging
+import Queue
+import SocketServer
+import struct
+import threading
+import time
+from cStringIO import StringIO
+
+from . import graphite
+
+LOG = logging.getLogger(__name__)
+
+PICKLE_HEADER = struct.Struct("!L")
+MAX_PICKLE_SIZE = 2 ** 20 # same limit as carbon's MAX_LENGTH for a pickle message
+RECV_SIZE = 65536
+MAX_LINE_SIZE = 4 * RECV_SIZE # a partial line longer than this is dropped, and its connection closed
+
+
+def parse_lines(data, points):
+    """
+    :type data: str
+    :param data: complete lines of carbon's plaintext protocol
+
+    :type points: list
+    :param points: a list that (name, timestamp, value) tuples will be appended to
+
+    :rtype: int
+    :return: the number of lines that couldn't be parsed and were skipped, including any
+        whose timestamp or value is nan or infinite
+
+    The points are appended to a list the caller owns so that a whole
+    chunk of the socket is parsed without any intermediate lists.
+    """
+    invalid = 0
+    append = points.append
+    for line in data.splitlines():
+        parts = line.split()
+        if len(parts) != 3:
+            if parts:
+                invalid += 1
+            continue
+        try:
+            timestamp, value = float(parts[2]), float(parts[1])
+        except ValueError:
+            invalid += 1
+            continue
+        # x - x is 0.0 unless x is nan or infinite, which KairosDB won't accept
+        if timestamp - timestamp != 0.0 or value - value != 0.0:
+            invalid += 1
+            continue
+        append((parts[0], timestamp, value))
+    return invalid
+
+def parse_pickle(data, points):
+    """
+    :type data: str
+    :param data: the body of one pickle protocol message, without its length header
+
+    :type points: list
+    :param points: a list that (name, timestamp, value) tuples will be appended to
+
+    :rtype: int
+    :return: the number of entries that couldn't be used and were skipped, including any
+        whose timestamp or value is nan or infinite
+
+    Unpickling is done without allowing any globals to be looked up,
+    so only plain lists, tuples, strings and numbers can be received.
+    """
+    unpickler = cPickle.Unpickler(StringIO(data))
+    unpickler.find_global = None
+    invalid = 0
+    append = points.append
+    for entry in unpickler.load():
+        try:
+            name, (timestamp, value) = entry
+            if not isinstance(name, basestring):
+                raise TypeError("the name {0!r} isn't a string".format(name))
+            timestamp, value = float(timestamp), float(value)
+            if timestamp - timestamp != 0.0 or value - value != 0.0:
+                raise ValueError("{0} isn't finite".format((timestamp, value)))
+            append((name, timestamp, value))
+        except (TypeError, ValueError):
+            invalid += 1
+    return invalid
+
+
+class _LineHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        relay = self.server.relay
+        remainder = ""
+        while True:
+            chunk = self.request.recv(RECV_SIZE)
+            if not chunk:
+                break
+            end = chunk.rfind("\n")
+            if end == -1:
+                remainder += chunk
+                if len(remainder) > MAX_LINE_SIZE:
+                    LOG.warning("A line of more than %d bytes from %s, closing the connection",
+                                MAX_LINE_SIZE, self.client_address)
+                    relay.add_points([], 1)
+                    return
+                continue
+            points = list()
+            invalid = parse_lines(remainder + chunk[:end], points)
+            remainder = chunk[end + 1:]
+            relay.add_points(points, invalid)
+        if remainder:
+            points = list()
+            invalid = parse_lines(remainder, points)
+            relay.add_points(points, invalid)
+
+
+class _PickleHandler(SocketServer.BaseRequestHandler):
+    def _recv_exactly(self, size):
+        chunks = list()
+        while size > 0:
+            chunk = self.request.recv(min(size, RECV_SIZE))
+            if not chunk:
+                return None
+            chunks.append(chunk)
+            size -= len(chunk)
+        return "".join(chunks)
+
+    def handle(self):
+        relay = self.server.relay
+        while True:
+            header = self._recv_exactly(PICKLE_HEADER.size)
+            if header is None:
+                break
+            (length,) = PICKLE_HEADER.unpack(header)
+            if length > MAX_PICKLE_SIZE:
+                LOG.warning("Pickle message of %d bytes from %s is too large, closing the connection",
+                            length, self.client_address)
+                break
+            data = self._recv_exactly(length)
+            if data is None:
+                break
+            points = list()
+            try:
+                invalid = parse_pickle(data, points)
+            except Exception:
+                LOG.warning("Unable to unpickle a message from %s, closing the connection",
+                            self.client_address)
+                break
+            relay.add_points(points, invalid)
+
+
+class _UDPHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        points = list()
+        invalid = parse_lines(self.request[0], points)
+        self.server.relay.add_points(points, invalid, block=False)
+
+
+class _TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class _UDPServer(SocketServer.UDPServer):
+    allow_reuse_address = True
+    max_packet_size = RECV_SIZE
+
+
+class CarbonRelay(object):
+    """
+    :type conn: KairosDBConnection
+    :param conn: the connection that batches are written with
+
+    :type storage_schemas: list
+    :param storage_schemas: carbon.storage.Schema or graphite.StorageSchema objects used to tag the retentions
+
+    :type pervasive_tags: dict
+    :param pervasive_tags: tags that will be added to every metric
+
+    :type interface: str
+    :param interface: the address the listeners bind to
+
+    :type line_port: int
+    :param line_port: TCP port for the plaintext protocol, None to disable it, 0 for any free port
+
+    :type pickle_port: int
+    :param pickle_port: TCP port for the pickle protocol, None to disable it, 0 for any free port
+
+    :type udp_port: int
+    :param udp_port: UDP port for the plaintext protocol, None to disable it, 0 for any free port
+
+    :type batch_size: int
+    :param batch_size: the number of points written to KairosDB per request
+
+    :type flush_interval: float
+    :param flush_interval: the longest time, in seconds, that a point waits for its batch to fill up
+
+    :type max_queued_batches: int
+    :param max_queued_batches: how many batches may wait for a writer before the listeners are blocked
+
+    :type writer_threads: int
+    :param writer_threads: how many writes to KairosDB can be in flight at once
+
+    :type coalesce: bool
+    :param coalesce: whether a point for the same name and millisecond timestamp as one already
+        in the batch replaces it, instead of both being written.  KairosDB would keep the
+        last one anyway.  The tags are determined by the name, so the name is the series.
+
+    The counters in stats are received, invalid, dropped, collapsed (points
+    replaced by a later one when coalescing), written, batches and write_errors.
+    """
+
+    def __init__(self, conn, storage_schemas, pervasive_tags=None, interface="0.0.0.0",
+                 line_port=2003, pickle_port=2004, udp_port=None, batch_size=1000,
+                 flush_interval=1.0, max_queued_batches=100, writer_threads=2, coalesce=False):
+        self.conn = conn
+        self.storage_schemas = storage_schemas
+        self.pervasive_tags = pervasive_tags or {}
+        self.interface = interface
+        self.ports = {"line" : line_port, "pickle" : pickle_port, "udp" : udp_port}
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.writer_threads = writer_threads
+        self.coalesce = coalesce
+        self.stats = {"received" : 0, "invalid" : 0, "dropped" : 0, "collapsed" : 0, "written" : 0,
+                      "batches" : 0, "write_errors" : 0}
+        self._queue = Queue.Queue(max_queued_batches)
+        self._batch = self._new_batch()
+        self._batch_started = None
+        self._lock = threading.Lock()
+        self._servers = dict()
+        self._threads = list()
+        self._running = False
+
+    def add_points(self, points, invalid=0, block=True):
+        """
+        :type points: list
+        :param points: (name, timestamp, value) tuples
+
+        :type invalid: int
+        :param invalid: the number of unparseable entries that were received with these points
+
+        :type block: bool
+        :param block: whether to wait for room in the queue or to drop the points when it's full
+
+        Points can be added directly, to relay metrics that didn't come
+        in through a listener.
+        """
+        full_batches = list()
+        with self._lock:
+            self.stats["received"] += len(points)
+            self.stats["invalid"] += invalid
+            if not points:
+                return
+            if not self._batch:
+                self._batch_started = time.time()
+            if self.coalesce:
+                self._coalesce(points, full_batches)
+            else:
+                self._batch.extend(points)
+                while len(self._batch) >= self.batch_size:
+                    full_batches.append(self._batch[:self.batch_size])
+                    self._batch = self._batch[self.batch_size:]
+        for batch in full_batches:
+            self._enqueue(batch, block)
+
+    def _new_batch(self):
+        # When coalescing, the batch maps (interned name, timestamp in ms) to the latest point
+        if self.coalesce:
+            return dict()
+        return list()
+
+    def _coalesce(self, points, full_batches):
+        batch = self._batch
+        batch_size = self.batch_size
+        collapsed = 0
+        for point in points:
+            name = point[0]
+            if type(name) is str:
+                name = intern(name)
+            key = (name, int(point[1] * 1000))
+            if key in batch:
+                collapsed += 1
+            batch[key] = point
+            if len(batch) >= batch_size:
+                full_batches.append(batch.values())
+                batch = dict()
+        self._batch = batch
+        self.stats["collapsed"] += collapsed
+
+    def _enqueue(self, batch, block=True):
+        try:
+            self._queue.put(batch, block)
+        except Queue.Full:
+            with self._lock:
+                self.stats["dropped"] += len(batch)
+
+    def flush(self):
+        """
+        Queue whatever is in the current, partial batch.
+        """
+        with self._lock:
+            batch = self._batch
+            self._batch = self._new_batch()
+        if self.coalesce:
+            batch = batch.values()
+        if batch:
+            self._enqueue(batch)
+
+    def _flusher(self):
+        while self._running:
+            time.sleep(min(self.flush_interval, 0.1))
+            with self._lock:
+                due = self._batch and time.time() - self._batch_started >= self.flush_interval
+            if due:
+                self.flush()
+
+    def _writer(self):
+        while True:
+            batch = self._queue.get()
+            try:
+                if batch is None:
+                    return
+                self.write_batch(batch)
+            except Exception:
+                # a writer that died would never be replaced, and the listeners would block once they all had
+                LOG.exception("Writing a batch of %d points failed", len(batch))
+            finally:
+                self._queue.task_done()
+
+    def write_batch(self, batch):
+        """
+        :type batch: list
+        :param batch: (name, timestamp, value) tuples
+
+        Tag the batch with its retentions and write it to KairosDB.
+        Failures are logged and counted, but the batch is not retried.
+        """
+        try:
+            metrics = list(graphite.graphite_metric_list_with_retentions_to_kairosdb_list(
+                batch, self.storage_schemas, self.pervasive_tags))
+            r = self.conn.write_metrics(metrics)
+            ok = r.status_code == 204
+        except Exception:
+            LOG.exception("Writing a batch of %d points to KairosDB failed", len(batch))
+            ok = False
+        else:
+            if not ok:
+                LOG.error("Writing a batch of %d points to KairosDB failed. Status code: %s, content: %s",
+                          len(batch), r.status_code, r.content)
+        with self._lock:
+            self.stats["batches"] += 1
+            if ok:
+                self.stats["written"] += len(batch)
+            else:
+                self.stats["write_errors"] += 1
+
+    def address(self, listener):
+        """
+        :type listener: str
+        :param listener: one of "line", "pickle" or "udp"
+
+        :rtype: tuple
+        :return: the (host, port) the listener is bound to, useful when it was started on port 0
+        """
+        return self._servers[listener].server_address
+
+    def start(self):
+        """
+        Bind the listeners and start the threads that serve them and
+        write to KairosDB.  This returns immediately.
+        """
+        server_classes = {"line" : (_TCPServer, _LineHandler),
+                          "pickle" : (_TCPServer, _PickleHandler),
+                          "udp" : (_UDPServer, _UDPHandler)}
+        self._running = True
+        for n in range(self.writer_threads):
+            self._start_thread(self._writer)
+        self._start_thread(self._flusher)
+        for listener, port in self.ports.items():
+            if port is None:
+                continue
+            server_class, handler_class = server_classes[listener]
+            server = server_class((self.interface, port), handler_class)
+            server.relay = self
+            self._servers[listener] = server
+            self._start_thread(server.serve_forever)
+        return self
+
+    def _start_thread(self, target):
+        t = threading.Thread(target=target)
+        t.daemon = True
+        t.start()
+        self._threads.append(t)
+
+    def stop(self):
+        """
+        Close the listeners, then write everything that has been
+        received before returning.
+        """
+        for server in self._servers.values():
+            server.shutdown()
+            server.server_close()
+        self._servers = dict()
+        self._running = False
+        self.flush()
+        for n in range(self.writer_threads):
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = list()
+
+    def serve_forever(self):
+        """
+        Start the relay and block until interrupted.
+        """
+        self.start()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
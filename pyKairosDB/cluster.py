@@ -0,0 +1,426 @@
+# -*- python -*-
+
+"""
+A connection to several KairosDB nodes that serve the same data, e.g.
+several front-ends of one Cassandra cluster, without a load balancer
+in front of them.
+
+Each read, write or delete made through the connection's methods is
+sent to one healthy node, picked either round-robin or by the fewest
+requests outstanding.  A background thread checks every node's
+/api/v1/version endpoint; a node that fails unhealthy_threshold checks
+(or requests) in a row is ejected, and it's brought back after it
+passes healthy_threshold checks in a row.  A request that can't reach
+its node is tried once more on another node.
+
+Reads can be hedged to cut tail latency: if a read hasn't been answered
+within hedge_after seconds, it's also sent to a second node and
+whichever answers first is used.  The number of extra reads is capped
+by max_hedge_ratio.
+
+The module-level functions (e.g. metadata.get_all_metric_names(conn))
+read the connection's URLs directly, and those always point at the
+first healthy node.
+"""
+
+import itertools
+import logging
+import Queue
+import threading
+import time
+from collections import deque
+
+import requests
+
+from . import connection
+from . import instrumentation
+from . import metadata
+from . import transport
+
+LOG = logging.getLogger(__name__)
+
+ROUND_ROBIN       = "round_robin"
+LEAST_OUTSTANDING = "least_outstanding"
+
+HEDGE_AT_P95        = "p95" # hedge reads that take longer than the 95th percentile of recent reads
+LATENCY_SAMPLES     = 1000  # how many recent read latencies the percentile is taken from
+MIN_LATENCY_SAMPLES = 20    # until there are this many, hedge_after_default is used
+PERCENTILE_EVERY    = 50    # how many reads between re-computing the percentile
+MAX_SAVED_HEDGES    = 10
+
+# The KairosDBConnection methods that are sent to one node of the cluster
+BALANCED_METHODS = ("write_one_metric", "write_metrics",
+                    "delete_datapoints", "delete_datapoints_chunked", "delete_metrics",
+                    "delete_metrics_matching", "metric_names", "tag_names", "tag_values")
+
+
+class NoHealthyNodesError(requests.ConnectionError):
+    """Every node of the cluster has been ejected"""
+
+
+class Node(object):
+    """
+    :type conn: KairosDBConnection
+    :param conn: the connection to this node
+
+    The health and load of one node of a cluster.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.healthy = True
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.consecutive_successes = 0
+
+    def __repr__(self):
+        return "<Node {0.server}:{0.port} healthy={1.healthy} outstanding={1.outstanding}>".format(self.conn, self)
+
+
+def _balanced(name):
+    def method(self, *args, **kwargs):
+        return self._call(name, *args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = getattr(connection.KairosDBConnection, name).__doc__
+    return method
+
+
+class KairosDBCluster(connection.KairosDBConnection):
+    """
+    :type nodes: list
+    :param nodes: the nodes, as (server, port) tuples or "server:port" strings
+
+    :type ssl: bool
+    :param ssl: Whether or not to use ssl for the connections.
+
+    :type strategy: str
+    :param strategy: ROUND_ROBIN or LEAST_OUTSTANDING
+
+    :type health_check_interval: float
+    :param health_check_interval: seconds between health checks, None to not run the checks
+
+    :type unhealthy_threshold: int
+    :param unhealthy_threshold: consecutive failures after which a node is ejected
+
+    :type healthy_threshold: int
+    :param healthy_threshold: consecutive passed checks after which an ejected node is used again
+
+    :type health_check_timeout: float
+    :param health_check_timeout: seconds to wait for each node to answer a health check
+
+    :type hedge_after: float
+    :param hedge_after: enables hedged reads.  The number of seconds a read_absolute() or
+        read_relative() may take before the same read is also sent to a second node, or
+        HEDGE_AT_P95 to use the 95th percentile of recent reads.  None doesn't hedge.
+
+    :type hedge_after_default: float
+    :param hedge_after_default: the hedge delay used with HEDGE_AT_P95 until enough reads have been timed
+
+    :type max_hedge_ratio: float
+    :param max_hedge_ratio: the most extra reads hedging may add, as a fraction of all reads
+
+    Any other keyword arguments, e.g. the timeouts, are given to the
+    KairosDBConnection of each node.  Each node has its own circuit
+    breaker, and a node whose breaker is open is skipped like one that
+    can't be reached.  The operations of every node are measured
+    together in the cluster's instrumentation.
+
+    Hedging is counted in hedge_stats: reads (hedgeable reads made),
+    fired (reads that were sent to a second node) and won (reads where
+    the second node answered first).
+    """
+
+    def __init__(self, nodes, ssl=False, strategy=ROUND_ROBIN, health_check_interval=5,
+                 unhealthy_threshold=2, healthy_threshold=2, health_check_timeout=2,
+                 hedge_after=None, hedge_after_default=0.05, max_hedge_ratio=0.05, **connection_options):
+        if strategy not in (ROUND_ROBIN, LEAST_OUTSTANDING):
+            raise ValueError("strategy must be {0} or {1}, not {2}".format(ROUND_ROBIN, LEAST_OUTSTANDING, strategy))
+        self.ssl = ssl
+        self.strategy = strategy
+        self.unhealthy_threshold = unhealthy_threshold
+        self.healthy_threshold = healthy_threshold
+        self.health_check_timeout = health_check_timeout
+        self.nodes = list()
+        for n in nodes:
+            if isinstance(n, basestring):
+                n = n.rsplit(":", 1)
+            self.nodes.append(Node(connection.KairosDBConnection(n[0], str(n[1]), ssl, **connection_options)))
+        if not self.nodes:
+            raise ValueError("A cluster needs at least one node")
+        self.instrumentation = None
+        if connection_options.get("instrument", True):
+            self.instrumentation = instrumentation.Instrumentation()
+        for node in self.nodes:
+            node.conn.instrumentation = self.instrumentation
+        self.hedge_after = hedge_after
+        self.hedge_after_default = hedge_after_default
+        self.max_hedge_ratio = max_hedge_ratio
+        self.hedge_stats = {"reads" : 0, "fired" : 0, "won" : 0}
+        self._hedge_tokens = 0
+        self._read_latencies = deque(maxlen=LATENCY_SAMPLES)
+        self._reads_since_percentile = 0
+        self._p95 = None
+        self._lock = threading.Lock()
+        self._round_robin = itertools.cycle(range(len(self.nodes)))
+        self._stop = threading.Event()
+        self._health_thread = None
+        if health_check_interval is not None:
+            self._health_thread = threading.Thread(target=self._health_checker, args=(health_check_interval,))
+            self._health_thread.daemon = True
+            self._health_thread.start()
+
+    def close(self):
+        """
+        Stop the health checks.
+        """
+        self._stop.set()
+        if self._health_thread is not None:
+            self._health_thread.join()
+
+    def healthy_nodes(self):
+        """
+        :rtype: list
+        :return: the nodes that requests are currently sent to
+        """
+        return [ n for n in self.nodes if n.healthy ]
+
+    def _primary(self):
+        healthy = self.healthy_nodes()
+        if not healthy:
+            return self.nodes[0].conn
+        return healthy[0].conn
+
+    # The URLs and address of the first healthy node, for code that uses them directly.
+    server            = property(lambda self: self._primary().server)
+    port              = property(lambda self: self._primary().port)
+    schema            = property(lambda self: self._primary().schema)
+    read_url          = property(lambda self: self._primary().read_url)
+    read_tag_url      = property(lambda self: self._primary().read_tag_url)
+    write_url         = property(lambda self: self._primary().write_url)
+    delete_dps_url    = property(lambda self: self._primary().delete_dps_url)
+    delete_metric_url = property(lambda self: self._primary().delete_metric_url)
+    connect_timeout   = property(lambda self: self._primary().connect_timeout)
+    read_timeout      = property(lambda self: self._primary().read_timeout)
+    total_timeout     = property(lambda self: self._primary().total_timeout)
+    circuit_breaker   = property(lambda self: self._primary().circuit_breaker)
+
+    def _generate_urls(self):
+        pass # each node has its own
+
+    def pick_node(self, exclude=()):
+        """
+        :type exclude: tuple
+        :param exclude: nodes that shouldn't be picked
+
+        :rtype: Node
+        :return: the node that the next request should go to, with its outstanding count
+            already incremented.  release_node() must be called when the request is done.
+
+        :raises: NoHealthyNodesError if no node can be picked
+        """
+        with self._lock:
+            candidates = [ n for n in self.nodes if n.healthy and n not in exclude ]
+            if not candidates:
+                raise NoHealthyNodesError("None of the nodes of the cluster are healthy: {0}".format(self.nodes))
+            if self.strategy == LEAST_OUTSTANDING:
+                node = min(candidates, key=lambda n: n.outstanding)
+            else:
+                for i in self._round_robin:
+                    if self.nodes[i] in candidates:
+                        node = self.nodes[i]
+                        break
+            node.outstanding += 1
+        return node
+
+    def release_node(self, node, failed=False):
+        """
+        :type node: Node
+        :param node: a node returned by pick_node()
+
+        :type failed: bool
+        :param failed: whether the node couldn't be reached
+        """
+        with self._lock:
+            node.outstanding -= 1
+        self._record(node, not failed)
+
+    def _record(self, node, ok):
+        with self._lock:
+            if ok:
+                node.consecutive_failures = 0
+                node.consecutive_successes += 1
+                if not node.healthy and node.consecutive_successes >= self.healthy_threshold:
+                    LOG.info("KairosDB node %s:%s is healthy again", node.conn.server, node.conn.port)
+                    node.healthy = True
+            else:
+                node.consecutive_successes = 0
+                node.consecutive_failures += 1
+                if node.healthy and node.consecutive_failures >= self.unhealthy_threshold:
+                    LOG.warning("Ejecting KairosDB node %s:%s after %d failures",
+                                node.conn.server, node.conn.port, node.consecutive_failures)
+                    node.healthy = False
+
+    def _call(self, name, *args, **kwargs):
+        tried = list()
+        timestamps = None
+        if name == "write_metrics":
+            # encoding converts the timestamps in place, so a retry has to start from the originals
+            timestamps = [ m["timestamp"] for m in args[0] ]
+        while True:
+            node = self.pick_node(exclude=tried)
+            if tried and timestamps is not None:
+                for m, timestamp in zip(args[0], timestamps):
+                    m["timestamp"] = timestamp
+            try:
+                result = getattr(node.conn, name)(*args, **kwargs)
+            except transport.DeadlineExceeded:
+                self.release_node(node) # the caller ran out of time, the node didn't fail
+                raise
+            except (requests.ConnectionError, requests.Timeout):
+                self.release_node(node, failed=True)
+                tried.append(node)
+                if len(tried) >= 2:
+                    raise
+                continue
+            except Exception:
+                self.release_node(node)
+                raise
+            self.release_node(node)
+            return result
+
+    def _hedge_delay(self):
+        """
+        :rtype: float
+        :return: how long to wait for a read before hedging it
+        """
+        if self.hedge_after != HEDGE_AT_P95:
+            return self.hedge_after
+        with self._lock:
+            if len(self._read_latencies) < MIN_LATENCY_SAMPLES:
+                return self.hedge_after_default
+            if self._reads_since_percentile >= PERCENTILE_EVERY or self._p95 is None:
+                ordered = sorted(self._read_latencies)
+                self._p95 = ordered[int(len(ordered) * 0.95) - 1]
+                self._reads_since_percentile = 0
+            return self._p95
+
+    def _record_read_latency(self, seconds):
+        with self._lock:
+            self._read_latencies.append(seconds)
+            self._reads_since_percentile += 1
+
+    def _take_hedge_token(self):
+        """
+        Every read earns max_hedge_ratio of a hedge, and every hedge
+        spends one, so hedging can add at most that fraction of extra
+        reads.  A few unspent hedges are saved up for bursts of slow reads.
+        """
+        with self._lock:
+            if self._hedge_tokens >= 1:
+                self._hedge_tokens -= 1
+                return True
+            return False
+
+    def _hedged_call(self, name, *args, **kwargs):
+        """
+        Send the read to one node, and if it hasn't answered within the
+        hedge delay, send it to a second node too.  The first successful
+        answer is returned.  The other request can't be stopped once it's
+        been sent, so it's abandoned: its node is released and its answer
+        is discarded whenever it arrives.
+        """
+        with self._lock:
+            self.hedge_stats["reads"] += 1
+            self._hedge_tokens = min(self._hedge_tokens + self.max_hedge_ratio, MAX_SAVED_HEDGES)
+        answers = Queue.Queue()
+
+        def attempt(node, hedged):
+            start = time.time()
+            try:
+                result = getattr(node.conn, name)(*args, **kwargs)
+            except Exception, e:
+                failed = isinstance(e, (requests.ConnectionError, requests.Timeout))
+                self.release_node(node, failed=failed and not isinstance(e, transport.DeadlineExceeded))
+                answers.put((hedged, False, e))
+                return
+            self.release_node(node)
+            self._record_read_latency(time.time() - start)
+            answers.put((hedged, True, result))
+
+        def start(node, hedged):
+            t = threading.Thread(target=attempt, args=(node, hedged))
+            t.daemon = True
+            t.start()
+
+        primary = self.pick_node()
+        start(primary, False)
+        in_flight = 1
+        try:
+            answer = answers.get(timeout=self._hedge_delay())
+        except Queue.Empty:
+            answer = None
+            if self._take_hedge_token():
+                try:
+                    secondary = self.pick_node(exclude=[primary])
+                except NoHealthyNodesError:
+                    secondary = None
+                if secondary is not None:
+                    with self._lock:
+                        self.hedge_stats["fired"] += 1
+                    start(secondary, True)
+                    in_flight += 1
+        while True:
+            if answer is None:
+                answer = answers.get()
+            in_flight -= 1
+            hedged, ok, value = answer
+            if ok:
+                if hedged:
+                    with self._lock:
+                        self.hedge_stats["won"] += 1
+                return value
+            if in_flight == 0:
+                if (isinstance(value, (requests.ConnectionError, requests.Timeout)) and not hedged
+                        and not isinstance(value, transport.DeadlineExceeded)):
+                    return self._call(name, *args, **kwargs) # the primary was unreachable, and nothing was hedged
+                raise value
+            answer = None
+
+    def read_relative(self, *args, **kwargs):
+        if self.hedge_after is None:
+            return self._call("read_relative", *args, **kwargs)
+        return self._hedged_call("read_relative", *args, **kwargs)
+    read_relative.__doc__ = connection.KairosDBConnection.read_relative.__doc__
+
+    def read_absolute(self, *args, **kwargs):
+        if self.hedge_after is None:
+            return self._call("read_absolute", *args, **kwargs)
+        return self._hedged_call("read_absolute", *args, **kwargs)
+    read_absolute.__doc__ = connection.KairosDBConnection.read_absolute.__doc__
+
+    def check_health(self):
+        """
+        Check every node once, ejecting and re-admitting them as needed.
+        """
+        for node in self.nodes:
+            try:
+                r = requests.get("{0.schema}://{0.server}:{0.port}/api/v1/version".format(node.conn),
+                                 timeout=self.health_check_timeout)
+                ok = r.status_code == 200
+            except requests.RequestException:
+                ok = False
+            self._record(node, ok)
+
+    def _health_checker(self, interval):
+        while not self._stop.wait(interval):
+            self.check_health()
+
+    def server_version(self, ttl=metadata.DEFAULT_VERSION_TTL, deadline=None):
+        """
+        :rtype: str
+        :return: the version of the first healthy node
+        """
+        return self._primary().server_version(ttl, deadline)
+
+for _name in BALANCED_METHODS:
+    setattr(KairosDBCluster, _name, _balanced(_name))
@@ -6,6 +6,8 @@ from . import reader
 from . import metadata
 from . import graphite
 from . import deleter
+from . import instrumentation
+from . import transport
 
 class KairosDBConnection(object):
     """
@@ -15,9 +17,40 @@ class KairosDBConnection(object):
     :param port: the port, as a string, that the KairosDB instance is running on
     :type ssl: bool
     :param ssl: Whether or not to use ssl for this connection.
+    :type connect_timeout: float
+    :param connect_timeout: the default seconds each request may take to connect.  None for no limit.
+    :type read_timeout: float
+    :param read_timeout: the default seconds each request may wait between bytes of the response.  None for no limit.
+    :type total_timeout: float
+    :param total_timeout: the default seconds each request may take altogether.  None for no limit.
+    :type circuit_breaker_threshold: int
+    :param circuit_breaker_threshold: how many requests in a row may time out before requests fail
+        fast with transport.CircuitOpenError.  None never fails fast.
+    :type circuit_breaker_reset: float
+    :param circuit_breaker_reset: seconds of failing fast before a request is let through to test the server
+    :type instrument: bool
+    :param instrument: whether to measure every operation in the instrumentation attribute, see
+        pyKairosDB.instrumentation
+    :type write_transport: telnet.TelnetTransport
+    :param write_transport: if given, writes are sent with it instead of being posted to the REST API
+    :type max_request_bytes: int
+    :param max_request_bytes: writes that encode to more than this are split into several requests.  None for no limit.
+    :type max_request_points: int
+    :param max_request_points: writes of more metrics than this are split into several requests.  None for no limit.
+    :type write_workers: int
+    :param write_workers: how many of the requests a split write sends at once
+    :type recent_store: recent.RecentStore
+    :param recent_store: if given, what's written is kept in it, and reads it covers are answered from it
+
+    Any of the timeouts can be overridden for one call by giving it a
+    deadline, see pyKairosDB.transport.
     """
 
-    def __init__(self, server='localhost', port='8080', ssl=False):
+    def __init__(self, server='localhost', port='8080', ssl=False,
+                 connect_timeout=transport.DEFAULT_CONNECT_TIMEOUT, read_timeout=transport.DEFAULT_READ_TIMEOUT,
+                 total_timeout=None, circuit_breaker_threshold=5, circuit_breaker_reset=30, instrument=True,
+                 write_transport=None, max_request_bytes=writer.DEFAULT_MAX_REQUEST_BYTES,
+                 max_request_points=writer.DEFAULT_MAX_REQUEST_POINTS, write_workers=4, recent_store=None):
         """
         :type server: str
         :param server: the host to connect to that is running KairosDB
@@ -29,12 +62,26 @@ class KairosDBConnection(object):
         self.ssl  = ssl
         self.server = server
         self.port = port
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.total_timeout = total_timeout
+        self.circuit_breaker = None
+        if circuit_breaker_threshold is not None:
+            self.circuit_breaker = transport.CircuitBreaker(circuit_breaker_threshold, circuit_breaker_reset)
+        self.write_transport = write_transport
+        self.max_request_bytes = max_request_bytes
+        self.max_request_points = max_request_points
+        self.write_workers = write_workers
+        self.recent_store = recent_store
+        self.instrumentation = None
+        if instrument:
+            self.instrumentation = instrumentation.Instrumentation()
 
         # We shouldn't have to worry about efficient re-use of connections, pooling, etc. See:
         # http://docs.python-requests.org/en/latest/user/advanced/#keep-alive
         self._generate_urls()
-        metadata.get_server_version(self) # XXX check for failure to connect
-
+        # Nothing is sent to the server until it's used.  server_version() can be used
+        # to check that the server is reachable.
 
 
     def _generate_urls(self):
@@ -52,7 +99,77 @@ class KairosDBConnection(object):
         self.delete_dps_url = "{0}://{1}:{2}/api/v1/datapoints/delete".format(self.schema, self.server, self.port)
         self.delete_metric_url = "{0}://{1}:{2}/api/v1/metric/".format(self.schema, self.server, self.port)
 
-    def write_one_metric(self, name, timestamp, value, tags):
+    def new_deadline(self, total=None, connect=None, read=None):
+        """
+        :type total: float
+        :param total: seconds until everything done under the deadline must be finished
+        :type connect: float
+        :param connect: seconds each request may take to connect
+        :type read: float
+        :param read: seconds each request may wait between bytes of the response
+
+        :rtype: transport.Deadline
+        :return: a deadline that starts now, with this connection's defaults for anything not given.
+            It can be passed as the deadline of any call, and shared by several calls.
+        """
+        return transport.new_deadline(self, total, connect, read)
+
+    def server_version(self, ttl=metadata.DEFAULT_VERSION_TTL, deadline=None):
+        """
+        :type ttl: float
+        :param ttl: how many seconds a cached version is used for, None to keep it forever
+
+        :type deadline: transport.Deadline
+        :param deadline: the deadline for the call, per pyKairosDB.transport.  None for the connection's defaults.
+
+        :rtype: str
+        :return: the version of the KairosDB server
+
+        The version is asked for once and shared with every connection
+        to the same server, port and schema.
+        """
+        return metadata.get_cached_server_version(self, ttl, deadline=deadline)
+
+    def metric_names(self, ttl=metadata.DEFAULT_NAMES_TTL, deadline=None):
+        """
+        :type ttl: float
+        :param ttl: how many seconds a cached list is used for
+
+        :type deadline: transport.Deadline
+        :param deadline: the deadline for the call, per pyKairosDB.transport.  None for the connection's defaults.
+
+        :rtype: list
+        :return: all of the metric names that the server has recorded
+        """
+        return metadata.get_cached_metric_names(self, ttl, deadline=deadline)
+
+    def tag_names(self, ttl=metadata.DEFAULT_NAMES_TTL, deadline=None):
+        """
+        :type ttl: float
+        :param ttl: how many seconds a cached list is used for
+
+        :type deadline: transport.Deadline
+        :param deadline: the deadline for the call, per pyKairosDB.transport.  None for the connection's defaults.
+
+        :rtype: list
+        :return: all of the tag names that the server has recorded
+        """
+        return metadata.get_cached_tag_names(self, ttl, deadline=deadline)
+
+    def tag_values(self, ttl=metadata.DEFAULT_NAMES_TTL, deadline=None):
+        """
+        :type ttl: float
+        :param ttl: how many seconds a cached list is used for
+
+        :type deadline: transport.Deadline
+        :param deadline: the deadline for the call, per pyKairosDB.transport.  None for the connection's defaults.
+
+        :rtype: list
+        :return: all of the tag values that the server has recorded
+        """
+        return metadata.get_cached_tag_values(self, ttl, deadline=deadline)
+
+    def write_one_metric(self, name, timestamp, value, tags, deadline=None):
         """
         :type name: str
         :param name: the name of the metric being written
@@ -66,6 +183,9 @@ class KairosDBConnection(object):
         :type tags: dict
         :param tags: A dictionary of key : value strings that are the tags that will be recorded with this metric.
 
+        :type deadline: transport.Deadline
+        :param deadline: the deadline for the call, per pyKairosDB.transport.  None for the connection's defaults.
+
         :rtype: requests.response
         :return: a requests.response object with the results of the write
 
@@ -74,20 +194,24 @@ class KairosDBConnection(object):
         batches, and write_metrics() should be used instead in these cases.
 
         """
-        return writer.write_one_metric(self, name, timestamp, value, tags)
+        return writer.write_one_metric(self, name, timestamp, value, tags, deadline=deadline)
 
-    def write_metrics(self, metric_list):
+    def write_metrics(self, metric_list, deadline=None):
         """
         :type tags: list
         :param tags: list of dictionaries of metrics, including name, timestamp, value, and tags to be written
 
+        :type deadline: transport.Deadline
+        :param deadline: the deadline for the call, per pyKairosDB.transport.  None for the connection's defaults.
+
         :rtype: requests.response
-        :return: a requests.response object with the results of the write
+        :return: a requests.response object with the results of the write, or a writer.WriteSummary
+            if it was split into several requests
         """
-        return writer.write_metrics_list(self, metric_list)
+        return writer.write_metrics_list(self, metric_list, deadline=deadline)
 
     def read_relative(self, metric_names_list, start_time, end_time=None,
-                      query_modifying_function=None, only_read_tags=False, tags=None):
+                      query_modifying_function=None, only_read_tags=False, tags=None, deadline=None):
         """
         :type metric_names_list: list
         :param metric_names_list: list of metric names to be queried
@@ -112,6 +236,9 @@ class KairosDBConnection(object):
         :param tags: Contains tags which will be added to the query. If only_read_tags=True, will filter the results to
             those that have specified tags.
 
+        :type deadline: transport.Deadline
+        :param deadline: the deadline for the call, per pyKairosDB.transport.  None for the connection's defaults.
+
         :rtype: requests.response
         :return: a requests.response object with the results of the write
 
@@ -120,10 +247,10 @@ class KairosDBConnection(object):
         """
         return reader.read_relative(self, metric_names_list, start_time, end_time,
                                     query_modifying_function=query_modifying_function,
-                                    only_read_tags=only_read_tags, tags=tags)
+                                    only_read_tags=only_read_tags, tags=tags, deadline=deadline)
 
     def read_absolute(self, metric_names_list, start_time, end_time=None,
-                      query_modifying_function=None, only_read_tags=False, tags=None):
+                      query_modifying_function=None, only_read_tags=False, tags=None, deadline=None):
         """
         :type metric_names_list: list
         :param metric_names_list: list of metric names to be queried
@@ -146,6 +273,9 @@ class KairosDBConnection(object):
         :param tags: Contains tags which will be added to the query. If only_read_tags=True, will filter the results to
             those that have specified tags.
 
+        :type deadline: transport.Deadline
+        :param deadline: the deadline for the call, per pyKairosDB.transport.  None for the connection's defaults.
+
         :rtype: requests.response
         :return: a requests.response object with the results of the write
 
@@ -154,9 +284,27 @@ class KairosDBConnection(object):
         """
         return reader.read_absolute(self, metric_names_list, start_time, end_time,
                                     query_modifying_function=query_modifying_function,
-                                    only_read_tags=only_read_tags, tags=tags)
+                                    only_read_tags=only_read_tags, tags=tags, deadline=deadline)
 
-    def delete_datapoints(self, metric_names_list, start_time, end_time=None, tags=None):
+    def get_latest(self, metric_names_list, tags=None, lookback=(1, "days"), batch_size=reader.LATEST_BATCH_SIZE,
+                   workers=1, deadline=None):
+        """
+        :type metric_names_list: list
+        :param metric_names_list: metric names, or (name, tags) tuples for series
+
+        :type lookback: tuple
+        :param lookback: how far back to look for a value, as a pair like start_time in read_relative()
+
+        :rtype: dict
+        :return: each name or series that has a value, to its latest (timestamp, value)
+
+        Get the latest value of many series with one datapoint sent back
+        for each, per reader.get_latest()
+        """
+        return reader.get_latest(self, metric_names_list, tags=tags, lookback=lookback, batch_size=batch_size,
+                                 workers=workers, deadline=deadline)
+
+    def delete_datapoints(self, metric_names_list, start_time, end_time=None, tags=None, deadline=None):
         """
         :type metric_names_list: list
         :param metric_names_list: list of metric names to be queried.
@@ -174,16 +322,100 @@ class KairosDBConnection(object):
         :param tags: Tags to be searched in metrics. Allows to filter the results to only metric which contain specified
         tags in case only_read_tags=True.
 
+        :type deadline: transport.Deadline
+        :param deadline: the deadline for the call, per pyKairosDB.transport.  None for the connection's defaults.
+
         Performs the query made from specified parameters and deletes all data points returned by the query.
         Aggregators and groupers have no effect on which data points are deleted.
         Note: Works for the Cassandra and H2 data store only.
         """
-        return deleter.delete_datapoints(self, metric_names_list, start_time, 
-                                         end_time, tags=tags)
+        return deleter.delete_datapoints(self, metric_names_list, start_time,
+                                         end_time, tags=tags, deadline=deadline)
 
-    def delete_metrics(self, metric_names_list):
+    def delete_datapoints_chunked(self, metric_names_list, start_time, end_time=None, tags=None,
+                                  window=3600, workers=1, max_rate=None, progress_callback=None,
+                                  checkpoint_file=None, deadline=None):
+        """
+        :type metric_names_list: list
+        :param metric_names_list: list of metric names whose datapoints will be deleted.
+
+        :type start_time: float
+        :param start_time: The start time of the data to delete as seconds since the epoch (per python's time.time())
+
+        :type end_time: float
+        :param end_time: The end time of the data to delete as seconds since the epoch (per python's time.time())
+
+        :type tags: dict
+        :param tags: Tags to be searched in metrics, per delete_datapoints()
+
+        :type window: float
+        :param window: the number of seconds of data deleted by each request
+
+        :type workers: int
+        :param workers: how many windows may be deleted at once
+
+        :type max_rate: float
+        :param max_rate: if given, the most windows that will be started per second
+
+        :type progress_callback: callable
+        :param progress_callback: called after each window with (done_through, windows_done, windows_total)
+
+        :type checkpoint_file: str
+        :param checkpoint_file: if given, progress is saved here and an interrupted deletion resumes from it
+
+        :type deadline: transport.Deadline
+        :param deadline: a deadline shared by every window.  None gives each window the connection's defaults.
+
+        :rtype: int
+        :return: the number of windows that were deleted
+
+        Like delete_datapoints(), but the range is deleted a window at a
+        time so that the tombstones don't pile up all at once.  See
+        pyKairosDB.deleter.delete_datapoints_chunked().
+        """
+        return deleter.delete_datapoints_chunked(self, metric_names_list, start_time, end_time, tags=tags,
+                                                 window=window, workers=workers, max_rate=max_rate,
+                                                 progress_callback=progress_callback,
+                                                 checkpoint_file=checkpoint_file, deadline=deadline)
+
+    def delete_metrics(self, metric_names_list, workers=1, max_rate=None, deadline=None):
         """
         :type metric_names_list: list
         :param metric_names_list: list of metric names to be deleted.
+
+        :type workers: int
+        :param workers: how many deletions may be in flight at once
+
+        :type max_rate: float
+        :param max_rate: if given, the most deletions that will be started per second
+
+        :type deadline: transport.Deadline
+        :param deadline: a deadline shared by every deletion.  None gives each one the connection's defaults.
+
+        :rtype: dict
+        :return: a dict of metric name to None for each metric that was deleted, or to the exception
+            that was raised while deleting it
+        """
+        return deleter.delete_metrics(self, metric_names_list, workers=workers, max_rate=max_rate,
+                                      deadline=deadline)
+
+    def delete_metrics_matching(self, pattern, workers=1, max_rate=None, deadline=None):
+        """
+        :type pattern: str
+        :param pattern: a graphite-style glob selecting the metrics to be deleted
+
+        :type workers: int
+        :param workers: how many deletions may be in flight at once
+
+        :type max_rate: float
+        :param max_rate: if given, the most deletions that will be started per second
+
+        :type deadline: transport.Deadline
+        :param deadline: a deadline shared by every deletion.  None gives each one the connection's defaults.
+
+        :rtype: dict
+        :return: a dict of metric name to None for each metric that was deleted, or to the exception
+            that was raised while deleting it
         """
-        return deleter.delete_metrics(self, metric_names_list)
+        return deleter.delete_metrics_matching(self, pattern, workers=workers, max_rate=max_rate,
+                                               deadline=deadline)
@@ -2,13 +2,20 @@
 
 import json
 import logging
+import os
+import time
 import requests
+from multiprocessing.pool import ThreadPool
 
 from . import reader
+from . import graphite
+from . import instrumentation
+from . import transport
+from . import util
 
 LOG = logging.getLogger(__name__)
 
-def delete_metric(conn, metric):
+def delete_metric(conn, metric, deadline=None):
     """Deletes metric and all it's datapoints from the database.
 
     :type conn: pyKairosDB.connect object
@@ -16,27 +23,102 @@ def delete_metric(conn, metric):
 
     :type metric:
     :param metric: the metric name
+
+    :type deadline: transport.Deadline
+    :param deadline: the deadline for the request, per pyKairosDB.transport.  None for the connection's defaults.
+
+    :raises: requests.HTTPError if KairosDB doesn't confirm the deletion
     """
     delete_url = conn.delete_metric_url + str(metric)
-    r = requests.delete(delete_url)
+    with instrumentation.operation(conn, "delete_metric") as op:
+        with op.phase("network"):
+            r = transport.request(conn, "DELETE", delete_url, deadline=deadline)
+        op.response_bytes = len(r.content)
     if r.status_code != 204:
-        LOG.exception('deletion of metric %s failed. Status code: %s') % (
-            metric, r.status_code)
-        raise
+        LOG.error('deletion of metric %s failed. Status code: %s', metric, r.status_code)
+        raise requests.HTTPError('deletion of metric {0} failed. Status code: {1}'.format(
+            metric, r.status_code), response=r)
 
-def delete_metrics(conn, metric_names_list):
+def delete_metrics(conn, metric_names_list, workers=1, max_rate=None, deadline=None):
     """
     :type conn: pyKairosDB.connect object
     :param conn: the interface to the requests library
 
     :type metric_names_list: list of str
     :param metric_names_list: A list of metric names to be deleted
+
+    :type workers: int
+    :param workers: how many deletions may be in flight at once
+
+    :type max_rate: float
+    :param max_rate: if given, the most deletions that will be started per second, across all workers
+
+    :type deadline: transport.Deadline
+    :param deadline: a deadline shared by every deletion.  None gives each one the connection's defaults.
+        Once it's passed, the metrics that are left fail with transport.DeadlineExceeded.
+
+    :rtype: dict
+    :return: a dict of metric name to None for each metric that was deleted, or to the exception
+        that was raised while deleting it
+
+    Every metric is attempted, a failure doesn't stop the others from
+    being deleted.
     """
-    for metric in metric_names_list:
-        delete_metric(conn, metric)
+    limiter = None
+    if max_rate is not None:
+        limiter = util.RateLimiter(max_rate)
+
+    def delete_one(metric):
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            delete_metric(conn, metric, deadline)
+        except Exception, e:
+            return (metric, e)
+        return (metric, None)
+
+    if workers <= 1:
+        results = dict(delete_one(m) for m in metric_names_list)
+    else:
+        pool = ThreadPool(workers)
+        try:
+            results = dict(pool.imap_unordered(delete_one, metric_names_list))
+        finally:
+            pool.close()
+            pool.join()
+    # The graphite name index may still list what was just deleted
+    graphite.expand_graphite_wildcard_metric_name.cache_timestamp = 0
+    return results
+
+def delete_metrics_matching(conn, pattern, workers=1, max_rate=None, deadline=None):
+    """
+    :type conn: pyKairosDB.connect object
+    :param conn: the interface to the requests library
+
+    :type pattern: str
+    :param pattern: a graphite-style glob, e.g. "retired.{web,api}-0[1-9].*"
+
+    :type workers: int
+    :param workers: how many deletions may be in flight at once
+
+    :type max_rate: float
+    :param max_rate: if given, the most deletions that will be started per second, across all workers
+
+    :type deadline: transport.Deadline
+    :param deadline: per delete_metrics()
+
+    :rtype: dict
+    :return: per delete_metrics()
+
+    The metrics are selected from a freshly fetched copy of the name
+    index with graphite.find_nodes(), and only the names that are
+    metrics - not the branches - are deleted.
+    """
+    names = [ name for name, kind in graphite.find_nodes(conn, pattern, cache_ttl=0) if kind == "leaf" ]
+    return delete_metrics(conn, names, workers=workers, max_rate=max_rate, deadline=deadline)
 
 def delete_datapoints(conn, metric_names_list, start_time,
-                      end_time=None, tags=None):
+                      end_time=None, tags=None, deadline=None):
     """Deletes data points.
 
     :type conn: pyKairosDB.connect object
@@ -57,11 +139,136 @@ def delete_datapoints(conn, metric_names_list, start_time,
     :param tags: Tags to be searched in metrics. Allows to filter the results to only metric which contain specified
         tags in case only_read_tags=True.
 
+    :type deadline: transport.Deadline
+    :param deadline: the deadline for the request, per pyKairosDB.transport.  None for the connection's defaults.
+
     First the query is created to retrieve the data points which will be deleted afterwards.
     """
     query = reader._query_absolute(start=start_time, end=end_time)
+    return _post_delete_query(conn, query, metric_names_list, tags, deadline)
+
+def _post_delete_query(conn, query, metric_names_list, tags, deadline=None):
     query["metrics"] = [{"name" : m } for m in metric_names_list]
     if tags:
         query = reader.add_tags_to_query(query, tags)
     delete_url = conn.delete_dps_url
-    return requests.post(delete_url, json.dumps(query))
+    with instrumentation.operation(conn, "delete_datapoints") as op:
+        with op.phase("encode"):
+            body = json.dumps(query)
+        with op.phase("network"):
+            r = transport.request(conn, "POST", delete_url, body, deadline)
+        op.request_bytes = len(body)
+        op.response_bytes = len(r.content)
+        return r
+
+def delete_datapoints_chunked(conn, metric_names_list, start_time, end_time=None, tags=None,
+                              window=3600, workers=1, max_rate=None, progress_callback=None,
+                              checkpoint_file=None, deadline=None):
+    """Deletes data points one window of time at a time.
+
+    :type conn: pyKairosDB.connect object
+    :param conn: the interface to the requests library
+
+    :type metric_names_list: list of str
+    :param metric_names_list: A list of metric names which datapoints will be deleted.
+
+    :type start_time: float
+    :param start_time: the absolute start time (unix time since the epoch) of the data to delete
+
+    :type end_time: float
+    :param end_time: the absolute end time (unix time since the epoch) of the data to delete.  Defaults to now.
+
+    :type tags: dict
+    :param tags: Tags to be searched in metrics, per delete_datapoints()
+
+    :type window: float
+    :param window: the number of seconds of data deleted by each request
+
+    :type workers: int
+    :param workers: how many windows may be deleted at once
+
+    :type max_rate: float
+    :param max_rate: if given, the most windows that will be started per second
+
+    :type progress_callback: callable
+    :param progress_callback: called after each window with (done_through, windows_done, windows_total).
+        done_through is the time up to which every window has been deleted.
+
+    :type checkpoint_file: str
+    :param checkpoint_file: if given, done_through is saved to this file after each window, along
+        with the metrics, tags, start_time and end_time, and a later call with the same file and the
+        same arguments starts from where the earlier one got to.  A checkpoint saved by a call with
+        other arguments is ignored, with a warning, and the whole range is deleted.
+
+    :type deadline: transport.Deadline
+    :param deadline: a deadline shared by every window.  None gives each window the connection's defaults.
+
+    :rtype: int
+    :return: the number of windows that were deleted by this call
+
+    :raises: requests.HTTPError if KairosDB doesn't accept the deletion of a window, or
+        requests.Timeout if the deadline runs out.  Windows
+        that haven't been started are not deleted, and the checkpoint is left at the first
+        window that isn't known to be done.
+
+    A single delete over a long range creates a burst of tombstones in
+    Cassandra that slows down reads across the cluster.  Deleting the
+    range in small windows, with the concurrency and rate limited,
+    spreads that load out so that retention can be enforced while the
+    cluster is busy.
+    """
+    requested_end = end_time
+    if end_time is None:
+        end_time = time.time()
+    start_ms = int(start_time * 1000)
+    end_ms = int(end_time * 1000)
+    window_ms = int(window * 1000)
+    # what the checkpoint is for, as it reads back from json, so that it's only resumed by the same deletion
+    deletion = json.loads(json.dumps({"metrics" : list(metric_names_list), "tags" : tags or {},
+                                      "start" : start_time, "end" : requested_end}))
+    if checkpoint_file is not None and os.path.exists(checkpoint_file):
+        with open(checkpoint_file) as f:
+            checkpoint = json.load(f)
+        if dict((k, checkpoint.get(k)) for k in deletion) == deletion:
+            start_ms = max(start_ms, int(checkpoint["done_through"] * 1000))
+        else:
+            LOG.warning("Ignoring the checkpoint in %s, it's for a different deletion", checkpoint_file)
+
+    windows = [ (s, min(s + window_ms, end_ms + 1) - 1) for s in xrange(start_ms, end_ms + 1, window_ms) ]
+    limiter = None
+    if max_rate is not None:
+        limiter = util.RateLimiter(max_rate)
+
+    def delete_window(w):
+        if limiter is not None:
+            limiter.acquire()
+        query = {"start_absolute" : w[0], "end_absolute" : w[1]}
+        r = _post_delete_query(conn, query, metric_names_list, tags, deadline)
+        if r.status_code != 204:
+            LOG.error('deletion of datapoints from %s to %s failed. Status code: %s', w[0], w[1], r.status_code)
+            raise requests.HTTPError('deletion of datapoints from {0} to {1} failed. Status code: {2}'.format(
+                w[0], w[1], r.status_code), response=r)
+        return w
+
+    def done(w, windows_done):
+        done_through = (w[1] + 1) / 1000.0
+        if checkpoint_file is not None:
+            with open(checkpoint_file, "w") as f:
+                json.dump(dict(deletion, done_through=done_through), f)
+        if progress_callback is not None:
+            progress_callback(done_through, windows_done, len(windows))
+
+    if workers <= 1:
+        for n, w in enumerate(windows):
+            done(delete_window(w), n + 1)
+        return len(windows)
+    pool = ThreadPool(workers)
+    try:
+        # imap returns the windows in order, so a window is only reported once
+        # every window before it is done, too.
+        for n, w in enumerate(pool.imap(delete_window, windows)):
+            done(w, n + 1)
+    finally:
+        pool.terminate()
+        pool.join()
+    return len(windows)
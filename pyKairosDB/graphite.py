@@ -5,9 +5,11 @@ from . import util
 from util import tree
 from . import metadata
 from . import reader
+from . import transport
 from collections import deque
 import fnmatch
 import re
+import ConfigParser
 
 
 RETENTION_TAG = "gr-ret" # terse in order to save space on-disk
@@ -21,6 +23,239 @@ SECONDS_PER_YEAR   = SECONDS_PER_DAY    * 365
 INVALID_CHARS      = re.compile(r'[^A-Za-z0-9-_/.]')
 RET_SEPERATOR_CHAR = "_" # Character we use to separate the retentions
 RET_GRAPHITE_CHAR  = ":" # Character graphite uses to separate the retentions
+TAG_SEPERATOR_CHAR = "_" # Character that replaces the characters KairosDB won't accept in a name
+ROLLUP_PREFIX      = "_rollup" # Downsampled series are named _rollup.<seconds>s.<metric>, see pyKairosDB.rollup
+
+
+class StorageSchema(object):
+    """
+    :type name: str
+    :param name: the name of the section in storage-schemas.conf
+
+    :type pattern: str
+    :param pattern: the regular expression that metric names are matched against
+
+    :type retentions: str
+    :param retentions: the retentions, as written in storage-schemas.conf, e.g. "60s:1d,5m:4w"
+
+    A stand-in for carbon.storage.Schema with what this module needs
+    from it: a test() method and the retentions in options, so that
+    carbon doesn't have to be installed to tag metrics.
+    """
+    def __init__(self, name, pattern, retentions):
+        self.name = name
+        self.pattern = pattern
+        self.regex = re.compile(pattern)
+        self.options = {"pattern" : pattern, "retentions" : retentions}
+
+    def test(self, metric_name):
+        return self.regex.search(metric_name) is not None
+
+def load_storage_schemas(path):
+    """
+    :type path: str
+    :param path: the path to a carbon storage-schemas.conf
+
+    :rtype: list
+    :return: a list of StorageSchema objects in the order they appear in the file
+
+    Sections without a pattern or without retentions are skipped, the
+    same as carbon does.
+    """
+    parser = ConfigParser.RawConfigParser()
+    parser.read(path)
+    schemas = list()
+    for section in parser.sections():
+        if not (parser.has_option(section, "pattern") and parser.has_option(section, "retentions")):
+            continue
+        schemas.append(StorageSchema(section, parser.get(section, "pattern"),
+                                     parser.get(section, "retentions").replace(" ", "")))
+    return schemas
+
+class SchemaMatcher(object):
+    """
+    :type storage_schemas: list
+    :param storage_schemas: list of carbon.storage.Schema objects, in the order they're tested
+
+    :type cache_size: int
+    :param cache_size: how many metric names to remember the retention of
+
+    Finds the retention for metric names the way carbon does - the
+    first schema whose test() passes - but only once per name.
+
+    When every schema has a pattern, the patterns are compiled into a
+    few regular expressions whose alternatives are tried in the
+    schemas' order, so a name that isn't cached yet is matched with one
+    search per hundred or so schemas instead of one per schema.
+    Otherwise each schema's test() is called in turn.
+
+    The result for each name is kept in a util.LRUCache, so looking up
+    a name that has been seen costs one dict lookup.  The cache is
+    dropped whenever set_schemas() is given different schemas.
+
+    The schemas, what's derived from them and the cache are replaced
+    together, so a lookup in another thread while set_schemas() runs
+    sees either the old schemas or the new ones, never a mix.
+    """
+
+    def __init__(self, storage_schemas, cache_size=100000):
+        self.cache_size = cache_size
+        self._state = None
+        self.set_schemas(storage_schemas)
+
+    @property
+    def storage_schemas(self):
+        return self._state.storage_schemas
+
+    @staticmethod
+    def signature(storage_schemas):
+        """
+        :rtype: tuple
+        :return: a value that's equal for two lists of schemas that would tag every metric the same way
+        """
+        return tuple((getattr(s, 'name', None), getattr(s, 'pattern', id(s)), s.options['retentions'])
+                     for s in storage_schemas)
+
+    def set_schemas(self, storage_schemas):
+        """
+        :type storage_schemas: list
+        :param storage_schemas: list of carbon.storage.Schema objects
+
+        Replace the schemas.  Cached retentions are forgotten if the new
+        schemas differ from the old ones.
+        """
+        signature = self.signature(storage_schemas)
+        if self._state is not None and signature == self._state.signature:
+            return
+        storage_schemas = list(storage_schemas)
+        self._state = _MatcherState(signature, storage_schemas,
+                                    [ self._retention_for_schema(s) for s in storage_schemas ],
+                                    self._combine_patterns(storage_schemas), util.LRUCache(self.cache_size))
+
+    @staticmethod
+    def _retention_for_schema(schema):
+        seconds, retention = _input_retention_resolution(schema.options['retentions'].split(','))
+        return (retention.replace(RET_GRAPHITE_CHAR, RET_SEPERATOR_CHAR), seconds)
+
+    @staticmethod
+    def _combine_patterns(storage_schemas):
+        """
+        Each pattern becomes a lookahead that can match anywhere in the
+        name (re.search() semantics) followed by an empty named group.
+        Alternatives are tried from left to right, so the name of the
+        group that matched is the index of the first matching schema.
+        Python's re allows fewer than 100 groups in an expression, so
+        the patterns are combined into as many expressions as their
+        groups need, which are tried in order.
+
+        Patterns with back-references or inline flags would mean
+        something else inside the combined expression (a group number
+        refers to another pattern's group, a flag applies to every
+        pattern), so if any pattern has them the schemas are tested one
+        at a time instead.
+        """
+        patterns = [ getattr(s, 'pattern', None) for s in storage_schemas ]
+        if not patterns or None in patterns:
+            return None
+        if any(_NOT_COMBINABLE.search(p) for p in patterns):
+            return None
+        try:
+            chunks = [[]]
+            groups = 0
+            for n, p in enumerate(patterns):
+                needed = re.compile(p).groups + 1 # its own groups and the named group after it
+                if needed > _MAX_GROUPS:
+                    return None
+                if groups + needed > _MAX_GROUPS:
+                    chunks.append([])
+                    groups = 0
+                chunks[-1].append("(?=.*?(?:{0}))(?P<_schema{1}>)".format(p, n))
+                groups += needed
+            return [ re.compile("^(?:{0})".format("|".join(chunk))) for chunk in chunks ]
+        except re.error: # e.g. duplicate group names across patterns
+            return None
+
+    @staticmethod
+    def _index(state, metric_name):
+        """The index of the first of the state's schemas that matches the name, or None"""
+        if state.combined is not None:
+            for combined in state.combined:
+                m = combined.match(metric_name)
+                if m is not None:
+                    return int(m.lastgroup[len("_schema"):])
+            return None
+        for n, s in enumerate(state.storage_schemas):
+            if s.test(metric_name):
+                return n
+        return None
+
+    def schema(self, metric_name):
+        """
+        :type metric_name: str
+        :param metric_name: the graphite metric name
+
+        :rtype: object
+        :return: the first schema that matches the name, or None.  Unlike retention(), this isn't cached.
+        """
+        state = self._state
+        n = self._index(state, metric_name)
+        if n is None:
+            return None
+        return state.storage_schemas[n]
+
+    def retention(self, metric_name):
+        """
+        :type metric_name: str
+        :param metric_name: the graphite metric name
+
+        :rtype: tuple
+        :return: (retention_tag, seconds) for the highest resolution retention of the first matching
+            schema, e.g. ("60s_1d", 60), or None when no schema matches.
+        """
+        state = self._state
+        r = state.cache.get(metric_name, _NO_RETENTION)
+        if r is _NO_RETENTION:
+            n = self._index(state, metric_name)
+            r = state.retentions[n] if n is not None else None
+            state.cache.put(metric_name, r)
+        return r
+
+class _MatcherState(object):
+    """Everything a SchemaMatcher derives from one list of schemas, replaced as a whole"""
+
+    __slots__ = ("signature", "storage_schemas", "retentions", "combined", "cache")
+
+    def __init__(self, signature, storage_schemas, retentions, combined, cache):
+        self.signature = signature
+        self.storage_schemas = storage_schemas
+        self.retentions = retentions
+        self.combined = combined
+        self.cache = cache
+
+_NO_RETENTION = object()
+
+# numbered back-references, named back-references, conditional groups and inline flags
+_MAX_GROUPS = 99 # sre_compile refuses an expression with 100 groups or more
+
+_NOT_COMBINABLE = re.compile(r"\\[1-9]|\(\?P=|\(\?\(|\(\?[iLmsux]+\)")
+
+def _schema_matcher(storage_schemas):
+    """
+    :rtype: SchemaMatcher
+    :return: the shared matcher, updated to use storage_schemas
+
+    Callers that pass the same schemas with every batch share one
+    matcher, and so share its cache.
+    """
+    matcher = _schema_matcher.matcher
+    if matcher is None:
+        matcher = SchemaMatcher(storage_schemas)
+        _schema_matcher.matcher = matcher
+    else:
+        matcher.set_schemas(storage_schemas)
+    return matcher
+
+_schema_matcher.matcher = None
 
 def _graphite_metric_list_retentions(metric_list, storage_schemas):
     """:type metric_list: list
@@ -30,12 +265,15 @@ def _graphite_metric_list_retentions(metric_list, storage_schemas):
     :param storage_schemas: list of carbon.stroage.Schema objects which will be matched against
                             each of the graphite metrics and used to tag each metric.
 
+    :rtype: list
+    :return: the retention tag for each metric, or None for metrics that no schema matches
+
     """
-    def get_retentions(metric_name):
-        for s in storage_schemas:
-            if s.test(metric_name):
-                return _input_retention_resolution(s.options['retentions'].split(','))
-    retentions = [ get_retentions(m[0])[1].replace(RET_GRAPHITE_CHAR, RET_SEPERATOR_CHAR) for m in metric_list ]
+    retention = _schema_matcher(storage_schemas).retention
+    retentions = list()
+    for m in metric_list:
+        r = retention(m[0])
+        retentions.append(r[0] if r is not None else None)
     return retentions
 
 # how graphite will access kairosdb
@@ -73,15 +311,76 @@ def graphite_metric_list_with_retentions_to_kairosdb_list(metric_list, storage_s
     Use this for entering a large set of metrics that have the disparate retentions.  The expected
     way to call this from a sender is to first call _graphite_metric_list_retentions()
 
+    Every metric with the same retention gets the same tags dict, per
+    shared_tags(), so the dicts must not be changed.
+
     XXX this API is getting messy - it should be simpler. -PN
     """
-    retentions_list = _graphite_metric_list_retentions(metric_list, storage_schemas)
-    for m,r in zip(metric_list, retentions_list):
-        tags = {}
-        if len(pervasive_tags) > 0:
-            tags.update(pervasive_tags)
-        tags[RETENTION_TAG] = r
-        yield graphite_metric_to_kairosdb(m, tags=tags)
+    retention = _schema_matcher(storage_schemas).retention
+    sanitize = sanitize_metric_name
+    pervasive_key = tuple(sorted(pervasive_tags.iteritems()))
+    tags_for = dict() # retention tag to its shared tags, for this batch
+    for m in metric_list:
+        r = retention(m[0])
+        if r is not None:
+            r = r[0]
+        tags = tags_for.get(r)
+        if tags is None:
+            tags = tags_for[r] = shared_tags(pervasive_tags, r, pervasive_key)
+        yield {"name" : sanitize(m[0]), "timestamp" : m[1], "value" : m[2], "tags" : tags}
+
+def shared_tags(pervasive_tags, retention_tag, pervasive_key=None):
+    """
+    :type pervasive_tags: dict
+    :param pervasive_tags: per graphite_metric_list_with_retentions_to_kairosdb_list()
+
+    :type retention_tag: str
+    :param retention_tag: the RETENTION_TAG value, or None for metrics that no schema matched
+
+    :type pervasive_key: tuple
+    :param pervasive_key: the sorted items of pervasive_tags, if the caller has them already
+
+    :rtype: dict
+    :return: the tags for a metric with this retention.  The same dict is returned for the same
+        arguments, so it must not be changed.
+
+    A batch of graphite metrics has only a few distinct tag sets, so
+    rather than building a dict for every metric, one dict per set is
+    kept in a util.LRUCache and shared by every metric that has it.
+    """
+    if pervasive_key is None:
+        pervasive_key = tuple(sorted(pervasive_tags.iteritems()))
+    key = (pervasive_key, retention_tag)
+    tags = _SHARED_TAGS.get(key)
+    if tags is None:
+        tags = dict(pervasive_tags)
+        if retention_tag is not None:
+            tags[RETENTION_TAG] = intern(retention_tag) if type(retention_tag) is str else retention_tag
+        _SHARED_TAGS.put(key, tags)
+    return tags
+
+_SHARED_TAGS = util.LRUCache(1000)
+
+def sanitize_metric_name(name):
+    """
+    :type name: str
+    :param name: a graphite metric name
+
+    :rtype: str
+    :return: the name with every character that KairosDB won't accept replaced by TAG_SEPERATOR_CHAR
+
+    Names repeat in almost every batch, so the results are kept in a
+    util.LRUCache, and a cached name is only a dict lookup.
+    """
+    sanitized = _SANITIZED_NAMES.get(name)
+    if sanitized is None:
+        sanitized = INVALID_CHARS.sub(TAG_SEPERATOR_CHAR, name)
+        if type(sanitized) is str:
+            sanitized = intern(sanitized)
+        _SANITIZED_NAMES.put(name, sanitized)
+    return sanitized
+
+_SANITIZED_NAMES = util.LRUCache(100000)
 
 
 def _fnmatch_expand_graphite_wildcard_metric_name(conn, name, cache_ttl=60):
@@ -113,13 +412,50 @@ def _fnmatch_expand_graphite_wildcard_metric_name(conn, name, cache_ttl=60):
     all_metric_name_list = metadata.get_all_metric_names(conn)
     return [ n for n in all_metric_name_list if fnmatch.fnmatch(n, name) ]
 
+def is_rollup_name(name):
+    """
+    :rtype: bool
+    :return: whether name is one of the downsampled series that pyKairosDB.rollup writes, which
+        graphite shouldn't list as metrics of their own
+    """
+    return name.startswith(ROLLUP_PREFIX + ".")
+
+def _graphite_name_cache(conn, cache_ttl=60):
+    """
+    :type conn: pyKairosDB.KairosDBConnection
+    :param conn: the connection to the database
+
+    :type cache_ttl: int
+    :param cache_ttl: how often to update the cache from KairosDB, in seconds
+
+    :rtype: tuple
+    :return: (cache_tree, names) - the tree of all metric names, split on ".", and
+        a frozenset of the names themselves, which tells leaves from branches.
+
+    These are kept on expand_graphite_wildcard_metric_name and are
+    rebuilt from the server's list of metric names when they have aged
+    beyond cache_ttl.
+    """
+    ts          = expand_graphite_wildcard_metric_name.cache_timestamp
+    cache_tree  = expand_graphite_wildcard_metric_name.cache_tree
+    cache_names = expand_graphite_wildcard_metric_name.cache_names
+    if ts == 0 or (time.time() - ts > cache_ttl):
+        all_metric_name_list = [ n for n in metadata.get_all_metric_names(conn) if not is_rollup_name(n) ]
+        cache_tree           = tree()
+        cache_names          = frozenset(all_metric_name_list)
+        _make_graphite_name_cache(cache_tree, all_metric_name_list)
+        expand_graphite_wildcard_metric_name.cache_tree      = cache_tree
+        expand_graphite_wildcard_metric_name.cache_names     = cache_names
+        expand_graphite_wildcard_metric_name.cache_timestamp = time.time()
+    return (cache_tree, cache_names)
+
 def expand_graphite_wildcard_metric_name(conn, name, cache_ttl=60):
     """
     :type conn: pyKairosDB.KairosDBConnection
     :param conn: the connection to the database
 
     :type name: string
-    :param name: the graphite-like name which can include ".*." to provide wildcard expansion
+    :param name: the graphite-like name which can include glob patterns in any segment
 
     :type cache_ttl: int
     :param cache_ttl: how often to update the cache from KairosDB, in seconds
@@ -130,47 +466,63 @@ def expand_graphite_wildcard_metric_name(conn, name, cache_ttl=60):
     KairosDB doesn't currently support wildcards, so get all metric
     names and expand them.
 
-    Currently only ".*." or "\*." or ".\*" expansions are supported.
-    Substring expansions aren't supported at this time.
-
-    Graphite-web uses fnmatch or something similar, perhaps this
-    should provide a list and re-use the same functionality.
+    The same glob syntax as graphite-web is supported in every
+    segment: "*", "?", character classes such as "[1-9]", and brace
+    alternation such as "{web,api}", so "{web,api}-0[1-9].cpu.*" works
+    the way it does against whisper files.  See
+    util.metric_name_wildcard_expansion() for how the tree is walked.
 
     This function caches the created tree for cache_ttl seconds and
     refreshes when the cache has aged beyond the cache_ttl.
     """
 
-    if "*" not in name:
+    if not util.is_glob_pattern(name):
         return [u'{0}'.format(name)]
 
-    if "." in name:
-        name_list = [ u'{0}'.format(n) for n in name.split(".")]
-    else:
-        name_list = [ name ]
-    # print "Name_list is {0}".format(name_list)
-
-    ts        = expand_graphite_wildcard_metric_name.cache_timestamp
-    cache_tree = expand_graphite_wildcard_metric_name.cache_tree
-    if ts == 0 or (time.time() - ts > cache_ttl):
-        all_metric_name_list = metadata.get_all_metric_names(conn)
-        cache_tree           = tree()
-        _make_graphite_name_cache(cache_tree, all_metric_name_list)
-        expand_graphite_wildcard_metric_name.cache_tree      = cache_tree
-        expand_graphite_wildcard_metric_name.cache_timestamp = time.time()
-    if name == "*": # special case for the root of the tree:
-        return cache_tree.keys()
-    if '*' in name and not '.' in name:
-        return [ ctk for ctk in cache_tree.keys() if fnmatch.fnmatch(ctk, name)]
+    name_list = [ u'{0}'.format(n) for n in name.split(".")]
+    cache_tree, cache_names = _graphite_name_cache(conn, cache_ttl)
     expanded_name_list = util.metric_name_wildcard_expansion(cache_tree, name_list)
-    # print "expanded_name_list is {0}".format(expanded_name_list)
-
-    return_list = [ ".".join(en) for en in expanded_name_list]
-    return list(set(return_list))
+    return [ ".".join(en) for en in expanded_name_list]
 
 expand_graphite_wildcard_metric_name.cache_tree = tree()
+expand_graphite_wildcard_metric_name.cache_names = frozenset()
 expand_graphite_wildcard_metric_name.cache_timestamp = 0
 
 
+def find_nodes(conn, pattern, cache_ttl=60):
+    """
+    :type conn: pyKairosDB.KairosDBConnection
+    :param conn: the connection to the database
+
+    :type pattern: string
+    :param pattern: a graphite-style name, optionally with glob patterns in any segment
+
+    :type cache_ttl: int
+    :param cache_ttl: how often to update the cache from KairosDB, in seconds
+
+    :rtype: list
+    :return: a sorted list of (name, "leaf") and (name, "branch") tuples.  A name that is both
+        a metric and the prefix of other metrics, e.g. "a.b" when "a.b.c" also exists, is
+        listed twice, once as each.
+
+    This is what a graphite-web finder needs to answer a find: every
+    node that matches and whether it's a leaf or a branch, from a
+    single walk of the name index.  Calling leaf_or_branch() for each
+    node of an expansion instead costs one expansion per node.
+    """
+    name_list = [ u'{0}'.format(n) for n in pattern.split(".")]
+    cache_tree, cache_names = _graphite_name_cache(conn, cache_ttl)
+    nodes = list()
+    for path, node in util.metric_name_wildcard_nodes(cache_tree, name_list):
+        name = ".".join(path)
+        if len(node) > 0:
+            nodes.append((name, "branch"))
+        if name in cache_names or len(node) == 0:
+            nodes.append((name, "leaf"))
+    nodes.sort()
+    return nodes
+
+
 def leaf_or_branch(conn, name):
     """
     :type conn: pyKairosDB.KairosDBConnection
@@ -187,10 +539,12 @@ def leaf_or_branch(conn, name):
     traversed further
     """
     # print "Trying to expand the name {0}".format(name)
-    if name.endswith('*'):
-        wildcard_expansion = expand_graphite_wildcard_metric_name(conn, name)
-    else:
-        wildcard_expansion = expand_graphite_wildcard_metric_name(conn, name + ".*")
+    if not util.is_glob_pattern(name):
+        nodes = find_nodes(conn, name)
+        if (name, "branch") in nodes:
+            return "branch"
+        return "leaf"
+    wildcard_expansion = expand_graphite_wildcard_metric_name(conn, name)
 
     if len(wildcard_expansion) == 1 and wildcard_expansion[0] == name:
         return "leaf"
@@ -253,7 +607,7 @@ def graphite_metric_to_kairosdb(metric, tags):
     above are converted to an underscore.
 
     """
-    converted_metric_name = INVALID_CHARS.sub(TAG_SEPERATOR_CHAR, metric[0])
+    converted_metric_name = sanitize_metric_name(metric[0])
     return {
         "name"      : converted_metric_name,
         "timestamp" : metric[1],
@@ -339,7 +693,7 @@ def _lowest_resolution_retention(data, name):
         all_tags_set.update(util.get_matching_tags_from_result(result, RETENTION_TAG))
     return max([ seconds_from_retention_tag(tag, RET_SEPERATOR_CHAR) for tag in all_tags_set])# return the lowest resolution
 
-def read_absolute(conn, metric_name, start_time, end_time):
+def read_absolute(conn, metric_name, start_time, end_time, deadline=None):
     """
     :type conn: pyKairosDB.KairosDBConnection
     :param conn: The connection to KairosDB
@@ -353,6 +707,10 @@ def read_absolute(conn, metric_name, start_time, end_time):
     :type end_time: float
     :param end_time: The float representing the number of seconds since the epoch that this query endsa at.
 
+    :type deadline: transport.Deadline
+    :param deadline: the deadline for the whole read.  Both requests made to KairosDB share it, so a slow
+        tags query leaves less time for the data query.  None for a deadline with the connection's defaults.
+
     :rtype: tuple
     :return: 2-element tuple - ((start_time, end_time, interval), list_of_metric_values).  Graphite wants evenly-spaced metrics,
         and None for any interval that doesn't have data.  It infers the time for each update by the order and place of each
@@ -364,9 +722,11 @@ def read_absolute(conn, metric_name, start_time, end_time):
         def cache_query_closure(query_dict):
             reader.cache_time(10, query_dict)
         return cache_query_closure
+    if deadline is None:
+        deadline = transport.new_deadline(conn)
     tags = conn.read_absolute([metric_name], start_time, end_time,
                               query_modifying_function=cache_query(),
-                              only_read_tags=True)
+                              only_read_tags=True, deadline=deadline)
 
     interval_seconds = _lowest_resolution_retention(tags, metric_name)
     def modify_query():
@@ -380,7 +740,7 @@ def read_absolute(conn, metric_name, start_time, end_time):
         return modify_query_closure
     # now that we've gotten the tags and have set the retention time, get data
     content = conn.read_absolute([metric_name], start_time, end_time,
-        query_modifying_function=modify_query())
+        query_modifying_function=modify_query(), deadline=deadline)
     return_list = list()
     if len(content['queries'][0]['results']) > 0:
         # by_interval_dict = dict([(v[1], v[0]) for v in content["queries"][0]["results"][0]["values"] ])
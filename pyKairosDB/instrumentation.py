@@ -0,0 +1,398 @@
+# -*- python -*-
+
+"""
+Measurements of what each connection spends its time on.
+
+Every read, write, delete and metadata request made through a
+connection is recorded in its Instrumentation (conn.instrumentation):
+how long it took, a histogram of those latencies, the bytes sent and
+received, the number of datapoints, and the time spent in each phase
+of the operation.  The phases of a read, for example, are::
+
+    build       building the query
+    encode      json.dumps() of the query
+    network     sending it and receiving the whole answer
+    decode      json.loads() of the answer
+    timestamps  converting the timestamps to seconds
+
+snapshot() returns the totals so far, and callbacks added with
+add_callback() are given each operation as it finishes::
+
+    conn.instrumentation.add_callback(lambda event: log.debug("%(operation)s took %(seconds)f", event))
+    conn.instrumentation.snapshot()["read"]["latency"]["p99"]
+
+A Reporter writes the measurements of each interval back into KairosDB
+as metrics, all in one batch.
+"""
+
+import bisect
+import logging
+import socket
+import threading
+import time
+from collections import defaultdict
+
+import requests
+
+LOG = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the latency buckets: 0.5ms doubling up to about a minute.
+# Anything slower falls in a last bucket with no upper bound.
+LATENCY_BUCKETS = tuple(0.0005 * 2 ** n for n in range(18))
+PERCENTILES = (50, 90, 99)
+
+
+class Histogram(object):
+    """
+    Counts of latencies in fixed buckets, so that recording one is cheap
+    and the counts of two snapshots can be subtracted to get the
+    histogram of the time between them.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p, counts=None):
+        """
+        :type p: float
+        :param p: the percentile, 0-100
+
+        :type counts: list
+        :param counts: bucket counts to use instead of this histogram's, e.g. a difference of two snapshots
+
+        :rtype: float
+        :return: the upper bound of the bucket the percentile falls in, or the largest latency
+            seen if that's smaller.  None if nothing has been recorded.
+        """
+        if counts is None:
+            counts = self.counts
+        total = sum(counts)
+        if total == 0:
+            return None
+        rank = total * p / 100.0
+        seen = 0
+        for n, count in enumerate(counts):
+            seen += count
+            if seen >= rank and count:
+                if n < len(self.bounds):
+                    return min(self.bounds[n], self.max)
+                return self.max
+        return self.max
+
+
+class _Stats(object):
+    """The totals of one operation"""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.points = 0
+        self.latency = Histogram()
+        self.phases = defaultdict(float)
+
+    def snapshot(self):
+        latency = dict(("p{0}".format(p), self.latency.percentile(p)) for p in PERCENTILES)
+        latency["max"] = self.latency.max
+        latency["buckets"] = list(self.latency.counts)
+        return {"count" : self.count, "errors" : self.errors, "seconds" : self.seconds,
+                "request_bytes" : self.request_bytes, "response_bytes" : self.response_bytes,
+                "points" : self.points, "latency" : latency, "phases" : dict(self.phases)}
+
+
+class Operation(object):
+    """
+    The measurements of one operation while it's being done.  It's used
+    as a context manager, and recorded when the block is left, as an
+    error if the block raised.
+    """
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.points = 0
+        self.phases = dict()
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.instrumentation.record(self, time.time() - self.start, exc_value)
+        return False
+
+    def phase(self, name):
+        """
+        :type name: str
+        :param name: the phase that the block is timed as
+        """
+        return _Phase(self, name)
+
+    def add_phase(self, name, seconds):
+        """
+        :type name: str
+        :param name: the phase
+
+        :type seconds: float
+        :param seconds: time spent in the phase outside of the block, e.g. in another thread
+        """
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+
+class _Phase(object):
+    __slots__ = ("operation", "name", "start")
+
+    def __init__(self, operation, name):
+        self.operation = operation
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        phases = self.operation.phases
+        phases[self.name] = phases.get(self.name, 0.0) + time.time() - self.start
+        return False
+
+
+class _NullOperation(object):
+    """Stands in for an Operation when a connection isn't instrumented"""
+
+    request_bytes = response_bytes = points = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def phase(self, name):
+        return self
+
+    def add_phase(self, name, seconds):
+        pass
+
+    def __setattr__(self, name, value):
+        pass # measurements are thrown away
+
+_NULL_OPERATION = _NullOperation()
+
+
+class Instrumentation(object):
+    """
+    The measurements of every operation made through one connection (or
+    one cluster), keyed by operation name: read, read_tags, write,
+    delete_datapoints, delete_metric, version, metric_names, tag_names
+    and tag_values.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = defaultdict(_Stats)
+        self._callbacks = list()
+
+    def operation(self, name):
+        """
+        :type name: str
+        :param name: the name that the operation is recorded under
+
+        :rtype: Operation
+        :return: a context manager that measures the operation
+        """
+        return Operation(self, name)
+
+    def record(self, operation, seconds, error=None):
+        """
+        :type operation: Operation
+        :param operation: a finished operation
+
+        :type seconds: float
+        :param seconds: how long it took altogether
+
+        :type error: Exception
+        :param error: what it raised, if it failed
+        """
+        with self._lock:
+            stats = self._stats[operation.name]
+            stats.count += 1
+            if error is not None:
+                stats.errors += 1
+            stats.seconds += seconds
+            stats.request_bytes += operation.request_bytes
+            stats.response_bytes += operation.response_bytes
+            stats.points += operation.points
+            stats.latency.add(seconds)
+            for phase, phase_seconds in operation.phases.items():
+                stats.phases[phase] += phase_seconds
+            callbacks = list(self._callbacks)
+        if callbacks:
+            event = {"operation" : operation.name, "seconds" : seconds, "error" : error,
+                     "request_bytes" : operation.request_bytes, "response_bytes" : operation.response_bytes,
+                     "points" : operation.points, "phases" : operation.phases}
+            for callback in callbacks:
+                try:
+                    callback(event)
+                except Exception:
+                    LOG.exception("An instrumentation callback failed")
+
+    def add_callback(self, callback):
+        """
+        :type callback: callable
+        :param callback: called with a dict describing each operation as it finishes: operation,
+            seconds, error, request_bytes, response_bytes, points and phases (phase to seconds).
+            It's called on the thread that made the request, so it should be quick.
+        """
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        with self._lock:
+            self._callbacks.remove(callback)
+
+    def snapshot(self):
+        """
+        :rtype: dict
+        :return: operation name to a dict of its totals since the connection was made: count,
+            errors, seconds, request_bytes, response_bytes, points, phases (phase to seconds)
+            and latency (p50, p90, p99, max and the bucket counts of LATENCY_BUCKETS).
+        """
+        with self._lock:
+            return dict((name, stats.snapshot()) for name, stats in self._stats.items())
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+def operation(conn, name):
+    """
+    :type conn: KairosDBConnection
+    :param conn: the connection the operation is made through
+
+    :type name: str
+    :param name: the name that the operation is recorded under
+
+    :return: a context manager that measures the operation, or does nothing if the
+        connection isn't instrumented
+    """
+    instrumentation = getattr(conn, "instrumentation", None)
+    if instrumentation is None:
+        return _NULL_OPERATION
+    return instrumentation.operation(name)
+
+
+class Reporter(object):
+    """
+    :type instrumentation: Instrumentation
+    :param instrumentation: the measurements to report
+
+    :type conn: KairosDBConnection
+    :param conn: the connection to write them to.  Its own writes are measured too, one per interval.
+
+    :type interval: float
+    :param interval: seconds between reports
+
+    :type prefix: str
+    :param prefix: the start of the name of every metric that's written
+
+    :type tags: dict
+    :param tags: tags written with every metric.  Defaults to the host name.
+
+    Every interval, what changed since the last report is written as one
+    batch.  For each operation that was used, the metrics are
+    <prefix>.<operation>.count, .errors, .request_bytes, .response_bytes,
+    .points, .latency.p50/.p90/.p99 (over the interval, in seconds)
+    and .phase.<phase> (seconds spent in the phase).  Nothing is written
+    for an interval with no operations.
+    """
+
+    def __init__(self, instrumentation, conn, interval=60, prefix="pykairosdb.client", tags=None):
+        self.instrumentation = instrumentation
+        self.conn = conn
+        self.interval = interval
+        self.prefix = prefix
+        if tags is None:
+            tags = {"host" : socket.gethostname()}
+        self.tags = tags
+        self._last = dict()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def metrics(self, now=None):
+        """
+        :rtype: list
+        :return: the metrics describing what changed since the last call, per writer.write_metrics_list()
+        """
+        if now is None:
+            now = time.time()
+        current = self.instrumentation.snapshot()
+        metrics = list()
+
+        def add(name, value):
+            metrics.append({"name" : "{0}.{1}".format(self.prefix, name), "timestamp" : now,
+                            "value" : value, "tags" : self.tags})
+
+        for op, stats in sorted(current.items()):
+            last = self._last.get(op)
+            if last is None:
+                last = _Stats().snapshot()
+            count = stats["count"] - last["count"]
+            if count == 0:
+                continue
+            for field in ("count", "errors", "request_bytes", "response_bytes", "points"):
+                add("{0}.{1}".format(op, field), stats[field] - last[field])
+            buckets = [ a - b for a, b in zip(stats["latency"]["buckets"], last["latency"]["buckets"]) ]
+            histogram = Histogram()
+            histogram.max = stats["latency"]["max"]
+            for p in PERCENTILES:
+                add("{0}.latency.p{1}".format(op, p), histogram.percentile(p, buckets))
+            for phase, seconds in sorted(stats["phases"].items()):
+                add("{0}.phase.{1}".format(op, phase), seconds - last["phases"].get(phase, 0.0))
+        self._last = current
+        return metrics
+
+    def report(self):
+        """
+        Write what changed since the last report.  Failures are logged,
+        and what they would have reported is skipped rather than retried.
+        """
+        metrics = self.metrics()
+        if not metrics:
+            return
+        try:
+            r = self.conn.write_metrics(metrics)
+            if r.status_code != 204:
+                LOG.warning("Reporting client metrics failed. Status code: %s", r.status_code)
+        except requests.RequestException, e:
+            LOG.warning("Reporting client metrics failed: %s", e)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+
+    def stop(self):
+        """
+        Stop reporting, after one last report.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            self.report()
@@ -2,27 +2,168 @@
 
 """Functions for getting metadata from the server"""
 
-import requests
 import json
+import threading
+import time
 
-def get_server_version(conn):
+from . import instrumentation
+from . import transport
+
+# The server version doesn't change without a restart, so by default it's kept until
+# the process exits.  The lists of names change as metrics are written.
+DEFAULT_VERSION_TTL = None
+DEFAULT_NAMES_TTL   = 60
+
+_cache = dict()
+_cache_lock = threading.Lock()
+_fetch_locks = dict() # cache key to the lock held while that key is asked for, guarded by _cache_lock
+
+def get_server_version(conn, deadline=None):
     """
     :type conn: KairosDBConnection
     :param conn: a connection object
 
+    :type deadline: transport.Deadline
+    :param deadline: the deadline for the request, per pyKairosDB.transport.  None for the connection's defaults.
+
     :rtype: string
     :return: String containing the version of the KairosDB server.
     """
     version_path = "api/v1/version"
-    return json.loads(requests.get("{0.schema}://{0.server}:{0.port}/{1}".format(conn, version_path)).content)['version']
+    return _get(conn, "version", version_path, 'version', deadline)
 
-def get_all_metric_names(conn):
+def get_all_metric_names(conn, deadline=None):
     """
     :type conn: KairosDBConnection
     :param conn: a connection object
 
+    :type deadline: transport.Deadline
+    :param deadline: the deadline for the request, per pyKairosDB.transport.  None for the connection's defaults.
+
     :rtype: list
     :return: list containing the strings of all of the metric names that the server has recorded.
     """
     all_names_path = "api/v1/metricnames"
-    return json.loads(requests.get("{0.schema}://{0.server}:{0.port}/{1}".format(conn, all_names_path)).content)['results']
\ No newline at end of file
+    return _get(conn, "metric_names", all_names_path, 'results', deadline)
+
+def get_all_tag_names(conn, deadline=None):
+    """
+    :type conn: KairosDBConnection
+    :param conn: a connection object
+
+    :type deadline: transport.Deadline
+    :param deadline: the deadline for the request, per pyKairosDB.transport.  None for the connection's defaults.
+
+    :rtype: list
+    :return: list containing the strings of all of the tag names that the server has recorded.
+    """
+    all_tag_names_path = "api/v1/tagnames"
+    return _get(conn, "tag_names", all_tag_names_path, 'results', deadline)
+
+def get_all_tag_values(conn, deadline=None):
+    """
+    :type conn: KairosDBConnection
+    :param conn: a connection object
+
+    :type deadline: transport.Deadline
+    :param deadline: the deadline for the request, per pyKairosDB.transport.  None for the connection's defaults.
+
+    :rtype: list
+    :return: list containing the strings of all of the tag values that the server has recorded.
+    """
+    all_tag_values_path = "api/v1/tagvalues"
+    return _get(conn, "tag_values", all_tag_values_path, 'results', deadline)
+
+def _get(conn, operation, path, key, deadline):
+    """
+    :rtype: object
+    :return: the value of key in the JSON that the server answers path with
+    """
+    with instrumentation.operation(conn, operation) as op:
+        with op.phase("network"):
+            r = transport.request(conn, "GET", "{0.schema}://{0.server}:{0.port}/{1}".format(conn, path),
+                                  deadline=deadline)
+        op.response_bytes = len(r.content)
+        with op.phase("decode"):
+            return json.loads(r.content)[key]
+
+def _cached(conn, getter, ttl, deadline=None):
+    """
+    :type conn: KairosDBConnection
+    :param conn: a connection object
+
+    :type getter: function
+    :param getter: one of the get_ functions in this module
+
+    :type ttl: float
+    :param ttl: how many seconds a cached result is used for.  None keeps it forever.
+
+    :type deadline: transport.Deadline
+    :param deadline: the deadline for asking the server, if what's cached can't be used
+
+    The results are shared by every connection to the same server, port
+    and schema, so short-lived connections don't each ask again.  Only
+    one thread at a time asks for each, and threads that were waiting
+    for it use what it got.  A list is returned as a copy, so the
+    caller can change it without changing what's cached.
+    """
+    key = (conn.schema, conn.server, str(conn.port), getter.__name__)
+    asked = time.time()
+    with _cache_lock:
+        entry = _cache.get(key)
+        fetch_lock = _fetch_locks.setdefault(key, threading.Lock())
+    if entry is None or (ttl is not None and time.time() - entry[0] >= ttl):
+        with fetch_lock:
+            with _cache_lock:
+                entry = _cache.get(key)
+            # unless another thread got it while this one waited
+            if entry is None or (entry[0] < asked and (ttl is None or time.time() - entry[0] >= ttl)):
+                value = getter(conn, deadline)
+                entry = (time.time(), value)
+                with _cache_lock:
+                    _cache[key] = entry
+    if isinstance(entry[1], list):
+        return list(entry[1])
+    return entry[1]
+
+def clear_cache(conn=None):
+    """
+    :type conn: KairosDBConnection
+    :param conn: forget what's cached for the server of this connection, or for every server if None
+    """
+    with _cache_lock:
+        if conn is None:
+            _cache.clear()
+            return
+        endpoint = (conn.schema, conn.server, str(conn.port))
+        for key in _cache.keys():
+            if key[:3] == endpoint:
+                del _cache[key]
+
+def get_cached_server_version(conn, ttl=DEFAULT_VERSION_TTL, deadline=None):
+    """
+    :rtype: string
+    :return: per get_server_version(), asking the server at most once per ttl seconds
+    """
+    return _cached(conn, get_server_version, ttl, deadline)
+
+def get_cached_metric_names(conn, ttl=DEFAULT_NAMES_TTL, deadline=None):
+    """
+    :rtype: list
+    :return: per get_all_metric_names(), asking the server at most once per ttl seconds
+    """
+    return _cached(conn, get_all_metric_names, ttl, deadline)
+
+def get_cached_tag_names(conn, ttl=DEFAULT_NAMES_TTL, deadline=None):
+    """
+    :rtype: list
+    :return: per get_all_tag_names(), asking the server at most once per ttl seconds
+    """
+    return _cached(conn, get_all_tag_names, ttl, deadline)
+
+def get_cached_tag_values(conn, ttl=DEFAULT_NAMES_TTL, deadline=None):
+    """
+    :rtype: list
+    :return: per get_all_tag_values(), asking the server at most once per ttl seconds
+    """
+    return _cached(conn, get_all_tag_values, ttl, deadline)
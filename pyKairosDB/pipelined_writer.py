@@ -0,0 +1,287 @@
+# -*- python -*-
+
+"""
+A writer that overlaps encoding batches with sending them.
+
+write_metrics_list() encodes a batch and then waits on the network, so
+the CPU is idle while the request is in flight and the network is idle
+while the next batch is encoded.  A PipelinedWriter splits the two into
+stages connected by bounded queues::
+
+    submit() -> encode queue -> encoder threads -> send queue -> sender threads -> WriteFuture
+
+There are max_in_flight sender threads, so that many requests can be
+waiting on the server at once.  When both queues are full, submit()
+blocks (or raises Queue.Full if block=False), which pushes back on
+whatever is producing the metrics instead of letting memory grow.
+
+Encoding is python code, so encoder threads share the interpreter lock
+with everything else; more than one encoder only helps when a
+write_transport's encode() releases it.  The overlap with the network
+is what matters.
+"""
+
+import logging
+import Queue
+import threading
+import time
+
+from . import instrumentation
+from . import writer
+
+LOG = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class WriteFuture(object):
+    """
+    The outcome of one batch given to PipelinedWriter.submit().  The
+    result is what write_metrics_list() would have returned.
+    """
+
+    def __init__(self, sequence, points):
+        self.sequence = sequence
+        self.points = points
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def _set(self, result, exception):
+        self._result = result
+        self._exception = exception
+        self._done.set()
+
+    def done(self):
+        """
+        :rtype: bool
+        :return: whether the batch has been written, or has failed
+        """
+        return self._done.is_set()
+
+    def exception(self, timeout=None):
+        """
+        :type timeout: float
+        :param timeout: the most seconds to wait, None to wait until it's done
+
+        :rtype: Exception
+        :return: what encoding or sending the batch raised, None if it didn't
+        """
+        if not self._done.wait(timeout):
+            raise Queue.Empty("the batch hasn't been written yet")
+        return self._exception
+
+    def result(self, timeout=None):
+        """
+        :type timeout: float
+        :param timeout: the most seconds to wait, None to wait until it's done
+
+        :rtype: requests.Response
+        :return: per writer.write_metrics_list()
+
+        :raises: whatever encoding or sending the batch raised, or Queue.Empty if it isn't done in time
+        """
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+
+class PipelinedWriter(object):
+    """
+    :type conn: KairosDBConnection
+    :param conn: the connection to write to.  Its write_transport and recent_store, if it has them, are used.
+
+    :type encoders: int
+    :param encoders: how many threads encode batches
+
+    :type max_in_flight: int
+    :param max_in_flight: the most requests that are sent at once
+
+    :type queue_size: int
+    :param queue_size: how many batches each of the encode and send queues holds
+
+    :type ordered: bool
+    :param ordered: whether batches complete in the order they were submitted.  When True, a
+        batch that's written before an earlier one waits for it before its future is done.
+
+    :type on_complete: callable
+    :param on_complete: called with each WriteFuture as it's done, from a sender thread.  It's
+        called in completion order, with the writer's lock held, so it mustn't call submit() or flush().
+
+    The counters in stats are submitted, written and failed (batches that
+    raised, or that the server didn't answer with a 204).
+    """
+
+    def __init__(self, conn, encoders=1, max_in_flight=4, queue_size=8, ordered=False, on_complete=None):
+        self.conn = conn
+        self.ordered = ordered
+        self.on_complete = on_complete
+        self.stats = {"submitted" : 0, "written" : 0, "failed" : 0}
+        self._encode_queue = Queue.Queue(queue_size)
+        self._send_queue = Queue.Queue(queue_size)
+        self._submit_lock = threading.Lock()
+        self._next_sequence = 0
+        self._closed = False
+        self._completed = threading.Condition()
+        self._next_to_complete = 0
+        self._reorder = dict()
+        self._outstanding = 0
+        self._store = getattr(conn, "recent_store", None)
+        self._encoders = [ self._start_thread(self._encoder) for n in range(encoders) ]
+        self._senders = [ self._start_thread(self._sender) for n in range(max_in_flight) ]
+
+    def _start_thread(self, target):
+        t = threading.Thread(target=target)
+        t.daemon = True
+        t.start()
+        return t
+
+    def submit(self, metric_list, block=True, timeout=None):
+        """
+        :type metric_list: list
+        :param metric_list: list of dicts, per writer.write_metrics_list().  It belongs to the
+            writer until its future is done.
+
+        :type block: bool
+        :param block: whether to wait for room in the encode queue
+
+        :type timeout: float
+        :param timeout: the most seconds to wait for room, None to wait as long as it takes
+
+        :rtype: WriteFuture
+        :return: the batch's outcome, once it's been written
+
+        :raises: Queue.Full if there was no room in time, ValueError if the writer is closed
+        """
+        with self._submit_lock:
+            if self._closed:
+                raise ValueError("the PipelinedWriter is closed")
+            future = WriteFuture(self._next_sequence, len(metric_list))
+            with self._completed:
+                self._outstanding += 1 # before it's queued, so that it can't complete first
+            try:
+                self._encode_queue.put((future, metric_list), block, timeout)
+            except Queue.Full:
+                with self._completed:
+                    self._outstanding -= 1
+                    if self._outstanding == 0:
+                        self._completed.notify_all()
+                raise
+            self._next_sequence += 1
+        with self._completed:
+            self.stats["submitted"] += 1
+        return future
+
+    def _encoder(self):
+        while True:
+            item = self._encode_queue.get()
+            if item is _STOP:
+                return
+            future, metric_list = item
+            start = time.time()
+            timestamps = None
+            try:
+                # for the connection's recent_store, before encoding converts them in place
+                if self._store is not None:
+                    timestamps = [ m["timestamp"] for m in metric_list ]
+                body = writer.encode_for(self.conn, metric_list)
+            except Exception, e:
+                self._send_queue.put((future, None, 0, e, metric_list, timestamps))
+            else:
+                self._send_queue.put((future, body, time.time() - start, None, metric_list, timestamps))
+
+    def _sender(self):
+        while True:
+            item = self._send_queue.get()
+            if item is _STOP:
+                return
+            future, body, encode_seconds, error, metric_list, timestamps = item
+            result = None
+            if error is None:
+                try:
+                    with instrumentation.operation(self.conn, "write") as op:
+                        op.add_phase("encode", encode_seconds)
+                        result = writer.send_encoded(self.conn, body, future.points, None, op)
+                except Exception, e:
+                    error = e
+            if self._store is not None:
+                try:
+                    if error is None and result.status_code == 204:
+                        self._store.add(metric_list, timestamps=timestamps)
+                    else:
+                        self._store.forget(set(m["name"] for m in metric_list))
+                except Exception:
+                    LOG.exception("Updating the recent store failed for batch %s", future.sequence)
+            self._complete(future, result, error)
+
+    def _complete(self, future, result, error):
+        with self._completed:
+            if error is not None or result.status_code != 204:
+                self.stats["failed"] += 1
+            else:
+                self.stats["written"] += 1
+            if not self.ordered:
+                ready = [(future, result, error)]
+            else:
+                # hold it until every batch submitted before it is done
+                self._reorder[future.sequence] = (future, result, error)
+                ready = list()
+                while self._next_to_complete in self._reorder:
+                    ready.append(self._reorder.pop(self._next_to_complete))
+                    self._next_to_complete += 1
+            for future, result, error in ready:
+                future._set(result, error)
+                if self.on_complete is not None:
+                    try:
+                        self.on_complete(future)
+                    except Exception:
+                        LOG.exception("on_complete failed for batch %s", future.sequence)
+            self._outstanding -= len(ready)
+            if self._outstanding == 0:
+                self._completed.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        :type timeout: float
+        :param timeout: the most seconds to wait, None to wait until it's done
+
+        :rtype: bool
+        :return: True if every batch submitted so far is done, False if some aren't yet
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._completed:
+            while self._outstanding:
+                if deadline is None:
+                    self._completed.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._completed.wait(remaining)
+        return True
+
+    def close(self):
+        """
+        Stop taking batches, wait for the ones already submitted to be
+        written, and stop the threads.
+        """
+        with self._submit_lock:
+            if self._closed:
+                return
+            self._closed = True
+        for t in self._encoders:
+            self._encode_queue.put(_STOP)
+        for t in self._encoders:
+            t.join()
+        for t in self._senders:
+            self._send_queue.put(_STOP)
+        for t in self._senders:
+            t.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
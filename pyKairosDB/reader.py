@@ -28,13 +28,19 @@ format for a relative start time::
 And per the docs, end_absolute and end_relative can be specified "in the same way".
 """
 
-import requests
 import json
+from multiprocessing.pool import ThreadPool
+
+from . import instrumentation
+from . import recent
+from . import transport
 
 # If you evoke an error:
 # Out[7]: '{"errors":["\\"day\\" is not a valid time unit, must be one of MILLISECONDS,SECONDS,MINUTES,HOURS,DAYS,WEEKS,MONTHS,YEARS"]}'
 VALID_UNITS = ("milliseconds", "seconds", "minutes", "hours", "days", "weeks", "months", "years")
 
+LATEST_BATCH_SIZE = 500 # how many series get_latest() asks for in each query
+
 def default_group_by():
     """
     :rtype: dict
@@ -169,7 +175,7 @@ def add_tags_to_query(query, tags):
 
 def read(conn, metric_names, start_absolute=None, start_relative=None,
          end_absolute=None, end_relative=None, query_modifying_function=None,
-         only_read_tags=False, tags=None):
+         only_read_tags=False, tags=None, deadline=None):
     """
     :type conn: pyKairosDB.connect object
     :param conn: the interface to the requests library
@@ -204,30 +210,58 @@ def read(conn, metric_names, start_absolute=None, start_relative=None,
     :param tags: Tags to be searched in metrics. Allows to filter the results to only metric which contain specified
         tags in case only_read_tags=True.
 
+    :type deadline: transport.Deadline
+    :param deadline: the deadline for the request, per pyKairosDB.transport.  None for the connection's defaults.
+
     :rtype: dict
     :return: a dictionary that reflects the json returned from the kairosdb, with timestamps changed to seconds
         since the epoch (from KairosDBs native milliseconds since the epoch).
 
+    The time taken by each phase is recorded in conn.instrumentation, see
+    pyKairosDB.instrumentation.
+
+    If the connection has a recent_store (see pyKairosDB.recent) that
+    covers the range for all of the metrics, and there's no
+    query_modifying_function, the read is answered from it without a
+    request.
     """
-    if start_relative is not None:
-        query = _query_relative(start_relative, end_relative)
-    elif start_absolute is not None:
-        query = _query_absolute(start_absolute, end_absolute)
-    if only_read_tags is True:
-        read_url = conn.read_tag_url
-        # print read_url
-    else:
-        read_url = conn.read_url
-
-    query["metrics"] = [ {"name" : m } for m in metric_names ]
-    if tags:
-        query = add_tags_to_query(query, tags)
-        # print query
-    if query_modifying_function is not None:
-        query_modifying_function(query)
-    r = requests.post(read_url, json.dumps(query))
-    # print "Results are: ", r.json()
-    return _change_timestamps_to_python(r.content)
+    store = getattr(conn, "recent_store", None)
+    if store is not None and query_modifying_function is None and not only_read_tags:
+        window = recent.absolute_range(start_absolute, start_relative, end_absolute, end_relative)
+        if window is not None:
+            content = store.read(metric_names, window[0], window[1], tags)
+            if content is not None:
+                return content
+    with instrumentation.operation(conn, "read_tags" if only_read_tags else "read") as op:
+        with op.phase("build"):
+            if start_relative is not None:
+                query = _query_relative(start_relative, end_relative)
+            elif start_absolute is not None:
+                query = _query_absolute(start_absolute, end_absolute)
+            if only_read_tags is True:
+                read_url = conn.read_tag_url
+                # print read_url
+            else:
+                read_url = conn.read_url
+
+            query["metrics"] = [ {"name" : m } for m in metric_names ]
+            if tags:
+                query = add_tags_to_query(query, tags)
+                # print query
+            if query_modifying_function is not None:
+                query_modifying_function(query)
+        with op.phase("encode"):
+            body = json.dumps(query)
+        with op.phase("network"):
+            r = transport.request(conn, "POST", read_url, body, deadline)
+        op.request_bytes = len(body)
+        op.response_bytes = len(r.content)
+        # print "Results are: ", r.json()
+        with op.phase("decode"):
+            c_dict = json.loads(r.content)
+        with op.phase("timestamps"):
+            op.points = _timestamps_to_python(c_dict)
+        return c_dict
 
 def _query_relative(start, end=None):
     """
@@ -290,18 +324,97 @@ def _query_absolute(start, end):
 
 
 def read_relative(conn, metric_names, start, end=None, tags=None,
-                  query_modifying_function=None, only_read_tags=False):
+                  query_modifying_function=None, only_read_tags=False, deadline=None):
     """If end_relative is empty, "now" is implied"""
     return read(conn, metric_names, start_relative=start, end_relative=end,
                 query_modifying_function=query_modifying_function,
-                only_read_tags=only_read_tags, tags=tags)
+                only_read_tags=only_read_tags, tags=tags, deadline=deadline)
 
 def read_absolute(conn, metric_names, start, end=None, tags=None,
-                  query_modifying_function=None, only_read_tags=False):
+                  query_modifying_function=None, only_read_tags=False, deadline=None):
     """If end_absolute is empty, time.time() is implied"""
     return read(conn, metric_names, start_absolute=start, end_absolute=end,
                 query_modifying_function=query_modifying_function,
-                only_read_tags=only_read_tags, tags=tags)
+                only_read_tags=only_read_tags, tags=tags, deadline=deadline)
+
+
+def get_latest(conn, metric_names, tags=None, lookback=(1, "days"), batch_size=LATEST_BATCH_SIZE,
+               workers=1, deadline=None):
+    """
+    :type conn: pyKairosDB.connect object
+    :param conn: the interface to the requests library
+
+    :type metric_names: list
+    :param metric_names: the series to get the latest value of.  Each is a metric name, or a
+        (name, tags) tuple for the series of the name that have those tags.
+
+    :type tags: dict
+    :param tags: tags that every series must have, as well as its own
+
+    :type lookback: tuple
+    :param lookback: how far back to look for a value, per read_relative()'s start
+
+    :type batch_size: int
+    :param batch_size: the most series asked for in one query
+
+    :type workers: int
+    :param workers: how many queries may be in flight at once
+
+    :type deadline: transport.Deadline
+    :param deadline: the deadline for the whole call, shared by its queries.  None for the connection's defaults.
+
+    :rtype: dict
+    :return: each of metric_names that has a value in the lookback, to its latest (timestamp, value).
+        A (name, tags) series is keyed by (name, tags as a sorted tuple of (key, value) pairs).
+
+    Each series is queried with KairosDB's limit and order options, so
+    only its latest datapoint is sent back, however many there are in
+    the lookback.  The series are batched batch_size to a query.
+    """
+    if deadline is None:
+        deadline = transport.new_deadline(conn)
+    series = list()
+    for entry in metric_names:
+        if isinstance(entry, basestring):
+            series.append((entry, entry, dict(tags or {})))
+        else:
+            name, series_tags = entry
+            merged = dict(tags or {})
+            merged.update(series_tags)
+            series.append(((name, tuple(sorted(series_tags.iteritems()))), name, merged))
+    batches = [ series[n:n + batch_size] for n in xrange(0, len(series), batch_size) ]
+
+    def read_batch(batch):
+        def modify_query(query):
+            query["metrics"] = [ _latest_query_item(name, series_tags) for key, name, series_tags in batch ]
+        content = conn.read_relative([ name for key, name, series_tags in batch ], lookback,
+                                     query_modifying_function=modify_query, deadline=deadline)
+        latest = dict()
+        for (key, name, series_tags), q in zip(batch, content["queries"]):
+            values = [ v for result in q["results"] for v in result["values"] ]
+            if values:
+                latest[key] = tuple(max(values))
+        return latest
+
+    latest = dict()
+    if workers <= 1 or len(batches) <= 1:
+        for batch in batches:
+            latest.update(read_batch(batch))
+        return latest
+    pool = ThreadPool(min(workers, len(batches)))
+    try:
+        for batch_latest in pool.imap_unordered(read_batch, batches):
+            latest.update(batch_latest)
+    finally:
+        pool.close()
+        pool.join()
+    return latest
+
+def _latest_query_item(name, tags):
+    item = {"name" : name, "limit" : 1, "order" : "desc"}
+    if tags:
+        item["tags"] = tags
+    return item
 
 
 def _change_timestamps_to_python(content):
@@ -316,8 +429,21 @@ def _change_timestamps_to_python(content):
     the epoch, with millisecond resolution
     """
     c_dict = json.loads(content)
+    _timestamps_to_python(c_dict)
+    return c_dict
+
+def _timestamps_to_python(c_dict):
+    """
+    :type c_dict: dict
+    :param c_dict: decoded content, whose timestamps are changed in place
+
+    :rtype: int
+    :return: the number of values
+    """
+    points = 0
     for q in c_dict["queries"]:
         for r in q["results"]:
             for v in r["values"]:
                 v[0] = float(v[0]) / 1000.0
-    return c_dict
+            points += len(r["values"])
+    return points
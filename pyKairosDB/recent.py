@@ -0,0 +1,331 @@
+# -*- python -*-
+
+"""
+An in-process store of the datapoints recently written through a
+connection, so that reading them back doesn't need a round trip to
+KairosDB::
+
+    store = recent.RecentStore(horizon=600, max_bytes=64 * 2 ** 20)
+    conn = pyKairosDB.connect("kairos01", "8080", recent_store=store)
+    conn.write_metrics(metrics)
+    ...
+    conn.read_relative(["web01.load"], (5, "minutes")) # answered from the store
+
+Every write that KairosDB accepts is added to the store, and a read
+that the store fully covers is answered from it, in the same form as
+KairosDB's answer.  Any other read goes to KairosDB as usual: one with
+a query_modifying_function (aggregators, group_by, ...), a tags-only
+read, or one over a range the store can't vouch for.
+
+Each series is kept in a ring buffer of arrays, and datapoints older
+than horizon seconds are dropped from it.  A metric is covered from the
+time of its first write through the connection, or from just after the
+newest datapoint that has been dropped, whichever is later.  When the
+series take more than max_bytes, whole metrics are dropped, the least
+recently written first, and their reads go to KairosDB again.  Each
+series counts SERIES_BYTES towards max_bytes besides its buffers, so
+that many sparse series can't take several times the limit.
+
+The store only knows about what was written through its connections,
+so it should only be used when this process is the one writer of the
+metrics it writes.  Datapoints written by anything else in a covered
+range won't be seen.
+"""
+
+import array
+import collections
+import logging
+import threading
+import time
+
+from . import writer
+
+LOG = logging.getLogger(__name__)
+
+POINT_BYTES = 17 # a double timestamp, a double value and a byte for whether the value is an integer
+# what a series costs besides its datapoints: the _Ring, its arrays' headers, its copy of the
+# tags and the key it's kept under, about 800 bytes for a couple of tags, with room for more
+SERIES_BYTES = 1024
+MIN_CAPACITY = 16
+
+RELATIVE_SECONDS = {"milliseconds" : 0.001, "seconds" : 1, "minutes" : 60, "hours" : 3600, "days" : 86400,
+                    "weeks" : 7 * 86400} # months and years are calendar units, they aren't answered locally
+
+
+class _Ring(object):
+    """The datapoints of one series, oldest first, in arrays that are used as a ring"""
+
+    __slots__ = ("tags", "timestamps", "values", "integers", "start", "count")
+
+    def __init__(self, tags):
+        self.tags = tags
+        self.timestamps = array.array("d", [0.0] * MIN_CAPACITY)
+        self.values = array.array("d", [0.0] * MIN_CAPACITY)
+        self.integers = array.array("b", [0] * MIN_CAPACITY)
+        self.start = 0
+        self.count = 0
+
+    @property
+    def nbytes(self):
+        return len(self.timestamps) * POINT_BYTES
+
+    def _resize(self, capacity):
+        order = self._indexes()
+        self.timestamps = array.array("d", [ self.timestamps[n] for n in order ] + [0.0] * (capacity - self.count))
+        self.values = array.array("d", [ self.values[n] for n in order ] + [0.0] * (capacity - self.count))
+        self.integers = array.array("b", [ self.integers[n] for n in order ] + [0] * (capacity - self.count))
+        self.start = 0
+
+    def _indexes(self):
+        capacity = len(self.timestamps)
+        return [ (self.start + n) % capacity for n in xrange(self.count) ]
+
+    def append(self, timestamp, value, integer):
+        if self.count == len(self.timestamps):
+            self._resize(self.count * 2)
+        n = (self.start + self.count) % len(self.timestamps)
+        self.timestamps[n] = timestamp
+        self.values[n] = value
+        self.integers[n] = integer
+        self.count += 1
+
+    def expire(self, cutoff):
+        """
+        Drop the datapoints from the oldest up to the first that's at or after cutoff.
+
+        :return: the timestamp of the newest datapoint dropped, or None
+        """
+        dropped = None
+        capacity = len(self.timestamps)
+        while self.count and self.timestamps[self.start] < cutoff:
+            if dropped is None or self.timestamps[self.start] > dropped:
+                dropped = self.timestamps[self.start]
+            self.start = (self.start + 1) % capacity
+            self.count -= 1
+        if capacity > MIN_CAPACITY and self.count <= capacity // 4:
+            self._resize(max(MIN_CAPACITY, capacity // 2))
+        return dropped
+
+    def points(self, start, end):
+        """The [timestamp, value] of the datapoints in [start, end], the last written of any duplicate timestamp"""
+        selected = dict()
+        for n in self._indexes():
+            timestamp = self.timestamps[n]
+            if start <= timestamp <= end:
+                value = self.values[n]
+                selected[timestamp] = int(value) if self.integers[n] else value
+        return selected
+
+
+class _Metric(object):
+    """The series of one metric name, and the time they're complete from"""
+
+    __slots__ = ("series", "covered_from", "nbytes")
+
+    def __init__(self, covered_from):
+        self.series = dict() # sorted tag tuple to _Ring
+        self.covered_from = covered_from
+        self.nbytes = 0
+
+    def expire(self, cutoff):
+        for ring in self.series.values():
+            dropped = ring.expire(cutoff)
+            if dropped is not None:
+                # KairosDB has millisecond timestamps
+                self.covered_from = max(self.covered_from, dropped + 0.001)
+        self.nbytes = sum(ring.nbytes for ring in self.series.itervalues()) + SERIES_BYTES * len(self.series)
+
+
+class RecentStore(object):
+    """
+    :type horizon: float
+    :param horizon: seconds of datapoints that are kept, before the time they're added
+
+    :type max_bytes: int
+    :param max_bytes: the most memory the series may take, counting SERIES_BYTES for each
+        besides its buffers
+
+    The counters in stats are points (datapoints added), hits (reads
+    answered from the store), misses (reads that went to KairosDB) and
+    evicted (metrics dropped to stay under max_bytes).
+    """
+
+    def __init__(self, horizon=300, max_bytes=64 * 2 ** 20):
+        self.horizon = horizon
+        self.max_bytes = max_bytes
+        self.stats = {"points" : 0, "hits" : 0, "misses" : 0, "evicted" : 0}
+        self._metrics = collections.OrderedDict() # name to _Metric, the least recently written first
+        self._bytes = 0
+        self._last_sweep = time.time()
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        """How much memory the series take, by the same estimate as max_bytes"""
+        return self._bytes
+
+    def add(self, metric_list, now=None, timestamps=None):
+        """
+        :type metric_list: list
+        :param metric_list: dicts that KairosDB has accepted, per writer.write_metrics_list()
+
+        :type timestamps: list
+        :param timestamps: the metrics' timestamps in seconds, if writing them converted the
+            metrics' own to milliseconds.  None to use the metrics'.
+
+        A metric with a value that isn't a number is forgotten, so that
+        its reads go to KairosDB.
+        """
+        if now is None:
+            now = time.time()
+        frozen_tags = dict()
+        touched = dict()
+        unusable = set()
+        with self._lock:
+            if timestamps is None:
+                timestamps = [ m["timestamp"] for m in metric_list ]
+            for m, timestamp in zip(metric_list, timestamps):
+                name = m["name"]
+                metric = touched.get(name)
+                if metric is None:
+                    metric = self._metrics.pop(name, None) # popped and re-inserted as the most recent
+                    if metric is None:
+                        metric = _Metric(now)
+                    else:
+                        self._bytes -= metric.nbytes
+                    touched[name] = metric
+                tags = writer.series_key(name, m["tags"], frozen_tags)[1]
+                ring = metric.series.get(tags)
+                if ring is None:
+                    ring = metric.series[tags] = _Ring(dict(m["tags"]))
+                value = m["value"]
+                if not isinstance(value, (int, long, float)) or isinstance(value, bool):
+                    unusable.add(name)
+                    continue
+                ring.append(int(timestamp * 1000) / 1000.0, value, not isinstance(value, float))
+            cutoff = now - self.horizon
+            for name, metric in touched.iteritems():
+                if name in unusable:
+                    continue
+                metric.expire(cutoff)
+                self._metrics[name] = metric
+                self._bytes += metric.nbytes
+            self.stats["points"] += len(metric_list)
+            if now - self._last_sweep > self.horizon / 4.0:
+                self._sweep(cutoff)
+                self._last_sweep = now
+            while self._bytes > self.max_bytes and self._metrics:
+                name, metric = self._metrics.popitem(last=False)
+                self._bytes -= metric.nbytes
+                self.stats["evicted"] += 1
+                LOG.debug("Dropped %s from the recent store, it's over %d bytes", name, self.max_bytes)
+
+    def _sweep(self, cutoff):
+        """Expire the metrics that haven't been written lately, and drop the ones that are empty"""
+        for name, metric in self._metrics.items():
+            self._bytes -= metric.nbytes
+            metric.expire(cutoff)
+            if not any(ring.count for ring in metric.series.itervalues()):
+                del self._metrics[name]
+                continue
+            self._bytes += metric.nbytes
+
+    def forget(self, metric_names):
+        """
+        :type metric_names: iterable
+        :param metric_names: metrics whose datapoints the store can no longer vouch for, e.g.
+            after a write that may only have been partly accepted
+        """
+        with self._lock:
+            for name in metric_names:
+                metric = self._metrics.pop(name, None)
+                if metric is not None:
+                    self._bytes -= metric.nbytes
+
+    def read(self, metric_names, start, end=None, tags=None, now=None):
+        """
+        :type metric_names: list
+        :param metric_names: the metrics to read
+
+        :type start: float
+        :param start: seconds since the epoch
+
+        :type end: float
+        :param end: seconds since the epoch, None for now
+
+        :type tags: dict
+        :param tags: per reader.read(), which only applies them to the first metric
+
+        :rtype: dict
+        :return: what reader.read() would have returned, or None if the store doesn't cover the
+            range for every one of the metrics
+        """
+        if now is None:
+            now = time.time()
+        if end is None:
+            end = now
+        start = int(start * 1000) / 1000.0
+        end = int(end * 1000) / 1000.0
+        queries = list()
+        with self._lock:
+            for n, name in enumerate(metric_names):
+                metric = self._metrics.get(name)
+                if metric is None or metric.covered_from > start:
+                    self.stats["misses"] += 1
+                    return None
+                queries.append(_query_result(name, metric, start, end, tags if n == 0 else None))
+            self.stats["hits"] += 1
+        return {"queries" : queries}
+
+
+def forget_written(conn, metric_list):
+    """
+    :type metric_list: list
+    :param metric_list: metrics that are being written to the connection some other way than
+        writer.write_metrics_list(), which the connection's recent_store, if it has one, can't vouch for
+    """
+    store = getattr(conn, "recent_store", None)
+    if store is not None:
+        store.forget(set(m["name"] for m in metric_list))
+
+
+def _matches(series_tags, wanted):
+    for key, values in wanted.iteritems():
+        if not isinstance(values, list):
+            values = [values]
+        if str(series_tags.get(key)) not in [ str(v) for v in values ]:
+            return False
+    return True
+
+def _query_result(name, metric, start, end, tags):
+    values = list()
+    result_tags = collections.defaultdict(set)
+    for ring in metric.series.itervalues():
+        if tags and not _matches(ring.tags, tags):
+            continue
+        points = ring.points(start, end)
+        if not points:
+            continue
+        values.extend([t, v] for t, v in points.iteritems())
+        for key, value in ring.tags.iteritems():
+            result_tags[key].add(value)
+    values.sort()
+    result = {"name" : name, "tags" : dict((k, sorted(vs)) for k, vs in result_tags.iteritems()), "values" : values}
+    return {"sample_size" : len(values), "results" : [result]}
+
+def absolute_range(start_absolute=None, start_relative=None, end_absolute=None, end_relative=None, now=None):
+    """
+    :rtype: tuple
+    :return: (start, end) in seconds since the epoch for reader.read()'s arguments, end being None
+        for now, or None if a relative time is in months or years
+    """
+    if now is None:
+        now = time.time()
+    times = list()
+    for absolute, relative in ((start_absolute, start_relative), (end_absolute, end_relative)):
+        if relative is not None:
+            if relative[1] not in RELATIVE_SECONDS:
+                return None
+            absolute = now - float(relative[0]) * RELATIVE_SECONDS[relative[1]]
+        times.append(absolute)
+    return tuple(times)
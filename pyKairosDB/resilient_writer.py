@@ -0,0 +1,374 @@
+# -*- python -*-
+
+"""
+A writer that keeps accepting metrics while KairosDB is unavailable,
+e.g. during a rolling restart.
+
+Batches given to ResilientWriter.write() are encoded and queued in
+memory, and a sender thread posts them.  A post that fails with a
+connection error, a timeout or a 5xx status is retried with jittered
+exponential backoff.  If the retries run out, or if the in-memory
+queue is full, the batch is appended to a spill log on local disk
+instead, so write() never waits on the network.
+
+The spill log is a directory of append-only segment files.  A drain
+thread replays the oldest segment first, at no more than drain_rate
+batches per second so that a recovering server isn't flooded, and
+deletes each segment once all of it has been accepted.
+
+Replaying is at-least-once: if the process stops part way through a
+segment, the batches in it that were already sent are sent again,
+which KairosDB treats as overwrites of the same datapoints.
+"""
+
+import glob
+import logging
+import os
+import Queue
+import random
+import struct
+import threading
+import time
+
+import requests
+
+from . import recent
+from . import transport
+from . import util
+from . import writer
+
+LOG = logging.getLogger(__name__)
+
+RECORD_HEADER = struct.Struct("!L")
+
+
+class RetryableWriteError(Exception):
+    """The server didn't accept a write, but may if it's tried again"""
+
+
+def post_with_retry(conn, body, retries=5, backoff=0.1, max_backoff=10.0, timeout=(3.05, 30)):
+    """
+    :type conn: KairosDBConnection
+    :param conn: the connection to write to
+
+    :type body: str
+    :param body: an encoded write request, per writer.encode_metrics_list()
+
+    :type retries: int
+    :param retries: how many times to try again after the first attempt fails
+
+    :type backoff: float
+    :param backoff: the base delay, in seconds, which doubles with each retry
+
+    :type max_backoff: float
+    :param max_backoff: the most that the delay before one retry can grow to
+
+    :type timeout: tuple
+    :param timeout: (connect, read) timeouts in seconds for each attempt, per requests
+
+    :rtype: requests.Response
+    :return: the response to the attempt that succeeded, or that failed in a way that retrying won't fix (a 4xx)
+
+    :raises: RetryableWriteError when every attempt failed in a way that might succeed later
+
+    The delay before each retry is a random time between zero and the
+    backoff ("full jitter"), so that many clients recovering at once
+    don't retry in lock-step.
+    """
+    attempt = 0
+    while True:
+        try:
+            r = transport.request(conn, "POST", conn.write_url, body, transport.Deadline(None, *timeout))
+            if r.status_code < 500:
+                return r
+            error = "Status code: {0}".format(r.status_code)
+        except (requests.ConnectionError, requests.Timeout), e:
+            error = str(e)
+        if attempt >= retries:
+            raise RetryableWriteError("writing to {0} failed after {1} attempts. {2}".format(
+                conn.write_url, attempt + 1, error))
+        time.sleep(random.uniform(0, min(max_backoff, backoff * 2 ** attempt)))
+        attempt += 1
+
+
+class SegmentLog(object):
+    """
+    :type directory: str
+    :param directory: where the segment files are kept.  It's created if it doesn't exist.
+
+    :type segment_bytes: int
+    :param segment_bytes: the size after which a new segment file is started
+
+    Each record is a 4-byte big-endian length followed by that many
+    bytes.  Records are appended to the newest segment, and read back
+    from the oldest.
+    """
+
+    def __init__(self, directory, segment_bytes=64 * 2 ** 20):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self._lock = threading.Lock()
+        self._active = None
+        self._active_size = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        existing = self.segments()
+        if existing:
+            self._sequence = int(os.path.basename(existing[-1]).split(".")[0]) + 1
+        else:
+            self._sequence = 0
+
+    def segments(self):
+        """
+        :rtype: list
+        :return: the paths of the segment files, oldest first
+        """
+        return sorted(glob.glob(os.path.join(self.directory, "*.seg")))
+
+    def append(self, record):
+        """
+        :type record: str
+        :param record: the bytes to append
+        """
+        with self._lock:
+            if self._active is None or self._active_size >= self.segment_bytes:
+                self._roll()
+            self._active.write(RECORD_HEADER.pack(len(record)))
+            self._active.write(record)
+            self._active.flush()
+            self._active_size += RECORD_HEADER.size + len(record)
+
+    def _roll(self):
+        if self._active is not None:
+            self._active.close()
+        path = os.path.join(self.directory, "{0:012d}.seg".format(self._sequence))
+        self._sequence += 1
+        self._active = open(path, "ab")
+        self._active_size = 0
+
+    def seal_oldest(self):
+        """
+        :rtype: str
+        :return: the path of the oldest segment, which won't be appended to any more, or None
+            if there are no records
+
+        If the oldest segment is the one being appended to, a new one is
+        started so that it can be read without racing with appends.
+        """
+        with self._lock:
+            segments = self.segments()
+            if not segments:
+                return None
+            if self._active is not None and self._active.name == segments[0]:
+                if self._active_size == 0:
+                    return None
+                self._active.close()
+                self._active = None
+            return segments[0]
+
+    @staticmethod
+    def read(path, offset=0):
+        """
+        :type path: str
+        :param path: a sealed segment
+
+        :type offset: int
+        :param offset: where to start reading
+
+        :rtype: generator
+        :return: (record, offset_after_record) tuples.  A record cut short by a crash is ignored.
+        """
+        with open(path, "rb") as f:
+            f.seek(offset)
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                (length,) = RECORD_HEADER.unpack(header)
+                record = f.read(length)
+                if len(record) < length:
+                    return
+                offset += RECORD_HEADER.size + length
+                yield (record, offset)
+
+    def close(self):
+        with self._lock:
+            if self._active is not None:
+                self._active.close()
+                self._active = None
+
+
+class ResilientWriter(object):
+    """
+    :type conn: KairosDBConnection
+    :param conn: the connection to write to
+
+    :type spill_directory: str
+    :param spill_directory: where batches are kept while the server is unavailable.  Batches
+        left there by an earlier process are sent, too.
+
+    :type retries: int
+    :param retries: per post_with_retry()
+
+    :type backoff: float
+    :param backoff: per post_with_retry(), also the first delay between attempts to drain the spill log
+
+    :type max_backoff: float
+    :param max_backoff: per post_with_retry(), also the longest delay between attempts to drain the spill log
+
+    :type max_queued_batches: int
+    :param max_queued_batches: how many batches are held in memory before they're spilled to disk
+
+    :type drain_rate: float
+    :param drain_rate: the most spilled batches that are sent per second after the server recovers
+
+    :type timeout: tuple
+    :param timeout: (connect, read) timeouts in seconds for each attempt, per requests
+
+    :type segment_bytes: int
+    :param segment_bytes: per SegmentLog
+
+    The counters in stats are: queued and spilled (batches given to
+    write()), sent (batches accepted from the queue), drained (batches
+    accepted from the spill log) and rejected (batches the server refused
+    with a 4xx, which are logged and dropped).
+    """
+
+    def __init__(self, conn, spill_directory, retries=5, backoff=0.1, max_backoff=10.0,
+                 max_queued_batches=100, drain_rate=10, timeout=(3.05, 30),
+                 segment_bytes=64 * 2 ** 20):
+        self.conn = conn
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.spill_log = SegmentLog(spill_directory, segment_bytes)
+        self.stats = {"queued" : 0, "spilled" : 0, "sent" : 0, "drained" : 0, "rejected" : 0}
+        self._available = True
+        self._queue = Queue.Queue(max_queued_batches)
+        self._drain_limiter = util.RateLimiter(drain_rate)
+        self._lock = threading.Lock()
+        self._closing = threading.Event()
+        self._threads = [threading.Thread(target=self._sender), threading.Thread(target=self._drainer)]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.stats[name] += n
+
+    def write(self, metric_list):
+        """
+        :type metric_list: list
+        :param metric_list: list of dicts, per writer.write_metrics_list()
+
+        Encode the batch and queue it to be sent.  This returns without
+        waiting for the network, even when the server is down.  The
+        metrics are left as they were given, with their timestamps in
+        seconds.
+        """
+        recent.forget_written(self.conn, metric_list)
+        # encoding converts the timestamps in place, and the caller may still use the list
+        timestamps = [ m["timestamp"] for m in metric_list ]
+        try:
+            body = writer.encode_metrics_list(metric_list)
+        finally:
+            for m, timestamp in zip(metric_list, timestamps):
+                m["timestamp"] = timestamp
+        if self._available:
+            try:
+                self._queue.put_nowait(body)
+                self._count("queued")
+                return
+            except Queue.Full:
+                pass
+        self._spill(body)
+
+    def _spill(self, body):
+        self.spill_log.append(body)
+        self._count("spilled")
+
+    def _post(self, body):
+        """
+        :rtype: bool
+        :return: True if the batch is finished with, False if the server is unavailable
+        """
+        try:
+            r = post_with_retry(self.conn, body, self.retries, self.backoff, self.max_backoff, self.timeout)
+        except RetryableWriteError, e:
+            LOG.warning("KairosDB is unavailable, spilling to %s: %s", self.spill_log.directory, e)
+            self._available = False
+            return False
+        self._available = True
+        if r.status_code != 204:
+            LOG.error("KairosDB rejected a batch. Status code: %s, content: %s", r.status_code, r.content)
+            self._count("rejected")
+        return True
+
+    def _sender(self):
+        while True:
+            body = self._queue.get()
+            try:
+                if body is None:
+                    return
+                if not self._available:
+                    self._spill(body)
+                elif self._post(body):
+                    self._count("sent")
+                else:
+                    self._spill(body)
+            finally:
+                self._queue.task_done()
+
+    def _drainer(self):
+        delay = self.backoff
+        offset = 0
+        while not self._closing.is_set():
+            path = self.spill_log.seal_oldest()
+            if path is None:
+                self._closing.wait(self.backoff)
+                continue
+            for record, next_offset in self.spill_log.read(path, offset):
+                self._drain_limiter.acquire()
+                if self._closing.is_set() or not self._post(record):
+                    break
+                self._count("drained")
+                offset = next_offset
+                delay = self.backoff
+            else:
+                os.unlink(path)
+                offset = 0
+                continue
+            # the server is still unavailable (or this is closing), wait before trying the same record again
+            self._closing.wait(delay)
+            delay = min(delay * 2, self.max_backoff)
+
+    def flush(self, timeout=None):
+        """
+        :type timeout: float
+        :param timeout: the most seconds to wait, None to wait until it's done
+
+        :rtype: bool
+        :return: True if everything that was written has been sent or rejected, False if some
+            of it is still queued or spilled.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while deadline is None or time.time() < deadline:
+            if self._queue.unfinished_tasks == 0 and not self.spill_log.segments():
+                return True
+            time.sleep(0.01)
+        return False
+
+    def close(self):
+        """
+        Stop the sender and drain threads.  Whatever is still queued in
+        memory is spilled to disk, so it'll be sent by the next
+        ResilientWriter that uses the same spill directory.
+        """
+        self._closing.set()
+        self._available = False # anything still queued goes to disk
+        self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        self.spill_log.close()
@@ -0,0 +1,425 @@
+# -*- python -*-
+
+"""
+Downsampling and retention for graphite metrics, per their retention
+chains in storage-schemas.conf.
+
+Only the highest resolution of a chain like "60s:1d,5m:4w,1h:1y" is
+written to KairosDB (see graphite.py).  A RollupManager does the rest of
+what carbon would: for each lower resolution it has KairosDB aggregate
+the raw datapoints into windows of that resolution, writes the result
+as a series of its own, and deletes whatever has outlived its
+retention::
+
+    schemas = graphite.load_storage_schemas("/opt/graphite/conf/storage-schemas.conf")
+    manager = rollup.RollupManager(conn, schemas, checkpoint_file="/var/lib/rollup.json", workers=8)
+    manager.run_once()   # or manager.run(interval=300) to keep at it
+
+The rollup of metric <name> at a resolution of N seconds is written as
+the metric _rollup.<N>s.<name> (graphite.ROLLUP_PREFIX), tagged with the
+rollup's retention in gr-ret and the aggregator in gr-rollup.  The
+graphite name tree leaves the _rollup series out.
+
+Each metric's progress is kept in the checkpoint file, so every run
+only aggregates the windows that have completed since the last one.
+Raw datapoints are only deleted once every rollup of them has been
+written.  Metrics are processed in parallel by a pool of threads.
+
+read_absolute() is what graphite-web should read with once rollups are
+being made.  It picks the coarsest rollup that's fine enough for the
+number of values wanted, so a year long graph reads one rollup value an
+hour rather than every raw datapoint::
+
+    rollup.read_absolute(conn, "web01.load", start, end, schemas, max_points=800)
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+from . import deleter
+from . import graphite
+from . import metadata
+from . import reader
+from . import transport
+
+LOG = logging.getLogger(__name__)
+
+ROLLUP_TAG = "gr-rollup" # the aggregator a rollup series was made with
+
+UNIT_SECONDS = {"s" : 1, "m" : graphite.SECONDS_PER_MINUTE, "h" : graphite.SECONDS_PER_HOUR,
+                "d" : graphite.SECONDS_PER_DAY, "w" : graphite.SECONDS_PER_WEEK, "y" : graphite.SECONDS_PER_YEAR}
+
+
+_DURATION = re.compile(r"^(\d+)([a-z]*)$")
+
+def _seconds(text):
+    """(seconds, whether it had a unit), for a duration like "5m", "1y" or "60" (which is 60 seconds)"""
+    m = _DURATION.match(text.strip().lower())
+    if m is None or (m.group(2) and m.group(2)[0] not in UNIT_SECONDS):
+        raise ValueError("Not a storage-schemas.conf duration: {0!r}".format(text))
+    return int(m.group(1)) * UNIT_SECONDS[m.group(2)[:1] or "s"], bool(m.group(2))
+
+def parse_retentions(retentions):
+    """
+    :type retentions: str
+    :param retentions: a retention chain, as written in storage-schemas.conf, e.g. "60s:1d,5m:4w,1h:1y"
+
+    :rtype: list
+    :return: (resolution in seconds, retention in seconds, gr-ret tag) for each archive, from the
+        highest resolution to the lowest
+
+    As in carbon, a retention without a unit is a number of datapoints, and a
+    resolution without one is in seconds.
+    """
+    archives = list()
+    for archive in retentions.replace(" ", "").split(","):
+        resolution_text, retention_text = archive.split(graphite.RET_GRAPHITE_CHAR)
+        resolution, _ = _seconds(resolution_text)
+        retention, has_unit = _seconds(retention_text)
+        if not has_unit:
+            retention *= resolution
+        archives.append((resolution, retention,
+                         archive.replace(graphite.RET_GRAPHITE_CHAR, graphite.RET_SEPERATOR_CHAR)))
+    return sorted(archives)
+
+def rollup_name(name, resolution):
+    """
+    :rtype: str
+    :return: the name of the rollup series of the metric name at resolution seconds
+    """
+    return "{0}.{1}s.{2}".format(graphite.ROLLUP_PREFIX, resolution, name)
+
+def _read_sampled(conn, name, aggregator, resolution, start, end, deadline=None):
+    """
+    The values of name in [start, end), start being a multiple of resolution, aggregated by
+    KairosDB into windows of resolution seconds that are each timestamped with their start
+    """
+    def modify_query(query):
+        reader.aggregation([{"name" : aggregator, "align_start_time" : True,
+                             "sampling" : {"value" : resolution, "unit" : "seconds"}}], query["metrics"][0])
+    content = reader.read_absolute(conn, [name], start, end - 0.001, query_modifying_function=modify_query,
+                                   deadline=deadline)
+    values = list()
+    for result in content["queries"][0]["results"]:
+        values.extend(result["values"])
+    return values
+
+def plan_read(archives, start_time, end_time, max_points=None, now=None):
+    """
+    :type archives: list
+    :param archives: per parse_retentions()
+
+    :type max_points: int
+    :param max_points: how many values the caller wants at most, e.g. the width of a graph in
+        pixels.  None for the highest resolution that covers the range.
+
+    :rtype: tuple
+    :return: the archive to read, one of archives
+
+    Of the archives whose retention reaches back to start_time (or the
+    one that reaches back furthest, if none do), the coarsest whose
+    resolution still gives max_points values across the range, or the
+    finest of them when none is fine enough.
+    """
+    if now is None:
+        now = time.time()
+    covering = [ a for a in archives if now - a[1] <= start_time ] or [max(archives, key=lambda a: a[1])]
+    if max_points is None:
+        return covering[0]
+    wanted = (end_time - start_time) / float(max_points)
+    fine_enough = [ a for a in covering if a[0] <= wanted ]
+    if fine_enough:
+        return fine_enough[-1]
+    return covering[0]
+
+def read_absolute(conn, metric_name, start_time, end_time, storage_schemas, max_points=None, now=None,
+                  deadline=None, aggregator="avg"):
+    """
+    :type conn: pyKairosDB.KairosDBConnection
+    :param conn: The connection to KairosDB
+
+    :type metric_name: str
+    :param metric_name: the raw graphite metric
+
+    :type storage_schemas: list
+    :param storage_schemas: the schemas the RollupManager was given
+
+    :type max_points: int
+    :param max_points: per plan_read()
+
+    :type deadline: transport.Deadline
+    :param deadline: the deadline for the whole read, shared by its requests.  None for a deadline
+        with the connection's defaults.
+
+    :type aggregator: str
+    :param aggregator: the aggregator the RollupManager made the rollups with, which the raw
+        datapoints after the last rollup are aggregated with too
+
+    :rtype: tuple
+    :return: ((start_time, end_time, interval), list_of_metric_values), per graphite.read_absolute(),
+        except that start_time is rounded down to a multiple of the interval
+
+    A drop-in for graphite.read_absolute() that reads the rollup chosen
+    by plan_read() instead of aggregating the raw datapoints of the whole
+    range.  The rollup only reaches as far as the last window the
+    RollupManager has done, so the rest of the range, the most recent
+    part, is read from the raw series, aggregated by KairosDB into the
+    same windows.  A metric that no schema matches is read with
+    graphite.read_absolute().
+    """
+    schema = graphite._schema_matcher(storage_schemas).schema(metric_name)
+    if schema is None:
+        return graphite.read_absolute(conn, metric_name, start_time, end_time, deadline)
+    if deadline is None:
+        deadline = transport.new_deadline(conn)
+    archives = parse_retentions(schema.options["retentions"])
+    resolution, retention, tag = plan_read(archives, start_time, end_time, max_points, now)
+    first = int(start_time) // resolution * resolution
+    values = list()
+    raw_start = first
+    if resolution != archives[0][0]:
+        values = _read_sampled(conn, rollup_name(metric_name, resolution), aggregator, resolution, first, end_time,
+                               deadline)
+        if values:
+            raw_start = int(values[-1][0]) + resolution
+    if raw_start < end_time:
+        values.extend(_read_sampled(conn, metric_name, aggregator, resolution, raw_start, end_time, deadline))
+
+    slots = [None] * len(xrange(first, int(end_time), resolution))
+    for timestamp, value in values:
+        n = int(timestamp - first) // resolution
+        if 0 <= n < len(slots):
+            slots[n] = value
+    return ((first, end_time, resolution), slots)
+
+
+class RollupManager(object):
+    """
+    :type conn: KairosDBConnection
+    :param conn: the connection to read, write and delete with
+
+    :type storage_schemas: list
+    :param storage_schemas: carbon.storage.Schema or graphite.StorageSchema objects, per graphite.SchemaMatcher
+
+    :type checkpoint_file: str
+    :param checkpoint_file: where each metric's progress is kept between runs.  None to keep it in memory only.
+
+    :type workers: int
+    :param workers: how many metrics are processed at once
+
+    :type aggregator: str
+    :param aggregator: the KairosDB aggregator that makes the rollups, e.g. "avg", "max" or "sum"
+
+    :type settle: float
+    :param settle: seconds after a window ends before it's rolled up, for datapoints that arrive late
+
+    :type windows_per_read: int
+    :param windows_per_read: the most rollup windows aggregated by one query
+
+    :type checkpoint_interval: float
+    :param checkpoint_interval: the least seconds between writes of the checkpoint file during a run
+
+    A run aggregates the windows of each rollup that have completed
+    since the checkpoint, and then deletes raw datapoints older than
+    the highest resolution's retention (but not any that haven't been
+    rolled up yet) and rollup datapoints older than their own retention.
+
+    Every metric's checkpoint is updated in memory after each step, and
+    the file, which holds all of them, is written at most every
+    checkpoint_interval seconds and at the end of each run.  A process
+    that dies part way through a run redoes at most that much work.
+    """
+
+    def __init__(self, conn, storage_schemas, checkpoint_file=None, workers=4, aggregator="avg",
+                 settle=60, windows_per_read=1000, checkpoint_interval=10):
+        self.conn = conn
+        self.matcher = graphite.SchemaMatcher(storage_schemas)
+        self.checkpoint_file = checkpoint_file
+        self.workers = workers
+        self.aggregator = aggregator
+        self.settle = settle
+        self.windows_per_read = windows_per_read
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoints = dict()
+        if checkpoint_file is not None and os.path.exists(checkpoint_file):
+            with open(checkpoint_file) as f:
+                self.checkpoints = json.load(f)
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock() # held while the file is written, so _lock isn't
+        self._changed = False
+        self._last_write = time.time()
+        self._stop = threading.Event()
+
+    def archives(self, name):
+        """
+        :rtype: list
+        :return: per parse_retentions(), for the schema that matches name, or an empty list
+        """
+        schema = self.matcher.schema(name)
+        if schema is None:
+            return []
+        return parse_retentions(schema.options["retentions"])
+
+    def _checkpoint(self, name):
+        with self._lock:
+            return json.loads(json.dumps(self.checkpoints.get(name, {"rolled" : {}, "deleted" : {}})))
+
+    def _save(self, name, checkpoint):
+        with self._lock:
+            # a copy, as the caller carries on changing its own
+            self.checkpoints[name] = {"rolled" : dict(checkpoint["rolled"]), "deleted" : dict(checkpoint["deleted"])}
+            self._changed = True
+            due = time.time() - self._last_write >= self.checkpoint_interval
+        if due:
+            self.write_checkpoints()
+
+    def write_checkpoints(self):
+        """
+        Write every metric's checkpoint to the checkpoint_file, if any
+        have changed since it was last written.
+        """
+        if self.checkpoint_file is None:
+            return
+        with self._write_lock:
+            with self._lock:
+                if not self._changed:
+                    return
+                content = json.dumps(self.checkpoints)
+                self._changed = False
+                self._last_write = time.time()
+            try:
+                temporary = self.checkpoint_file + ".tmp"
+                with open(temporary, "w") as f:
+                    f.write(content)
+                os.rename(temporary, self.checkpoint_file)
+            except Exception:
+                with self._lock:
+                    self._changed = True
+                raise
+
+    def _aggregate(self, name, resolution, start, end):
+        """The aggregated values of name in [start, end), which are both multiples of resolution"""
+        return _read_sampled(self.conn, name, self.aggregator, resolution, start, end)
+
+    def _delete(self, name, start, end):
+        r = deleter.delete_datapoints(self.conn, [name], start, end - 0.001)
+        if r.status_code != 204:
+            raise requests.HTTPError("deleting {0} from {1} to {2} failed. Status code: {3}".format(
+                name, start, end, r.status_code), response=r)
+
+    def process_metric(self, name, now=None):
+        """
+        :type name: str
+        :param name: a raw graphite metric
+
+        :rtype: dict
+        :return: rollup_points (how many were written) and deletes (how many delete requests were made)
+
+        Bring the metric's rollups up to date and enforce its retentions.
+        The checkpoint is updated after each step, so a failure part way
+        through loses nothing that was done.  It's only sure to be in the
+        checkpoint_file after run_once() or write_checkpoints().
+        """
+        if now is None:
+            now = time.time()
+        archives = self.archives(name)
+        done = {"rollup_points" : 0, "deletes" : 0}
+        if not archives:
+            return done
+        checkpoint = self._checkpoint(name)
+        raw_retention = archives[0][1]
+
+        for resolution, retention, tag in archives[1:]:
+            key = str(resolution)
+            complete = int((now - self.settle) // resolution * resolution)
+            start = checkpoint["rolled"].get(key)
+            if start is None:
+                start = int((now - retention) // resolution * resolution)
+            while start < complete:
+                end = min(complete, start + resolution * self.windows_per_read)
+                values = self._aggregate(name, resolution, start, end)
+                if values:
+                    series = rollup_name(name, resolution)
+                    tags = {graphite.RETENTION_TAG : tag, ROLLUP_TAG : self.aggregator}
+                    r = self.conn.write_metrics([ {"name" : series, "timestamp" : t, "value" : v, "tags" : tags}
+                                                  for t, v in values ])
+                    if r.status_code != 204:
+                        raise requests.HTTPError("writing {0} failed. Status code: {1}".format(series, r.status_code),
+                                                 response=r)
+                    done["rollup_points"] += len(values)
+                checkpoint["rolled"][key] = start = end
+                self._save(name, checkpoint)
+
+        # the raw datapoints can go once they're past their retention and every rollup has them
+        raw_cutoff = now - raw_retention
+        for resolution, retention, tag in archives[1:]:
+            raw_cutoff = min(raw_cutoff, checkpoint["rolled"].get(str(resolution), 0))
+        expired = [(name, raw_cutoff)] + [ (rollup_name(name, resolution), now - retention)
+                                          for resolution, retention, tag in archives[1:] ]
+        for series, cutoff in expired:
+            deleted = checkpoint["deleted"].get(series, 0)
+            if cutoff > deleted:
+                self._delete(series, deleted, cutoff)
+                done["deletes"] += 1
+                checkpoint["deleted"][series] = cutoff
+                self._save(name, checkpoint)
+        return done
+
+    def run_once(self, names=None, now=None):
+        """
+        :type names: list
+        :param names: the raw metrics to process.  None for every metric on the server except the rollups.
+
+        :type now: float
+        :param now: the time to bring the rollups up to, default time.time()
+
+        :rtype: dict
+        :return: metrics (how many were processed), rollup_points, deletes, and failed (metric name to
+            the error it failed with).  A metric that failed carries on from its checkpoint next time.
+        """
+        if names is None:
+            names = [ n for n in metadata.get_all_metric_names(self.conn) if not graphite.is_rollup_name(n) ]
+        if now is None:
+            now = time.time()
+        summary = {"metrics" : 0, "rollup_points" : 0, "deletes" : 0, "failed" : {}}
+
+        def process(name):
+            try:
+                return name, self.process_metric(name, now), None
+            except (requests.RequestException, ValueError), e:
+                LOG.warning("Rolling up %s failed: %s", name, e)
+                return name, None, e
+
+        pool = ThreadPool(self.workers)
+        try:
+            for name, done, error in pool.imap_unordered(process, names):
+                summary["metrics"] += 1
+                if error is not None:
+                    summary["failed"][name] = repr(error)
+                    continue
+                summary["rollup_points"] += done["rollup_points"]
+                summary["deletes"] += done["deletes"]
+        finally:
+            pool.terminate()
+            pool.join()
+            self.write_checkpoints()
+        return summary
+
+    def run(self, interval=300):
+        """
+        Call run_once() every interval seconds until stop() is called.
+        """
+        while not self._stop.is_set():
+            summary = self.run_once()
+            LOG.info("Rolled up %(metrics)d metrics: %(rollup_points)d rollup points, %(deletes)d deletes", summary)
+            self._stop.wait(interval)
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,223 @@
+# -*- python -*-
+
+"""
+An inverted index of tags, built from the results of tags queries
+(read_relative/read_absolute with only_read_tags=True), for answering
+"which series have these tags" without asking KairosDB again.
+
+The index maps every (tag key, tag value) pair to the entries of the
+results that have it::
+
+    index = TagIndex.build(conn, ["cpu.user", "cpu.system"], (1, "days"))
+    index.select({"host" : ["web01", "web02"], "dc" : "east"})
+    index.values("host")
+
+An entry is one result of the content: a metric name and the tag values
+that came back with it.  A tags query without a group_by, which is what
+build() and refresh() make, has one result per metric, holding every
+value of every tag across all of the metric's series.  So an index
+built that way is of metrics, not series: select() with match_all
+finds the metrics that have a series with each of the tags, not
+necessarily one series with all of them, e.g. {"host" : "web01", "dc" :
+"east"} matches a metric whose web01 series are all in "west" if
+another of its series is in "east".  Content from a data query grouped
+by tag (reader.group_by() with {"name" : "tag", "tags" : [...]}) has a
+result per combination of the grouped tags, and add_content() indexes
+each of those as its own entry.
+
+Whether matching ignores case is decided when the index is created,
+so the keys and values are folded once as they're indexed rather than
+on every lookup.
+"""
+
+import threading
+from collections import defaultdict
+
+from . import reader
+
+
+class TagIndex(object):
+    """
+    :type case_sensitive: bool
+    :param case_sensitive: whether "Host"/"host" and "Web01"/"web01" are different tags
+
+    Entries ("series" below) are returned as (metric_name, tags) tuples,
+    where tags is a frozenset of (key, value) pairs as they were returned
+    by KairosDB, without any case folding.  From a tags query, there's
+    one per metric, see above.
+    """
+
+    def __init__(self, case_sensitive=True):
+        self.case_sensitive = case_sensitive
+        self._lock = threading.Lock()
+        self._postings = defaultdict(set) # (key, value) -> set of series
+        self._by_name = defaultdict(set)  # metric name -> set of series
+        self._values = defaultdict(lambda: defaultdict(int)) # key -> original value -> number of series
+
+    @classmethod
+    def build(cls, conn, metric_names, start_time, end_time=None, case_sensitive=True, tags=None):
+        """
+        :type conn: KairosDBConnection
+        :param conn: the connection to query
+
+        :type metric_names: list
+        :param metric_names: the metrics whose tags will be indexed
+
+        :type start_time: tuple
+        :param start_time: a relative start time, per reader.read_relative()
+
+        :type end_time: tuple
+        :param end_time: a relative end time, per reader.read_relative()
+
+        :type case_sensitive: bool
+        :param case_sensitive: per TagIndex
+
+        :type tags: dict
+        :param tags: only index series that have these tags, per reader.read()
+
+        :rtype: TagIndex
+        :return: an index of the tags of all of the metrics
+        """
+        index = cls(case_sensitive)
+        index.refresh(conn, metric_names, start_time, end_time, tags=tags)
+        return index
+
+    def _fold(self, s):
+        if self.case_sensitive:
+            return s
+        return s.lower()
+
+    def add_content(self, content):
+        """
+        :type content: dict
+        :param content: content returned from a tags query (or a data query, the values are ignored)
+
+        Index every result in the content.  Any series that were indexed
+        before for the metric names in the content are replaced, so this
+        is also how the index is refreshed.
+        """
+        series_by_name = defaultdict(set)
+        for q in content["queries"]:
+            for r in q["results"]:
+                pairs = frozenset((k, v) for k, values in r["tags"].items() for v in values)
+                series_by_name[r["name"]].add((r["name"], pairs))
+        with self._lock:
+            for name, series in series_by_name.items():
+                self._remove_name(name)
+                self._by_name[name] = series
+                for s in series:
+                    for k, v in s[1]:
+                        self._postings[(self._fold(k), self._fold(v))].add(s)
+                        self._values[self._fold(k)][v] += 1
+
+    def _remove_name(self, name):
+        for s in self._by_name.pop(name, ()):
+            for k, v in s[1]:
+                folded = (self._fold(k), self._fold(v))
+                posting = self._postings[folded]
+                posting.discard(s)
+                if not posting:
+                    del self._postings[folded]
+                values = self._values[folded[0]]
+                values[v] -= 1
+                if values[v] == 0:
+                    del values[v]
+                    if not values:
+                        del self._values[folded[0]]
+
+    def remove(self, metric_names):
+        """
+        :type metric_names: list
+        :param metric_names: metric names whose series will be dropped from the index
+        """
+        with self._lock:
+            for name in metric_names:
+                self._remove_name(name)
+
+    def refresh(self, conn, metric_names, start_time, end_time=None, tags=None):
+        """
+        :type conn: KairosDBConnection
+        :param conn: the connection to query
+
+        :type metric_names: list
+        :param metric_names: the metrics whose tags will be re-read.  Other metrics in the index are left alone.
+
+        :type start_time: tuple
+        :param start_time: a relative start time, per reader.read_relative()
+
+        :type end_time: tuple
+        :param end_time: a relative end time, per reader.read_relative()
+
+        :type tags: dict
+        :param tags: only index series that have these tags, per reader.read()
+
+        Re-read the tags of some metrics.  Metrics that have no data in
+        the time range are removed from the index.
+        """
+        content = reader.read_relative(conn, metric_names, start_time, end_time,
+                                       only_read_tags=True, tags=tags)
+        self.remove(metric_names)
+        self.add_content(content)
+
+    def series_with(self, key, value):
+        """
+        :rtype: frozenset
+        :return: the series that have the tag key=value
+        """
+        with self._lock:
+            return frozenset(self._postings.get((self._fold(key), self._fold(value)), ()))
+
+    def select(self, tags, match_all=True):
+        """
+        :type tags: dict
+        :param tags: tag key to a value or a list of values.  A series matches a key if it has
+            any of the values for it.
+
+        :type match_all: bool
+        :param match_all: if True, a series must match every key (intersection), otherwise
+            matching any key is enough (union).  For an index of a tags query's results, that's
+            a metric that has each of the tags, not necessarily on the same series.
+
+        :rtype: frozenset
+        :return: the series that match
+        """
+        result = None
+        with self._lock:
+            # smallest first, so an intersection shrinks as quickly as possible
+            per_key = list()
+            for key, values in tags.items():
+                if isinstance(values, basestring):
+                    values = [values]
+                matched = set()
+                for v in values:
+                    matched.update(self._postings.get((self._fold(key), self._fold(v)), ()))
+                per_key.append(matched)
+            per_key.sort(key=len)
+            for matched in per_key:
+                if result is None:
+                    result = matched
+                elif match_all:
+                    result = result & matched
+                    if not result:
+                        break
+                else:
+                    result = result | matched
+        return frozenset(result or ())
+
+    def names(self, series):
+        """
+        :type series: iterable
+        :param series: series as returned by select() or series_with()
+
+        :rtype: list
+        :return: the sorted, distinct metric names of the series
+        """
+        return sorted(set(s[0] for s in series))
+
+    def values(self, key):
+        """
+        :rtype: list
+        :return: the sorted values that the tag key has, across every indexed series
+        """
+        with self._lock:
+            return sorted(self._values.get(self._fold(key), {}).keys())
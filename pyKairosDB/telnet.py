@@ -0,0 +1,303 @@
+# -*- python -*-
+
+"""
+Writing to KairosDB's telnet interface, which takes one datapoint per
+line::
+
+    put <metric name> <timestamp in ms> <value> <tag>=<value> [<tag>=<value> ...]
+
+The protocol only writes, and the server doesn't answer a put, so lines
+are streamed back-to-back on a socket without waiting for anything.
+That makes it much cheaper per datapoint than the REST API.
+
+A TelnetTransport keeps a pool of persistent sockets.  It can be given
+to a connection, and then write_metrics() uses it instead of posting
+JSON::
+
+    conn = pyKairosDB.connect("kairosdb", "8080", write_transport=telnet.TelnetTransport("kairosdb"))
+    conn.write_metrics(metric_list)
+
+Since nothing is acknowledged, a write that returns has only been
+handed to the operating system.  With confirm=True, each send is
+followed by a "version" command, and it waits for the answer, which
+the server only sends after it has handled every line before it.
+"""
+
+import logging
+import re
+import select
+import socket
+import threading
+import time
+
+import requests
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_PORT = 4242
+
+_WHITESPACE = re.compile(r"\s")
+_NOT_SPACE_WHITESPACE = re.compile(r"[\t\n\r\f\v]")
+
+
+class TelnetError(requests.ConnectionError):
+    """Datapoints couldn't be sent to the telnet interface"""
+
+
+class TelnetResult(object):
+    """
+    What a write through a TelnetTransport returns.  It has the
+    status_code and content of the requests.Response returned by an HTTP
+    write, so code that checks for a 204 works with either.
+    """
+
+    status_code = 204
+    content = ""
+
+    def __init__(self, lines, bytes_sent):
+        self.lines = lines
+        self.bytes_sent = bytes_sent
+
+
+def _tag_string(name, tags):
+    if not tags:
+        raise ValueError("KairosDB won't store {0} without at least one tag".format(name))
+    tag_string = " ".join("%s=%s" % kv for kv in tags.iteritems())
+    if (tag_string.count(" ") != len(tags) - 1 or tag_string.count("=") != len(tags)
+            or _NOT_SPACE_WHITESPACE.search(tag_string)):
+        raise ValueError("Tags can't contain whitespace, or '=' in their names or values: {0} {1}".format(name, tags))
+    return tag_string
+
+def encode_lines(metric_list, command="put"):
+    """
+    :type metric_list: list
+    :param metric_list: list of dicts, per writer.write_metrics_list().  Unlike an HTTP write,
+        the timestamps are not changed in place.
+
+    :type command: str
+    :param command: "put", or "putm" for servers that only take milliseconds from putm
+
+    :rtype: str
+    :return: one line per metric
+
+    :raises: ValueError if a metric has no tags, whitespace in its name or tags, or '=' in its tags
+
+    A batch usually repeats the same few names and tag sets many times,
+    so each is checked and formatted once per batch.
+    """
+    tag_strings = dict()
+    names = set()
+    lines = list()
+    append = lines.append
+    command = command + " "
+    for m in metric_list:
+        name = m["name"]
+        tags = m["tags"]
+        key = tuple(tags.iteritems())
+        tag_string = tag_strings.get(key)
+        if tag_string is None:
+            tag_string = tag_strings[key] = _tag_string(name, tags)
+        if name not in names:
+            if _WHITESPACE.search(name):
+                raise ValueError("Metric names can't contain whitespace: {0!r}".format(name))
+            names.add(name)
+        value = m["value"]
+        if type(value) is float:
+            value = repr(value) # %s would round to 12 digits
+        append("%s%s %d %s %s\n" % (command, name, m["timestamp"] * 1000, value, tag_string))
+    return "".join(lines)
+
+
+class TelnetTransport(object):
+    """
+    :type host: str
+    :param host: the KairosDB server
+
+    :type port: int
+    :param port: its telnet port
+
+    :type pool_size: int
+    :param pool_size: the most sockets that are open at once.  Sends beyond that wait for a socket to be free.
+
+    :type connect_timeout: float
+    :param connect_timeout: seconds to wait to connect, unless a deadline is given
+
+    :type send_timeout: float
+    :param send_timeout: seconds a send may block, unless a deadline is given
+
+    :type retries: int
+    :param retries: how many times a send that fails is tried again on a new socket
+
+    :type backoff: float
+    :param backoff: the delay before the first retry, which doubles with each one
+
+    :type command: str
+    :param command: per encode_lines()
+
+    :type confirm: bool
+    :param confirm: whether every send waits for the server to have handled it
+
+    A send that fails part way through is sent again whole, so some
+    datapoints may be written twice, which KairosDB treats as an
+    overwrite.  The counters in stats are lines, bytes, connects and
+    reconnects.
+    """
+
+    def __init__(self, host, port=DEFAULT_PORT, pool_size=4, connect_timeout=3.05, send_timeout=30,
+                 retries=2, backoff=0.1, command="put", confirm=False):
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.send_timeout = send_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.command = command
+        self.confirm = confirm
+        self.stats = {"lines" : 0, "bytes" : 0, "connects" : 0, "reconnects" : 0}
+        self._idle = list()
+        self._closed = False
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    def encode(self, metric_list):
+        """
+        :rtype: str
+        :return: the lines for the metrics, per encode_lines()
+        """
+        return encode_lines(metric_list, self.command)
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.stats[name] += n
+
+    def _usable(self, sock):
+        """Whether an idle socket is still connected.  The server only sends on an idle socket to close it, or to complain."""
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return True
+        try:
+            data = sock.recv(4096)
+        except socket.error:
+            return False
+        if not data:
+            return False
+        LOG.warning("KairosDB telnet %s:%s said: %s", self.host, self.port, data.strip())
+        return True
+
+    def _checkout(self, connect_timeout):
+        with self._lock:
+            while self._idle:
+                sock = self._idle.pop()
+                if self._usable(sock):
+                    return sock
+                sock.close()
+        sock = socket.create_connection((self.host, self.port), connect_timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._count("connects")
+        return sock
+
+    def _checkin(self, sock):
+        with self._lock:
+            if not self._closed:
+                self._idle.append(sock)
+                return
+        sock.close()
+
+    def _wait_for_version(self, sock):
+        sock.sendall("version\n")
+        answer = ""
+        while not answer.endswith("\n"):
+            data = sock.recv(4096)
+            if not data:
+                raise socket.error("The connection was closed before the server answered")
+            answer += data
+        return answer
+
+    def send(self, data, lines=0, deadline=None, confirm=None):
+        """
+        :type data: str
+        :param data: lines, per encode()
+
+        :type lines: int
+        :param lines: how many lines there are, for the stats
+
+        :type deadline: transport.Deadline
+        :param deadline: if given, its connect and read timeouts are used instead of this transport's
+
+        :type confirm: bool
+        :param confirm: whether to wait for the server to have handled the lines.  None for this transport's default.
+
+        :rtype: TelnetResult
+        :return: what was sent
+
+        :raises: TelnetError if it couldn't be sent after the retries
+        """
+        if confirm is None:
+            confirm = self.confirm
+        self._slots.acquire()
+        try:
+            attempt = 0
+            while True:
+                connect_timeout, send_timeout = self.connect_timeout, self.send_timeout
+                if deadline is not None:
+                    connect_timeout, send_timeout = deadline.timeout()
+                sock = None
+                try:
+                    sock = self._checkout(connect_timeout)
+                    sock.settimeout(send_timeout)
+                    sock.sendall(data)
+                    if confirm:
+                        self._wait_for_version(sock)
+                except socket.error, e:
+                    if sock is not None:
+                        sock.close()
+                    if attempt >= self.retries:
+                        raise TelnetError("sending to {0}:{1} failed after {2} attempts: {3}".format(
+                            self.host, self.port, attempt + 1, e))
+                    time.sleep(self.backoff * 2 ** attempt)
+                    attempt += 1
+                    self._count("reconnects")
+                    continue
+                self._checkin(sock)
+                break
+        finally:
+            self._slots.release()
+        with self._lock:
+            self.stats["lines"] += lines
+            self.stats["bytes"] += len(data)
+        return TelnetResult(lines, len(data))
+
+    def write_metrics(self, metric_list, deadline=None):
+        """
+        :type metric_list: list
+        :param metric_list: list of dicts, per writer.write_metrics_list()
+
+        :rtype: TelnetResult
+        :return: what was sent
+        """
+        return self.send(self.encode(metric_list), len(metric_list), deadline)
+
+    def sync(self):
+        """
+        Wait until the server has handled every line sent on the idle
+        sockets, i.e. everything sent by sends that have returned.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, list()
+        for sock in idle:
+            try:
+                self._wait_for_version(sock)
+            except socket.error, e:
+                sock.close()
+                raise TelnetError("waiting for {0}:{1} failed: {2}".format(self.host, self.port, e))
+            self._checkin(sock)
+
+    def close(self):
+        """
+        Close the idle sockets.  Sockets in use are closed when their sends finish.
+        """
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, list()
+        for sock in idle:
+            sock.close()
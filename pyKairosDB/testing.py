@@ -0,0 +1,354 @@
+# -*- python -*-
+
+"""
+A stand-in for a KairosDB server that runs in-process, for tests and
+benchmarks that shouldn't need a real KairosDB and Cassandra.
+
+It answers the parts of the REST API that this library uses, and
+keeps what's written to it in memory::
+
+    server = StandInKairosDB()
+    server.start()
+    conn = pyKairosDB.connect("127.0.0.1", str(server.port))
+    ...
+    server.stop()
+
+It's not meant to be fast, or to be complete, only to be good enough
+that the network and the HTTP handling are real.
+
+Given a telnet_port, it also takes put lines on that port, and the
+datapoints are stored with the ones written over HTTP.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import json
+import socket
+import sys
+import threading
+import time
+import urllib
+from collections import defaultdict
+
+VERSION = "KairosDB 0.9.4-6.20140730155819"
+
+UNIT_MILLISECONDS = {"milliseconds" : 1, "seconds" : 1000, "minutes" : 60 * 1000,
+                     "hours" : 3600 * 1000, "days" : 86400 * 1000, "weeks" : 7 * 86400 * 1000,
+                     "months" : 30 * 86400 * 1000, "years" : 365 * 86400 * 1000}
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], socket.error):
+            return # the client gave up waiting for a slow answer and closed the connection
+        BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+class _StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive, the way KairosDB's jetty does it
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.getheader('content-length', 0))
+        body = self.rfile.read(length)
+        self.server.stand_in.bytes_received += length
+        return body
+
+    def _respond(self, status, content=None):
+        if content is None:
+            body = ""
+        else:
+            body = json.dumps(content)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _dispatch(self, method):
+        stand_in = self.server.stand_in
+        stand_in.request_counts[(method, self.path)] += 1
+        if stand_in.latency:
+            time.sleep(stand_in.latency)
+        handler = getattr(stand_in, "_{0}".format(method.lower()))
+        body = None
+        if method in ("POST",):
+            body = self._read_body()
+        if (method, self.path) in stand_in.failures:
+            status, content = stand_in.failures[(method, self.path)], {"errors": ["Injected failure"]}
+        else:
+            status, content = handler(self.path, body)
+        self._respond(status, content)
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+
+class _ThreadingTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], socket.error):
+            return # the connection was dropped
+        SocketServer.TCPServer.handle_error(self, request, client_address)
+
+
+class _StandInTelnetHandler(SocketServer.StreamRequestHandler):
+    """Handles put, putm and version.  Datapoints are stored in batches, and before answering version."""
+
+    def handle(self):
+        stand_in = self.server.stand_in
+        with stand_in.lock:
+            stand_in.telnet_connections.append(self.connection)
+        batch = list()
+        received = 0
+        try:
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                received += len(line)
+                parts = line.split()
+                if parts and parts[0] in ("put", "putm") and len(parts) >= 5:
+                    value = parts[3]
+                    try:
+                        value = int(value)
+                    except ValueError:
+                        value = float(value)
+                    batch.append((parts[1], [int(parts[2]), value, dict(t.split("=", 1) for t in parts[4:])]))
+                if len(batch) >= 1000 or (parts and parts[0] == "version"):
+                    stand_in._store(batch, received)
+                    batch, received = list(), 0
+                if parts and parts[0] == "version":
+                    self.wfile.write(VERSION + "\n")
+                    self.wfile.flush()
+        except IOError:
+            return # the client went away
+        finally:
+            stand_in._store(batch, received)
+            with stand_in.lock:
+                stand_in.telnet_connections.remove(self.connection)
+
+
+class StandInKairosDB(object):
+    """
+    :type host: str
+    :param host: the address to listen on
+
+    :type port: int
+    :param port: the port to listen on.  0 picks a free port, which can be read from the port attribute after start()
+
+    :type latency: float
+    :param latency: seconds to sleep before answering every request, to imitate a remote server
+
+    :type telnet_port: int
+    :param telnet_port: if given, the port to take telnet put lines on.  0 picks a free port.
+
+    Datapoints that are written are kept in the datapoints attribute, a
+    dict of metric name to a list of [timestamp_ms, value, tags].
+
+    The bodies of datapoint delete requests are kept in deletes.
+
+    Requests whose (method, path) is in the failures dict are answered
+    with the status code it maps to, to test how errors are handled.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0, telnet_port=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.datapoints = defaultdict(list)
+        self.points_received = 0
+        self.bytes_received = 0
+        self.request_counts = defaultdict(int)
+        self.failures = dict()
+        self.deletes = list()
+        self.telnet_port = telnet_port
+        self.telnet_connections = list()
+        self._server = None
+        self._telnet_server = None
+
+    def start(self):
+        self._server = _ThreadingHTTPServer((self.host, self.port), _StandInHandler)
+        self._server.stand_in = self
+        self.port = self._server.server_address[1]
+        servers = [self._server]
+        if self.telnet_port is not None:
+            self._telnet_server = _ThreadingTCPServer((self.host, self.telnet_port), _StandInTelnetHandler)
+            self._telnet_server.stand_in = self
+            self.telnet_port = self._telnet_server.server_address[1]
+            servers.append(self._telnet_server)
+        for server in servers:
+            t = threading.Thread(target=server.serve_forever)
+            t.daemon = True
+            t.start()
+        return self
+
+    def stop(self):
+        for server in (self._server, self._telnet_server):
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+        self._server = self._telnet_server = None
+        self.drop_telnet_connections()
+
+    def drop_telnet_connections(self):
+        """Close every open telnet connection, the way a restarting server would"""
+        with self.lock:
+            connections = list(self.telnet_connections)
+        for c in connections:
+            try:
+                c.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def _store(self, batch, bytes_received):
+        with self.lock:
+            for name, point in batch:
+                self.datapoints[name].append(point)
+            self.points_received += len(batch)
+            self.bytes_received += bytes_received
+
+    def _get(self, path, body):
+        if path == "/api/v1/version":
+            return 200, {"version": VERSION}
+        if path == "/api/v1/metricnames":
+            with self.lock:
+                return 200, {"results": sorted(self.datapoints.keys())}
+        if path in ("/api/v1/tagnames", "/api/v1/tagvalues"):
+            results = set()
+            with self.lock:
+                for points in self.datapoints.values():
+                    for p in points:
+                        if path.endswith("names"):
+                            results.update(p[2].keys())
+                        else:
+                            results.update(p[2].values())
+            return 200, {"results": sorted(results)}
+        return 404, {"errors": ["Not found: {0}".format(path)]}
+
+    def _post(self, path, body):
+        if path == "/api/v1/datapoints":
+            try:
+                metrics = json.loads(body)
+            except ValueError, e:
+                return 400, {"errors": [str(e)]}
+            with self.lock:
+                for m in metrics:
+                    self.datapoints[m["name"]].append([m["timestamp"], m["value"], m.get("tags", {})])
+                self.points_received += len(metrics)
+            return 204, None
+        if path in ("/api/v1/datapoints/query", "/api/v1/datapoints/query/tags"):
+            query = json.loads(body)
+            self._resolve_relative(query)
+            with self.lock:
+                queries = [ self._query_metric(query, metric, only_tags=path.endswith("/tags"))
+                            for metric in query["metrics"] ]
+            return 200, {"queries": queries}
+        if path == "/api/v1/datapoints/delete":
+            query = json.loads(body)
+            with self.lock:
+                for metric in query["metrics"]:
+                    keep = [ p for p in self.datapoints.get(metric["name"], [])
+                             if not self._selected(p, query, metric) ]
+                    if keep:
+                        self.datapoints[metric["name"]] = keep
+                    else:
+                        self.datapoints.pop(metric["name"], None)
+            self.deletes.append(query)
+            return 204, None
+        return 404, {"errors": ["Not found: {0}".format(path)]}
+
+    @staticmethod
+    def _resolve_relative(query):
+        """Turn start_relative/end_relative into absolute milliseconds"""
+        now = int(time.time() * 1000)
+        for edge in ("start", "end"):
+            relative = query.pop(edge + "_relative", None)
+            if relative is not None:
+                query[edge + "_absolute"] = now - int(float(relative["value"]) * UNIT_MILLISECONDS[relative["unit"]])
+
+    def _query_metric(self, query, metric, only_tags=False):
+        points = sorted([ p for p in self.datapoints.get(metric["name"], [])
+                          if self._selected(p, query, metric) ], key=lambda p: p[0])
+        tags = defaultdict(set)
+        for p in points:
+            for k, v in p[2].items():
+                tags[k].add(v)
+        values = [ [p[0], p[1]] for p in points ]
+        if metric.get("order") == "desc":
+            values.reverse()
+        if metric.get("limit") is not None:
+            values = values[:int(metric["limit"])]
+        for aggregator in metric.get("aggregators", []):
+            values = self._aggregate(values, aggregator, query.get("start_absolute"))
+        result = {"name": metric["name"],
+                  "tags": dict((k, sorted(vs)) for k, vs in tags.items()),
+                  "values": [] if only_tags else values}
+        if not points:
+            result["tags"] = {}
+        return {"sample_size": len(points), "results": [result]}
+
+    @staticmethod
+    def _aggregate(values, aggregator, start):
+        """
+        Apply a range aggregator the way KairosDB does: the ranges are
+        sampling long from the query's start (or from a multiple of the
+        sampling with align_sampling), and each is timestamped with its
+        first datapoint, or its start with align_start_time.
+        """
+        if not values:
+            return values
+        sampling = aggregator["sampling"]
+        size = int(float(sampling["value"]) * UNIT_MILLISECONDS[sampling["unit"]])
+        if start is None:
+            start = values[0][0]
+        if aggregator.get("align_sampling"):
+            start -= start % size
+        ranges = list()
+        for t, v in values:
+            begin = start + (t - start) // size * size
+            if not ranges or ranges[-1][0] != begin:
+                ranges.append((begin, list()))
+            ranges[-1][1].append((t, v))
+        combine = {"avg" : lambda vs: float(sum(vs)) / len(vs), "sum" : sum, "min" : min, "max" : max,
+                   "count" : len, "first" : lambda vs: vs[0], "last" : lambda vs: vs[-1]}[aggregator["name"]]
+        return [ [begin if aggregator.get("align_start_time") else points[0][0], combine([v for t, v in points])]
+                 for begin, points in ranges ]
+
+    @staticmethod
+    def _selected(point, query, metric):
+        """Whether a stored [timestamp, value, tags] is in the range and has the tags of the query"""
+        if point[0] < query.get("start_absolute", 0):
+            return False
+        if "end_absolute" in query and point[0] > query["end_absolute"]:
+            return False
+        for key, values in metric.get("tags", {}).items():
+            if not isinstance(values, list):
+                values = [values]
+            if str(point[2].get(key)) not in [str(v) for v in values]:
+                return False
+        return True
+
+    def _delete(self, path, body):
+        prefix = "/api/v1/metric/"
+        if path.startswith(prefix):
+            with self.lock:
+                self.datapoints.pop(urllib.unquote(path[len(prefix):]), None)
+            return 204, None
+        return 404, {"errors": ["Not found: {0}".format(path)]}
@@ -0,0 +1,71 @@
+# -*- python -*-
+
+import time
+import unittest
+
+import pyKairosDB
+from pyKairosDB import aggregator
+from pyKairosDB.testing import StandInKairosDB
+
+
+class TestAggregator(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInKairosDB().start()
+        self.conn = pyKairosDB.connect("127.0.0.1", str(self.server.port))
+        self.agg = aggregator.Aggregator(self.conn, interval=0.05, tags={"host" : "a"}, reservoir_size=100)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def by_name(self, metrics):
+        return dict((m["name"], m) for m in metrics)
+
+    def test_kinds(self):
+        start = time.time()
+        for n in range(1000):
+            self.agg.increment("requests")
+            self.agg.timing("latency", n)
+            self.agg.set("users", n % 7)
+            self.agg.gauge("depth", n)
+        self.agg.increment("requests", 5, tags={"code" : "500"}, sample_rate=0.5)
+        raw = self.agg.metrics(now=start + 10)
+        self.assertEqual(len(raw), 14) # two requests series, the gauge, the set and the timer's 8
+        self.assertEqual(self.agg.metrics(), []) # nothing left for the next interval
+        metrics = self.by_name(raw)
+        self.assertEqual(metrics["depth"]["value"], 999)
+        self.assertEqual(metrics["users.count"]["value"], 7)
+        self.assertEqual((metrics["latency.count"]["value"], metrics["latency.sum"]["value"]), (1000, 499500))
+        self.assertEqual((metrics["latency.min"]["value"], metrics["latency.max"]["value"]), (0, 999))
+        self.assertEqual(metrics["latency.mean"]["value"], 499.5)
+        self.assertTrue(300 < metrics["latency.p50"]["value"] < 700) # from a sample of 100
+        self.assertTrue(metrics["latency.p99"]["value"] > 800)
+        self.assertEqual(metrics["depth"]["tags"], {"host" : "a"})
+
+    def test_counters_by_tags(self):
+        self.agg.increment("requests", tags={"code" : "200"})
+        self.agg.increment("requests", 5, tags={"code" : "500"}, sample_rate=0.5)
+        counts = dict((m["tags"]["code"], m["value"]) for m in self.agg.metrics()
+                      if m["name"] == "requests.count")
+        self.assertEqual(counts, {"200" : 1, "500" : 10})
+
+    def test_bounded_reservoir(self):
+        for n in range(10000):
+            self.agg.timing("t", n)
+        self.assertEqual(len(self.agg._timers.values()[0].sample), 100)
+
+    def test_flushes_in_background(self):
+        self.agg.start()
+        with self.agg.timer("work"):
+            time.sleep(0.01)
+        for n in range(500):
+            self.agg.increment("hits")
+        time.sleep(0.2)
+        self.agg.stop()
+        self.assertEqual(sum(p[1] for p in self.server.datapoints["hits.count"]), 500)
+        self.assertTrue(self.server.datapoints["work.max"][0][1] >= 0.01)
+        self.assertEqual(self.agg.stats["observations"], 501)
+        self.assertEqual(self.agg.stats["write_errors"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
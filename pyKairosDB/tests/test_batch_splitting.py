@@ -0,0 +1,87 @@
+# -*- python -*-
+
+import json
+import time
+import unittest
+
+import requests
+
+import pyKairosDB
+from pyKairosDB import transport
+from pyKairosDB import writer
+from pyKairosDB.testing import StandInKairosDB
+
+
+def metrics(n, name="m"):
+    now = time.time()
+    return [{"name" : name, "timestamp" : now - i, "value" : i, "tags" : {"host" : "a"}} for i in range(n)]
+
+
+class TestEncodeMetricsBatches(unittest.TestCase):
+    def test_limits(self):
+        original = metrics(2500)
+        batches = writer.encode_metrics_batches([dict(m) for m in original], max_bytes=20000, max_points=300)
+        self.assertTrue(all(len(body) <= 20000 and points <= 300 for body, points in batches))
+        decoded = sum((json.loads(body) for body, points in batches), [])
+        self.assertEqual([m["value"] for m in decoded], range(2500))
+        self.assertEqual([len(json.loads(body)) for body, points in batches], [points for body, points in batches])
+        self.assertEqual(decoded[0]["timestamp"], int(original[0]["timestamp"] * 1000))
+
+    def test_unsplit(self):
+        batches = writer.encode_metrics_batches(metrics(2500))
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(len(json.loads(batches[0][0])), 2500)
+        self.assertEqual(writer.encode_metrics_batches([]), [("[]", 0)])
+
+    def test_oversized_metric(self):
+        big = metrics(3)
+        big[1]["tags"]["note"] = "x" * 500
+        batches = writer.encode_metrics_batches(big, max_bytes=200)
+        self.assertEqual([points for body, points in batches], [1, 1, 1])
+
+
+class TestSplitWrites(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInKairosDB().start()
+        self.conn = pyKairosDB.connect("127.0.0.1", str(self.server.port), max_request_points=1000)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_split(self):
+        r = self.conn.write_metrics(metrics(3500))
+        self.assertEqual(r.status_code, 204)
+        self.assertEqual((r.batches, r.points, r.failed_points), (4, 3500, 0))
+        self.assertEqual(self.server.points_received, 3500)
+        self.assertEqual(r.request_bytes, self.server.bytes_received)
+        write = self.conn.instrumentation.snapshot()["write"]
+        self.assertEqual((write["count"], write["points"]), (1, 3500))
+
+    def test_small_write_is_one_response(self):
+        r = self.conn.write_metrics(metrics(10))
+        self.assertFalse(isinstance(r, writer.WriteSummary))
+        self.assertEqual(r.status_code, 204)
+
+    def test_failures(self):
+        self.server.failures[("POST", "/api/v1/datapoints")] = 400
+        r = self.conn.write_metrics(metrics(2500))
+        self.assertEqual((r.status_code, r.failed_batches, r.failed_points), (400, 3, 2500))
+        self.assertTrue("Injected failure" in r.content)
+
+    def test_requests_that_raise_are_summarized(self):
+        # one request at a time, and the deadline runs out during the third
+        conn = pyKairosDB.connect("127.0.0.1", str(self.server.port), max_request_points=1000, write_workers=1)
+        self.server.latency = 0.2
+        r = conn.write_metrics(metrics(3500), deadline=transport.Deadline(0.5))
+        self.assertEqual((r.status_code, r.content, r.failed_batches, r.failed_points), (None, "", 2, 1500))
+        self.assertTrue(isinstance(r.error, requests.Timeout))
+        self.assertTrue(isinstance(r.responses[3], requests.Timeout))
+        self.assertEqual(self.server.points_received, 2000)
+
+    def test_every_request_raising_raises(self):
+        self.server.stop()
+        self.assertRaises(requests.ConnectionError, self.conn.write_metrics, metrics(2500))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+# -*- python -*-
+
+import time
+import unittest
+
+import pyKairosDB
+from pyKairosDB import bulk_load
+from pyKairosDB.testing import StandInKairosDB
+
+
+def metrics(n, start=1400000000):
+    for i in xrange(n):
+        yield {"name" : "m{0}".format(i % 3), "timestamp" : start + i, "value" : i if i % 2 else i + 0.5,
+               "tags" : {"host" : "h{0}".format(i % 5)}}
+
+
+class TestBulkLoad(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInKairosDB().start()
+        self.conn = pyKairosDB.connect("127.0.0.1", str(self.server.port))
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_load(self):
+        progress = list()
+        result = bulk_load.bulk_load(self.conn, metrics(2500), processes=2, chunk_points=100, block_points=1000,
+                                     progress_callback=lambda r: progress.append(r.points))
+        self.assertTrue(result.ok)
+        self.assertEqual((result.points, result.requests, result.failed_points), (2500, 25, 0))
+        self.assertEqual(result.status_codes, {204 : 25})
+        self.assertEqual(result.request_bytes, self.server.bytes_received)
+        self.assertEqual(progress[-1], 2500)
+        self.assertEqual(self.conn.instrumentation.snapshot()["write"]["points"], 2500)
+
+        stored = sorted(p for points in self.server.datapoints.values() for p in points)
+        expected = sorted([m["timestamp"] * 1000, m["value"], m["tags"]] for m in metrics(2500))
+        self.assertEqual(stored, expected)
+        self.assertTrue(all(isinstance(p[1], int) for p in stored if p[1] == int(p[1]))) # not 1.0
+
+    def test_failures(self):
+        self.server.failures[("POST", "/api/v1/datapoints")] = 400
+        result = bulk_load.bulk_load(self.conn, metrics(250), processes=2, chunk_points=100)
+        self.assertFalse(result.ok)
+        self.assertEqual((result.points, result.failed_points, result.failed_requests), (0, 250, 3))
+        self.assertEqual(result.status_codes, {400 : 3})
+        self.assertTrue(result.errors[0].startswith("status code 400"))
+
+    def test_not_a_number(self):
+        self.assertRaises(TypeError, bulk_load.bulk_load, self.conn,
+                          [{"name" : "m", "timestamp" : 1, "value" : "1", "tags" : {"host" : "a"}}], processes=1)
+
+
+if __name__ == "__main__":
+    unittest.main()
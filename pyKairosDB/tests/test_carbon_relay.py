@@ -0,0 +1,175 @@
+# -*- python -*-
+
+import cPickle
+import socket
+import struct
+import threading
+import time
+import unittest
+
+import pyKairosDB
+from pyKairosDB import carbon_relay
+from pyKairosDB import graphite
+from pyKairosDB.testing import StandInKairosDB
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class TestParsing(unittest.TestCase):
+    def test_parse_lines(self):
+        points = list()
+        invalid = carbon_relay.parse_lines("a.b 1.5 1400000000\nbad line\n\nc.d x 1\ne.f 2 1400000001.5", points)
+        self.assertEqual(points, [("a.b", 1400000000.0, 1.5), ("e.f", 1400000001.5, 2.0)])
+        self.assertEqual(invalid, 2)
+
+    def test_parse_pickle(self):
+        points = list()
+        data = cPickle.dumps([("a.b", (1400000000, 1)), ("broken",), ("c.d", (1400000001, "2")),
+                              (123, (1400000002, 3))], 2)
+        invalid = carbon_relay.parse_pickle(data, points)
+        self.assertEqual(points, [("a.b", 1400000000.0, 1.0), ("c.d", 1400000001.0, 2.0)])
+        self.assertEqual(invalid, 2)
+
+    def test_parse_pickle_refuses_globals(self):
+        self.assertRaises(cPickle.UnpicklingError, carbon_relay.parse_pickle,
+                          cPickle.dumps([Exception("no")], 2), list())
+
+    def test_non_finite_values_are_invalid(self):
+        points = list()
+        self.assertEqual(carbon_relay.parse_lines("a nan 1400000000\nb inf 1\nc -inf 1\nd 1 inf\ne 0 1\n", points), 4)
+        self.assertEqual(points, [("e", 1.0, 0.0)])
+        points = list()
+        data = cPickle.dumps([("a", (1, float("nan"))), ("b", (1, "-inf")), ("c", (float("inf"), 1)), ("d", (1, 2))], 2)
+        self.assertEqual(carbon_relay.parse_pickle(data, points), 3)
+        self.assertEqual(points, [("d", 1.0, 2.0)])
+
+
+class TestCarbonRelay(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInKairosDB().start()
+        self.conn = pyKairosDB.connect("127.0.0.1", str(self.server.port))
+        self.schemas = [graphite.StorageSchema("carbon", r"^carbon\.", "60:90d"),
+                        graphite.StorageSchema("default", ".*", "60s:1d,10s:6h")]
+        self.relay = carbon_relay.CarbonRelay(self.conn, self.schemas, pervasive_tags={"graphite" : "true"},
+                                              interface="127.0.0.1", line_port=0, pickle_port=0,
+                                              udp_port=0, batch_size=3, flush_interval=0.05)
+        self.relay.start()
+
+    def tearDown(self):
+        self.relay.stop()
+        self.server.stop()
+
+    def test_line_protocol(self):
+        s = socket.create_connection(self.relay.address("line"))
+        s.sendall("carbon.agents.a 1 1400000000\nweb.cpu 2 14000")
+        s.sendall("00001\nnot valid\nweb.cpu 3 1400000002\n")
+        s.close()
+        self.assertTrue(wait_for(lambda: self.server.points_received == 3))
+        self.assertEqual(self.server.datapoints["carbon.agents.a"],
+                         [[1400000000000, 1.0, {"graphite" : "true", "gr-ret" : "60_90d"}]])
+        self.assertEqual([p[0] for p in self.server.datapoints["web.cpu"]], [1400000001000, 1400000002000])
+        self.assertEqual(self.server.datapoints["web.cpu"][0][2]["gr-ret"], "10s_6h")
+        self.assertEqual(self.relay.stats["invalid"], 1)
+
+    def test_endless_line_is_dropped(self):
+        s = socket.create_connection(self.relay.address("line"))
+        try:
+            for n in range(carbon_relay.MAX_LINE_SIZE // carbon_relay.RECV_SIZE + 2):
+                s.sendall("x" * carbon_relay.RECV_SIZE)
+        except socket.error:
+            pass # the relay may close the connection before every chunk is sent
+        try:
+            closed = s.recv(1) == ""
+        except socket.error:
+            closed = True # reset, as the relay closed it with data unread
+        s.close()
+        self.assertTrue(closed)
+        self.assertEqual(self.relay.stats["invalid"], 1)
+
+    def test_pickle_protocol(self):
+        s = socket.create_connection(self.relay.address("pickle"))
+        for n in range(2):
+            payload = cPickle.dumps([("web.mem", (1400000000 + n, n)), ("web.disk", (1400000000 + n, n))], 2)
+            s.sendall(struct.pack("!L", len(payload)) + payload)
+        s.close()
+        self.assertTrue(wait_for(lambda: self.server.points_received == 4))
+        self.assertEqual(len(self.server.datapoints["web.mem"]), 2)
+
+    def test_udp(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.sendto("web.udp 7 1400000000\n", self.relay.address("udp"))
+        s.close()
+        self.assertTrue(wait_for(lambda: self.server.points_received == 1))
+        self.assertEqual(self.server.datapoints["web.udp"][0][1], 7.0)
+
+    def test_a_batch_that_cant_be_converted(self):
+        self.relay.add_points([(123, 1400000000, 1.0)])
+        self.relay.flush()
+        self.assertTrue(wait_for(lambda: self.relay.stats["write_errors"] == 1))
+        self.assertTrue(all(t.is_alive() for t in self.relay._threads))
+        self.relay.add_points([("web.after", 1400000000, 1.0)])
+        self.assertTrue(wait_for(lambda: self.server.points_received == 1))
+
+    def test_stop_writes_partial_batch(self):
+        self.relay.flush_interval = 60
+        self.relay.add_points([("web.partial", 1400000000, 1)])
+        self.relay.stop()
+        self.assertEqual(self.server.points_received, 1)
+
+
+class TestCoalescing(unittest.TestCase):
+    def test_last_write_wins(self):
+        server = StandInKairosDB().start()
+        try:
+            conn = pyKairosDB.connect("127.0.0.1", str(server.port))
+            relay = carbon_relay.CarbonRelay(conn, [graphite.StorageSchema("default", ".*", "60s:1d")],
+                                             line_port=None, pickle_port=None, batch_size=10,
+                                             flush_interval=60, coalesce=True)
+            relay.start()
+            relay.add_points([("a", 1400000000, 1), ("a", 1400000000.0001, 2), ("b", 1400000000, 3),
+                              ("a", 1400000060, 4), ("b", 1400000000, 5), ("c", 1400000000, 6)])
+            relay.stop()
+        finally:
+            server.stop()
+        self.assertEqual(relay.stats["collapsed"], 2)
+        self.assertEqual(server.points_received, 4)
+        self.assertEqual(sorted(p[1] for p in server.datapoints["a"]), [2, 4])
+        self.assertEqual([p[1] for p in server.datapoints["b"]], [5])
+
+    def test_coalesce_metrics(self):
+        tags = {"host" : "a", "dc" : "east"}
+        metrics = [{"name" : "m", "timestamp" : 1.0, "value" : 1, "tags" : tags},
+                   {"name" : "m", "timestamp" : 2.0, "value" : 2, "tags" : tags},
+                   {"name" : "m", "timestamp" : 1.0, "value" : 3, "tags" : {"dc" : "east", "host" : "a"}},
+                   {"name" : "m", "timestamp" : 1.0, "value" : 4, "tags" : {"host" : "b"}}]
+        coalesced, collapsed = pyKairosDB.writer.coalesce_metrics(metrics)
+        self.assertEqual([m["value"] for m in coalesced], [3, 2, 4])
+        self.assertEqual(collapsed, 1)
+
+
+class TestBackpressure(unittest.TestCase):
+    def test_full_queue_blocks_tcp_and_drops_udp(self):
+        relay = carbon_relay.CarbonRelay(None, [], line_port=None, pickle_port=None,
+                                         batch_size=1, max_queued_batches=1)
+        relay.add_points([("a", 1, 1)]) # fills the queue, there are no writers
+        relay.add_points([("b", 1, 1)], block=False)
+        self.assertEqual(relay.stats["dropped"], 1)
+        t = threading.Thread(target=relay.add_points, args=([("c", 1, 1)],))
+        t.daemon = True
+        t.start()
+        t.join(0.2)
+        self.assertTrue(t.is_alive())
+        relay._queue.get()
+        t.join(1)
+        self.assertFalse(t.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
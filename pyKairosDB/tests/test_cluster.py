@@ -0,0 +1,153 @@
+# -*- python -*-
+
+import threading
+import time
+import unittest
+
+import pyKairosDB
+from pyKairosDB import cluster
+from pyKairosDB.testing import StandInKairosDB
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def writes(server):
+    return server.request_counts[("POST", "/api/v1/datapoints")]
+
+
+class TestCluster(unittest.TestCase):
+    def setUp(self):
+        self.servers = [StandInKairosDB().start() for n in range(3)]
+        self.clusters = list()
+
+    def tearDown(self):
+        for c in self.clusters:
+            c.close()
+        for s in self.servers:
+            s.stop()
+
+    def connect(self, **kwargs):
+        kwargs.setdefault("health_check_interval", None)
+        c = pyKairosDB.connect_cluster(["127.0.0.1:{0}".format(s.port) for s in self.servers], **kwargs)
+        self.clusters.append(c)
+        return c
+
+    def metric(self):
+        return [{"name" : "m", "timestamp" : time.time(), "value" : 1, "tags" : {"host" : "a"}}]
+
+    def test_round_robin(self):
+        c = self.connect()
+        for n in range(9):
+            c.write_metrics(self.metric())
+        self.assertEqual([writes(s) for s in self.servers], [3, 3, 3])
+        content = c.read_relative(["m"], (1, "hours"))
+        self.assertEqual(len(content["queries"][0]["results"]), 1)
+
+    def test_least_outstanding_avoids_a_slow_node(self):
+        self.servers[0].latency = 0.3
+        c = self.connect(strategy=cluster.LEAST_OUTSTANDING)
+        threads = [threading.Thread(target=c.write_metrics, args=(self.metric(),)) for n in range(10)]
+        for t in threads:
+            t.start()
+            time.sleep(0.02)
+        for t in threads:
+            t.join()
+        self.assertEqual(writes(self.servers[0]), 1)
+        self.assertEqual(sum(writes(s) for s in self.servers), 10)
+
+    def test_unreachable_node_is_ejected_and_retried_elsewhere(self):
+        self.servers[1].stop()
+        c = self.connect(unhealthy_threshold=1)
+        for n in range(6):
+            self.assertEqual(c.write_metrics(self.metric()).status_code, 204)
+        self.assertEqual(len(c.healthy_nodes()), 2)
+        self.assertEqual(writes(self.servers[0]) + writes(self.servers[2]), 6)
+
+    def test_failed_over_write_keeps_its_timestamps(self):
+        self.servers[0].stop()
+        c = self.connect()
+        metrics = [{"name" : "m", "timestamp" : 1400000000, "value" : 1, "tags" : {"host" : "a"}}]
+        self.assertEqual(c.write_metrics(metrics).status_code, 204) # the first node is tried first
+        self.assertEqual(self.servers[1].datapoints["m"][0][0], 1400000000000)
+
+    def test_health_checks_eject_and_readmit(self):
+        c = self.connect(health_check_interval=0.05, unhealthy_threshold=2, healthy_threshold=2,
+                         health_check_timeout=0.5)
+        port = self.servers[2].port
+        self.servers[2].stop()
+        self.assertTrue(wait_for(lambda: len(c.healthy_nodes()) == 2))
+        self.servers[2] = StandInKairosDB(port=port).start()
+        self.assertTrue(wait_for(lambda: len(c.healthy_nodes()) == 3))
+
+    def test_no_healthy_nodes(self):
+        for s in self.servers:
+            s.stop()
+        c = self.connect(unhealthy_threshold=1)
+        self.assertRaises(Exception, c.write_metrics, self.metric())
+        self.assertRaises(Exception, c.write_metrics, self.metric())
+        self.assertRaises(cluster.NoHealthyNodesError, c.write_metrics, self.metric())
+
+    def test_module_functions_use_the_first_healthy_node(self):
+        self.servers[0].datapoints["only.on.first"].append([0, 1, {}])
+        c = self.connect()
+        self.assertEqual(pyKairosDB.metadata.get_all_metric_names(c), ["only.on.first"])
+        c.nodes[0].healthy = False
+        self.assertEqual(pyKairosDB.metadata.get_all_metric_names(c), [])
+
+
+class TestHedgedReads(unittest.TestCase):
+    def setUp(self):
+        self.servers = [StandInKairosDB().start() for n in range(2)]
+        self.servers[0].latency = 0.5
+        self.c = pyKairosDB.connect_cluster(["127.0.0.1:{0}".format(s.port) for s in self.servers],
+                                            health_check_interval=None, hedge_after=0.05,
+                                            max_hedge_ratio=1.0)
+
+    def tearDown(self):
+        self.c.close()
+        for s in self.servers:
+            s.stop()
+
+    def reads(self, server):
+        return server.request_counts[("POST", "/api/v1/datapoints/query")]
+
+    def test_slow_node_is_hedged(self):
+        for n in range(4):
+            start = time.time()
+            self.c.read_relative(["m"], (1, "hours"))
+            self.assertTrue(time.time() - start < 0.4)
+        # every read that went to the slow node first was hedged, and the hedge won
+        self.assertEqual(self.c.hedge_stats["reads"], 4)
+        self.assertEqual(self.c.hedge_stats["fired"], self.c.hedge_stats["won"])
+        self.assertEqual(self.c.hedge_stats["fired"], self.reads(self.servers[0]))
+        self.assertEqual(self.reads(self.servers[1]), 4)
+
+    def test_hedges_are_capped(self):
+        self.c.max_hedge_ratio = 0.25
+        for n in range(8):
+            self.c.read_absolute(["m"], 0)
+        self.assertEqual(self.c.hedge_stats["fired"], 2)
+
+    def test_p95_is_tracked(self):
+        self.servers[0].latency = 0
+        self.c.hedge_after = cluster.HEDGE_AT_P95
+        for n in range(cluster.MIN_LATENCY_SAMPLES):
+            self.c.read_absolute(["m"], 0)
+        self.assertTrue(self.c._hedge_delay() < self.c.hedge_after_default * 2)
+        self.assertEqual(self.c.hedge_stats["reads"], cluster.MIN_LATENCY_SAMPLES)
+
+    def test_unreachable_primary_falls_back(self):
+        self.servers[0].stop()
+        for n in range(2):
+            self.assertEqual(self.c.read_absolute(["m"], 0)["queries"][0]["sample_size"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
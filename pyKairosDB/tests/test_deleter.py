@@ -0,0 +1,131 @@
+# -*- python -*-
+
+import os
+import tempfile
+import time
+import unittest
+
+import requests
+
+import pyKairosDB
+from pyKairosDB import graphite
+from pyKairosDB import util
+from pyKairosDB.testing import StandInKairosDB
+
+
+class TestDeleteMetrics(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInKairosDB().start()
+        self.names = ["retired.web-{0:02d}.cpu".format(n) for n in range(1, 21)] + ["live.web-01.cpu"]
+        for name in self.names:
+            self.server.datapoints[name].append([0, 1, {}])
+        self.conn = pyKairosDB.connect("127.0.0.1", str(self.server.port))
+        graphite.expand_graphite_wildcard_metric_name.cache_timestamp = 0
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_concurrent_delete(self):
+        results = self.conn.delete_metrics(self.names[:20], workers=4)
+        self.assertEqual(results, dict((n, None) for n in self.names[:20]))
+        self.assertEqual(self.server.datapoints.keys(), ["live.web-01.cpu"])
+
+    def test_failures_are_reported_per_metric(self):
+        self.server.failures[("DELETE", "/api/v1/metric/retired.web-02.cpu")] = 500
+        results = self.conn.delete_metrics(self.names[:3], workers=2)
+        self.assertEqual(results["retired.web-01.cpu"], None)
+        self.assertEqual(results["retired.web-03.cpu"], None)
+        self.assertTrue(isinstance(results["retired.web-02.cpu"], requests.HTTPError))
+        self.assertEqual(results["retired.web-02.cpu"].response.status_code, 500)
+
+    def test_delete_metric_raises(self):
+        self.server.failures[("DELETE", "/api/v1/metric/x")] = 400
+        self.assertRaises(requests.HTTPError, pyKairosDB.deleter.delete_metric, self.conn, "x")
+
+    def test_delete_matching(self):
+        results = self.conn.delete_metrics_matching("retired.web-0[1-5].*", workers=2)
+        self.assertEqual(sorted(results), self.names[:5])
+        self.assertEqual(len(self.server.datapoints), 16)
+
+    def test_rate_limit(self):
+        start = time.time()
+        self.conn.delete_metrics(self.names[:6], workers=3, max_rate=20)
+        self.assertTrue(time.time() - start >= 0.25)
+
+
+class TestDeleteDatapointsChunked(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInKairosDB().start()
+        for t in range(0, 100):
+            self.server.datapoints["m"].append([t * 1000, t, {"host" : "a" if t % 2 else "b"}])
+        self.conn = pyKairosDB.connect("127.0.0.1", str(self.server.port))
+        self.checkpoint = tempfile.mktemp()
+
+    def tearDown(self):
+        self.server.stop()
+        if os.path.exists(self.checkpoint):
+            os.unlink(self.checkpoint)
+
+    def remaining(self):
+        return [p[0] / 1000 for p in self.server.datapoints["m"]]
+
+    def test_windows_cover_the_range_once(self):
+        progress = list()
+        windows = self.conn.delete_datapoints_chunked(["m"], 10, 49.999, window=10, workers=3,
+                                                      progress_callback=lambda *a: progress.append(a))
+        self.assertEqual(windows, 4)
+        self.assertEqual(self.remaining(), range(0, 10) + range(50, 100))
+        self.assertEqual(progress, [(20.0, 1, 4), (30.0, 2, 4), (40.0, 3, 4), (50.0, 4, 4)])
+        # with several workers the windows may reach the server in any order
+        self.assertEqual(sorted((q["start_absolute"], q["end_absolute"]) for q in self.server.deletes),
+                         [(10000, 19999), (20000, 29999), (30000, 39999), (40000, 49999)])
+
+    def test_tags(self):
+        self.conn.delete_datapoints_chunked(["m"], 0, 99, tags={"host" : "a"}, window=25)
+        self.assertEqual(self.remaining(), range(0, 100, 2))
+
+    def test_resume_from_checkpoint(self):
+        self.server.failures[("POST", "/api/v1/datapoints/delete")] = 503
+        self.assertRaises(requests.HTTPError, self.conn.delete_datapoints_chunked, ["m"], 0, 99,
+                          window=20, checkpoint_file=self.checkpoint)
+        self.assertFalse(os.path.exists(self.checkpoint))
+        del self.server.failures[("POST", "/api/v1/datapoints/delete")]
+
+        def interrupt(done_through, windows_done, windows_total):
+            if windows_done == 2:
+                raise KeyboardInterrupt()
+        self.assertRaises(KeyboardInterrupt, self.conn.delete_datapoints_chunked, ["m"], 0, 99,
+                          window=20, checkpoint_file=self.checkpoint, progress_callback=interrupt)
+        self.assertEqual(self.remaining(), range(40, 100))
+        self.server.deletes = list()
+        self.assertEqual(self.conn.delete_datapoints_chunked(["m"], 0, 99, window=20,
+                                                             checkpoint_file=self.checkpoint), 3)
+        self.assertEqual(self.server.deletes[0]["start_absolute"], 40000)
+        self.assertEqual(self.remaining(), [])
+
+    def test_checkpoint_of_another_deletion_is_ignored(self):
+        def interrupt(done_through, windows_done, windows_total):
+            raise KeyboardInterrupt()
+        self.assertRaises(KeyboardInterrupt, self.conn.delete_datapoints_chunked, ["m"], 0, 99,
+                          window=20, checkpoint_file=self.checkpoint, progress_callback=interrupt)
+        self.assertEqual(self.remaining(), range(20, 100))
+        # the same metric and range, but only some of its series
+        self.server.deletes = list()
+        self.assertEqual(self.conn.delete_datapoints_chunked(["m"], 0, 99, tags={"host" : "a"}, window=20,
+                                                             checkpoint_file=self.checkpoint), 5)
+        self.assertEqual(self.server.deletes[0]["start_absolute"], 0)
+        self.assertEqual(self.remaining(), range(20, 100, 2))
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_rate(self):
+        limiter = util.RateLimiter(100, burst=5)
+        start = time.time()
+        for n in range(25):
+            limiter.acquire()
+        elapsed = time.time() - start
+        self.assertTrue(0.15 <= elapsed < 0.5, elapsed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+# -*- python -*-
+
+import unittest
+
+import pyKairosDB
+from pyKairosDB import graphite
+from pyKairosDB.testing import StandInKairosDB
+
+
+class TestFindNodes(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInKairosDB().start()
+        for name in ["servers.web01.cpu", "servers.web01.mem", "servers.web02.cpu",
+                     "servers.web02", "servers.db01.disk.sda", "top"]:
+            self.server.datapoints[name].append([0, 1, {}])
+        self.conn = pyKairosDB.connect("127.0.0.1", str(self.server.port))
+        graphite.expand_graphite_wildcard_metric_name.cache_timestamp = 0
+
+    def tearDown(self):
+        self.server.stop()
+        graphite.expand_graphite_wildcard_metric_name.cache_timestamp = 0
+
+    def metricnames_requests(self):
+        return self.server.request_counts[("GET", "/api/v1/metricnames")]
+
+    def test_children_with_leaf_and_branch_flags(self):
+        self.assertEqual(graphite.find_nodes(self.conn, "servers.*"),
+                         [("servers.db01", "branch"), ("servers.web01", "branch"),
+                          ("servers.web02", "branch"), ("servers.web02", "leaf")])
+        self.assertEqual(graphite.find_nodes(self.conn, "*"), [("servers", "branch"), ("top", "leaf")])
+        self.assertEqual(graphite.find_nodes(self.conn, "servers.web0[12].cpu"),
+                         [("servers.web01.cpu", "leaf"), ("servers.web02.cpu", "leaf")])
+        self.assertEqual(graphite.find_nodes(self.conn, "servers.nothing.*"), [])
+
+    def test_literal_names(self):
+        self.assertEqual(graphite.find_nodes(self.conn, "servers.db01"), [("servers.db01", "branch")])
+        self.assertEqual(graphite.find_nodes(self.conn, "servers.web01.cpu"), [("servers.web01.cpu", "leaf")])
+
+    def test_one_index_fetch(self):
+        graphite.find_nodes(self.conn, "servers.*")
+        graphite.find_nodes(self.conn, "servers.*.*")
+        self.assertEqual(self.metricnames_requests(), 1)
+
+    def test_leaf_or_branch_agrees(self):
+        for name, kind in graphite.find_nodes(self.conn, "servers.*.*"):
+            self.assertEqual(graphite.leaf_or_branch(self.conn, name), kind)
+        self.assertEqual(graphite.leaf_or_branch(self.conn, "servers.web02"), "branch")
+        self.assertEqual(graphite.leaf_or_branch(self.conn, "servers.web01"), "branch")
+        self.assertEqual(graphite.leaf_or_branch(self.conn, "servers.web01.mem"), "leaf")
+
+
+if __name__ == '__main__':
+    unittest.main()
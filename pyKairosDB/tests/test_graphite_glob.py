@@ -0,0 +1,138 @@
+# -*- python -*-
+
+import fnmatch
+import itertools
+import re
+import unittest
+
+from pyKairosDB import util
+from pyKairosDB import graphite
+
+# The reference implementation below is graphite-web's own glob
+# matching (graphite/finders/__init__.py and the directory walk of the
+# standard finder), applied to a list of names instead of a directory
+# of whisper files.  The results of the tree expansion must agree with
+# it for every pattern.
+
+GRAPHITE_EXPAND_BRACES_RE = re.compile(r'.*(\{.*?[^\\]?\})')
+
+def graphite_expand_braces(s):
+    res = list()
+
+    def remove_outer_braces(s):
+        if s[0] == '{' and s[-1] == '}':
+            return s[1:-1]
+        return s
+
+    m = GRAPHITE_EXPAND_BRACES_RE.search(s)
+    if m is not None:
+        sub = m.group(1)
+        open_brace, close_brace = m.span(1)
+        if ',' in sub:
+            for pat in sub.strip('{}').split(','):
+                res.extend(graphite_expand_braces(s[:open_brace] + pat + s[close_brace:]))
+        else:
+            res.extend(graphite_expand_braces(s[:open_brace] + remove_outer_braces(sub) + s[close_brace:]))
+    else:
+        res.append(s.replace('\\}', '}'))
+    return list(set(res))
+
+def graphite_match_entries(entries, pattern):
+    matching = []
+    for variant in graphite_expand_braces(pattern):
+        matching.extend(fnmatch.filter(entries, variant))
+    return sorted(set(matching))
+
+def graphite_find(names, pattern):
+    """Walk the names one level at a time, like graphite-web walks directories"""
+    found = set()
+    pattern_parts = pattern.split('.')
+    current = [ ([], [n.split('.') for n in names]) ]
+    for depth, part in enumerate(pattern_parts):
+        next_level = list()
+        for prefix, candidates in current:
+            entries = sorted(set(c[depth] for c in candidates if len(c) > depth))
+            for entry in graphite_match_entries(entries, part):
+                matched = [ c for c in candidates if len(c) > depth and c[depth] == entry ]
+                next_level.append((prefix + [entry], matched))
+        current = next_level
+    for prefix, _ in current:
+        found.add(".".join(prefix))
+    return sorted(found)
+
+
+def make_names():
+    names = list()
+    for host, n, metric in itertools.product(["web", "api", "db", "webby"], range(1, 13),
+                                             ["cpu.user", "cpu.system", "mem.free", "load"]):
+        names.append("{0}-{1:02d}.{2}".format(host, n, metric))
+    names.extend(["carbon.agents.a-1.cache.size", "carbon.agents.b-1.cache.size",
+                  "carbon.agents.a-1.cache.queues", "x.y", "x.y.z", "{odd}.name"])
+    return names
+
+PATTERNS = [
+    "*",
+    "*.*",
+    "web-01.cpu.*",
+    "{web,api}-0[1-9].cpu.*",
+    "{web,api}-0[1-9].cpu.{user,system}",
+    "web*-1?.load",
+    "web-1[!0].mem.free",
+    "[wa]*-0?.*.user",
+    "{web,db}-{01,12}.*",
+    "webby-*.cpu",
+    "carbon.agents.*.cache.*",
+    "carbon.{agents,relays}.?-1.cache.size",
+    "x.*",
+    "x.y.*",
+    "nothing.here.*",
+    "*.cpu.s*",
+    "{api}-10.load",
+    "api-1{0,1,2}.cpu.user",
+    "\\{odd\\}.*",
+]
+
+
+class TestGraphiteGlob(unittest.TestCase):
+    def setUp(self):
+        self.names = make_names()
+        self.cache_tree = util.tree()
+        graphite._make_graphite_name_cache(self.cache_tree, self.names)
+
+    def expand(self, pattern):
+        expanded = util.metric_name_wildcard_expansion(self.cache_tree, pattern.split('.'))
+        return sorted(".".join(e) for e in expanded)
+
+    def test_expand_braces_matches_graphite(self):
+        for s in ["{a,b}", "a{b,c}d{e,f}", "{web,api}-0[1-9]", "{single}", "no-braces",
+                  "{a,{b,c}}", "a\\}b"]:
+            self.assertEqual(sorted(util.expand_braces(s)), sorted(graphite_expand_braces(s)), s)
+
+    def test_patterns_match_graphite(self):
+        for pattern in PATTERNS:
+            self.assertEqual(self.expand(pattern), graphite_find(self.names, pattern), pattern)
+
+    def test_is_glob_pattern(self):
+        self.assertFalse(util.is_glob_pattern("a.b.c"))
+        for pattern in ["a.*", "a?", "a[12]", "{a,b}"]:
+            self.assertTrue(util.is_glob_pattern(pattern))
+
+    def test_literal_segments_do_not_scan_siblings(self):
+        seen = list()
+        class RecordingTree(dict):
+            def keys(self):
+                seen.append(self)
+                return dict.keys(self)
+        root = RecordingTree(web=RecordingTree(cpu={}), api=RecordingTree(cpu={}))
+        result = util.metric_name_wildcard_expansion(root, ["{web,db}", "cpu"])
+        self.assertEqual(result, [["web", "cpu"]])
+        self.assertEqual(seen, [])
+
+    def test_expansion_does_not_vivify(self):
+        self.expand("{nothing,x}.{here,y}.*")
+        self.assertFalse("nothing" in self.cache_tree)
+        self.assertFalse("here" in self.cache_tree["x"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+# -*- python -*-
+
+import time
+import unittest
+
+import requests
+
+import pyKairosDB
+from pyKairosDB import instrumentation
+from pyKairosDB.testing import StandInKairosDB
+
+
+class TestHistogram(unittest.TestCase):
+    def test_percentiles(self):
+        h = instrumentation.Histogram()
+        self.assertEqual(h.percentile(50), None)
+        for n in range(99):
+            h.add(0.0007)
+        h.add(0.3)
+        self.assertEqual(h.percentile(50), 0.001)
+        self.assertEqual(h.percentile(99), 0.001)
+        self.assertEqual(h.percentile(100), 0.3) # the bucket is bigger than anything seen
+        self.assertEqual(h.max, 0.3)
+
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInKairosDB().start()
+        self.conn = pyKairosDB.connect("127.0.0.1", str(self.server.port))
+
+    def tearDown(self):
+        self.server.stop()
+
+    def write(self, n):
+        now = time.time()
+        return self.conn.write_metrics([{"name" : "m", "timestamp" : now - i, "value" : i, "tags" : {"host" : "a"}}
+                                        for i in range(n)])
+
+    def test_write_and_read(self):
+        self.write(10)
+        self.conn.read_relative(["m"], (1, "hours"))
+        snapshot = self.conn.instrumentation.snapshot()
+
+        write = snapshot["write"]
+        self.assertEqual(write["count"], 1)
+        self.assertEqual(write["points"], 10)
+        self.assertEqual(sorted(write["phases"]), ["encode", "network"])
+
+        read = snapshot["read"]
+        self.assertEqual((read["count"], read["errors"], read["points"]), (1, 0, 10))
+        self.assertTrue(read["response_bytes"] > 0)
+        self.assertEqual(sorted(read["phases"]), ["build", "decode", "encode", "network", "timestamps"])
+        self.assertTrue(sum(read["phases"].values()) <= read["seconds"])
+        self.assertEqual(sum(read["latency"]["buckets"]), 1)
+        self.assertEqual(write["request_bytes"] + read["request_bytes"], self.server.bytes_received)
+
+    def test_errors_and_callbacks(self):
+        events = list()
+        self.conn.instrumentation.add_callback(events.append)
+        self.conn.read_timeout = 0.1
+        self.server.latency = 0.3
+        self.assertRaises(requests.Timeout, self.conn.metric_names, ttl=0)
+        self.assertEqual(self.conn.instrumentation.snapshot()["metric_names"]["errors"], 1)
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]["operation"], "metric_names")
+        self.assertTrue(isinstance(events[0]["error"], requests.Timeout))
+
+    def test_not_instrumented(self):
+        conn = pyKairosDB.connect("127.0.0.1", str(self.server.port), instrument=False)
+        self.assertEqual(conn.instrumentation, None)
+        conn.write_one_metric("m", time.time(), 1, {"host" : "a"})
+        self.assertEqual(len(conn.read_relative(["m"], (1, "hours"))["queries"][0]["results"][0]["values"]), 1)
+
+
+class TestReporter(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInKairosDB().start()
+        self.conn = pyKairosDB.connect("127.0.0.1", str(self.server.port))
+        self.reporter = instrumentation.Reporter(self.conn.instrumentation, self.conn, prefix="client",
+                                                 tags={"host" : "test"})
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_reports_each_interval_once(self):
+        for n in range(3):
+            self.conn.write_one_metric("m", time.time(), n, {"host" : "a"})
+        self.reporter.report()
+        self.assertEqual(self.server.datapoints["client.write.count"][0][1], 3)
+        self.assertEqual(self.server.datapoints["client.write.points"][0][1], 3)
+        self.assertTrue("client.write.latency.p99" in self.server.datapoints)
+        self.assertTrue("client.write.phase.network" in self.server.datapoints)
+
+        # Only the report's own write happened since
+        metrics = dict((m["name"], m["value"]) for m in self.reporter.metrics())
+        self.assertEqual(metrics["client.write.count"], 1)
+        self.assertEqual(self.reporter.metrics(), [])
+
+    def test_background_thread(self):
+        self.reporter.interval = 0.05
+        self.reporter.start()
+        self.conn.metric_names(ttl=0)
+        time.sleep(0.2)
+        self.reporter.stop()
+        self.assertEqual(self.server.datapoints["client.metric_names.count"][0][1], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+# -*- python -*-
+
+import time
+import unittest
+
+import pyKairosDB
+from pyKairosDB.testing import StandInKairosDB
+
+
+class TestGetLatest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInKairosDB().start()
+        self.conn = pyKairosDB.connect("127.0.0.1", str(self.server.port))
+        self.now = int(time.time())
+        for n in range(10):
+            self.server.datapoints["status.m{0}".format(n)] = [
+                [(self.now - 600 + t * 60) * 1000, n * 100 + t, {"host" : ("a", "b")[t % 2]}] for t in range(10) ]
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_latest(self):
+        names = [ "status.m{0}".format(n) for n in range(10) ] + ["status.missing"]
+        latest = self.conn.get_latest(names, batch_size=4)
+        self.assertEqual(len(latest), 10)
+        self.assertEqual(latest["status.m3"], (self.now - 60, 309))
+        self.assertFalse("status.missing" in latest)
+        read = self.conn.instrumentation.snapshot()["read"]
+        self.assertEqual((read["count"], read["points"]), (3, 10)) # one datapoint per series
+
+    def test_series_and_tags(self):
+        series = ("status.m1", {"host" : "a"})
+        latest = self.conn.get_latest([series, "status.m2"], tags={"host" : "b"})
+        self.assertEqual(latest[("status.m1", (("host", "a"),))], (self.now - 120, 108))
+        self.assertEqual(latest["status.m2"], (self.now - 60, 209))
+
+    def test_lookback_and_workers(self):
+        names = [ "status.m{0}".format(n) for n in range(10) ]
+        self.assertEqual(self.conn.get_latest(names, lookback=(30, "seconds")), {})
+        self.assertEqual(len(self.conn.get_latest(names, batch_size=2, workers=3)), 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+# -*- python -*-
+
+import threading
+import time
+import unittest
+
+import requests
+
+import pyKairosDB
+from pyKairosDB import metadata
+from pyKairosDB.testing import StandInKairosDB, VERSION
+
+
+class TestLazyConnection(unittest.TestCase):
+    def test_construction_sends_nothing(self):
+        # nothing listens on this port
+        conn = pyKairosDB.connect("127.0.0.1", "1")
+        self.assertRaises(requests.ConnectionError, conn.server_version)
+
+
+class TestCachedMetadata(unittest.TestCase):
+    def setUp(self):
+        metadata.clear_cache()
+        self.server = StandInKairosDB().start()
+        self.server.datapoints["a.b"].append([0, 1, {"host" : "web01"}])
+        self.server.datapoints["c"].append([0, 1, {"dc" : "east"}])
+
+    def tearDown(self):
+        self.server.stop()
+        metadata.clear_cache()
+
+    def connect(self):
+        return pyKairosDB.connect("127.0.0.1", str(self.server.port))
+
+    def count(self, path):
+        return self.server.request_counts[("GET", path)]
+
+    def test_version_is_fetched_once_per_server(self):
+        for n in range(5):
+            self.assertEqual(self.connect().server_version(), VERSION)
+        self.assertEqual(self.count("/api/v1/version"), 1)
+        self.assertEqual(pyKairosDB.connect("localhost", str(self.server.port)).server_version(), VERSION)
+        self.assertEqual(self.count("/api/v1/version"), 2)
+
+    def test_names_and_tags(self):
+        conn = self.connect()
+        self.assertEqual(conn.metric_names(), ["a.b", "c"])
+        self.assertEqual(conn.tag_names(), ["dc", "host"])
+        self.assertEqual(conn.tag_values(), ["east", "web01"])
+        self.server.datapoints["d"].append([0, 1, {}])
+        self.assertEqual(self.connect().metric_names(), ["a.b", "c"])
+        self.assertEqual(self.count("/api/v1/metricnames"), 1)
+
+    def test_ttl_expires(self):
+        conn = self.connect()
+        conn.metric_names(ttl=0.05)
+        self.server.datapoints["d"].append([0, 1, {}])
+        time.sleep(0.1)
+        self.assertEqual(conn.metric_names(ttl=0.05), ["a.b", "c", "d"])
+
+    def test_callers_get_their_own_list(self):
+        names = self.connect().metric_names()
+        names.append("mine")
+        names.sort(reverse=True)
+        self.assertEqual(self.connect().metric_names(), ["a.b", "c"])
+
+    def test_concurrent_misses_ask_once(self):
+        self.server.latency = 0.2
+        conn = self.connect()
+        results = list()
+        threads = [ threading.Thread(target=lambda: results.append(conn.metric_names(ttl=0))) for n in range(5) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [["a.b", "c"]] * 5)
+        # the first asks, and the rest use what it got, since it came back after they asked
+        self.assertEqual(self.count("/api/v1/metricnames"), 1)
+
+    def test_clear_cache(self):
+        conn = self.connect()
+        conn.metric_names()
+        metadata.clear_cache(conn)
+        conn.metric_names()
+        self.assertEqual(self.count("/api/v1/metricnames"), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+# -*- python -*-
+
+import Queue
+import socket
+import time
+import unittest
+
+import requests
+
+import pyKairosDB
+from pyKairosDB import recent
+from pyKairosDB.pipelined_writer import PipelinedWriter
+from pyKairosDB.testing import StandInKairosDB
+
+
+def batch(name, n=10):
+    now = time.time()
+    return [{"name" : name, "timestamp" : now - i, "value" : i, "tags" : {"host" : "a"}} for i in range(n)]
+
+
+class TestPipelinedWriter(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInKairosDB().start()
+        self.conn = pyKairosDB.connect("127.0.0.1", str(self.server.port))
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_ordered_completion(self):
+        completed = list()
+        with PipelinedWriter(self.conn, max_in_flight=4, ordered=True,
+                             on_complete=lambda f: completed.append(f.sequence)) as w:
+            futures = [ w.submit(batch("m{0}".format(n))) for n in range(20) ]
+            self.assertTrue(w.flush(5))
+        self.assertEqual(completed, range(20))
+        self.assertTrue(all(f.result().status_code == 204 for f in futures))
+        self.assertEqual(self.server.points_received, 200)
+        self.assertEqual(w.stats, {"submitted" : 20, "written" : 20, "failed" : 0})
+        write = self.conn.instrumentation.snapshot()["write"]
+        self.assertEqual((write["count"], write["points"]), (20, 200))
+        self.assertEqual(sorted(write["phases"]), ["encode", "network"])
+
+    def test_unordered_completion(self):
+        completed = list()
+        w = PipelinedWriter(self.conn, encoders=2, max_in_flight=3, on_complete=lambda f: completed.append(f.sequence))
+        for n in range(20):
+            w.submit(batch("m{0}".format(n)))
+        w.close()
+        self.assertEqual(sorted(completed), range(20))
+        self.assertRaises(ValueError, w.submit, batch("late"))
+
+    def test_backpressure(self):
+        self.server.latency = 0.2
+        w = PipelinedWriter(self.conn, max_in_flight=1, queue_size=1)
+        # one being sent, one waiting to be sent, one waiting to be encoded, while the encoder is blocked
+        for n in range(4):
+            w.submit(batch("m{0}".format(n)), timeout=1)
+        self.assertRaises(Queue.Full, w.submit, batch("full"), block=False)
+        self.assertEqual(w.stats["submitted"], 4)
+        self.assertTrue(w.flush(5))
+        w.close()
+
+    def test_overlaps_requests(self):
+        self.server.latency = 0.1
+        start = time.time()
+        with PipelinedWriter(self.conn, max_in_flight=4) as w:
+            for n in range(8):
+                w.submit(batch("m{0}".format(n)))
+        self.assertTrue(time.time() - start < 0.5) # 0.8 one after another
+        self.assertEqual(self.server.points_received, 80)
+
+    def test_failures(self):
+        self.server.failures[("POST", "/api/v1/datapoints")] = 500
+        with PipelinedWriter(self.conn) as w:
+            f = w.submit(batch("m"))
+            self.assertEqual(f.result(5).status_code, 500)
+            bad = w.submit([{"name" : "m", "timestamp" : None, "value" : 1, "tags" : {}}])
+            self.assertTrue(isinstance(bad.exception(5), TypeError))
+        self.assertEqual(w.stats["failed"], 2)
+
+        s = socket.socket()
+        s.bind(("127.0.0.1", 0))
+        conn = pyKairosDB.connect("127.0.0.1", str(s.getsockname()[1]))
+        s.close()
+        with PipelinedWriter(conn) as w:
+            self.assertRaises(requests.ConnectionError, w.submit(batch("m")).result, 5)
+
+    def test_malformed_batches_with_a_recent_store(self):
+        conn = pyKairosDB.connect("127.0.0.1", str(self.server.port), recent_store=recent.RecentStore())
+        with PipelinedWriter(conn, encoders=1, max_in_flight=1) as w:
+            no_timestamp = w.submit([{"name" : "m", "value" : 1, "tags" : {}}])
+            no_name = w.submit([{"timestamp" : time.time(), "value" : 1, "tags" : {}}])
+            self.assertTrue(isinstance(no_timestamp.exception(5), KeyError))
+            # it isn't accepted, and then the store can't forget its metrics
+            self.assertTrue(no_name.exception(5) is not None or no_name.result(5).status_code != 204)
+            # neither batch stopped the one encoder or sender
+            self.assertEqual(w.submit(batch("m")).result(5).status_code, 204)
+        self.assertEqual(w.stats["failed"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+# -*- python -*-
+
+import time
+import unittest
+
+import pyKairosDB
+from pyKairosDB import bulk_load
+from pyKairosDB import reader
+from pyKairosDB import recent
+from pyKairosDB.pipelined_writer import PipelinedWriter
+from pyKairosDB.testing import StandInKairosDB
+
+
+def metrics(name, start, count, tags=None):
+    return [ {"name" : name, "timestamp" : start + n, "value" : n, "tags" : tags or {"host" : "a"}}
+             for n in range(count) ]
+
+
+class TestRecentStore(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInKairosDB().start()
+        self.store = recent.RecentStore(horizon=300)
+        self.conn = pyKairosDB.connect("127.0.0.1", str(self.server.port), recent_store=self.store)
+        self.plain = pyKairosDB.connect("127.0.0.1", str(self.server.port))
+
+    def tearDown(self):
+        self.server.stop()
+
+    def reads(self):
+        return self.conn.instrumentation.snapshot().get("read", {}).get("count", 0)
+
+    def test_reads_match_kairosdb(self):
+        now = time.time()
+        self.conn.write_metrics(metrics("alert.m", now + 1, 20) + metrics("alert.m", now + 1.5, 20, {"host" : "b"}))
+        # the store covers alert.m from the time it was written
+        for args, kwargs in (((["alert.m"], now + 1, now + 30), {}),
+                             ((["alert.m"], now + 5, now + 10), {}),
+                             ((["alert.m"], now + 1, now + 30), {"tags" : {"host" : "b"}}),
+                             ((["alert.m"], now + 1, now + 30), {"tags" : {"host" : ["a", "b"]}})):
+            self.assertEqual(self.conn.read_absolute(*args, **kwargs), self.plain.read_absolute(*args, **kwargs))
+        self.assertEqual(self.reads(), 0)
+        self.assertEqual(self.store.stats["hits"], 4)
+        content = self.conn.read_relative(["alert.m"], (10, "seconds"), (-1, "minutes"))
+        self.assertEqual(len(content["queries"][0]["results"][0]["values"]), 40)
+        self.assertTrue(isinstance(content["queries"][0]["results"][0]["values"][0][1], int))
+
+    def test_falls_through(self):
+        now = time.time()
+        self.server.datapoints["alert.m"] = [[int((now - 100) * 1000), 5, {"host" : "a"}]]
+        self.conn.write_metrics(metrics("alert.m", now, 10))
+        # from before the first write, another metric, with aggregators, and in calendar units
+        self.assertEqual(len(self.conn.read_absolute(["alert.m"], now - 200)["queries"][0]["results"][0]["values"]), 11)
+        self.conn.read_absolute(["alert.m", "other"], now + 1)
+        self.conn.read_absolute(["alert.m"], now + 1, query_modifying_function=lambda q: None)
+        self.conn.read_relative(["alert.m"], (1, "months"))
+        self.assertEqual(self.reads(), 4)
+        self.assertEqual(self.store.stats["misses"], 2)
+
+    def test_failed_writes_are_forgotten(self):
+        now = time.time()
+        self.conn.write_metrics(metrics("alert.m", now, 10))
+        self.server.failures[("POST", "/api/v1/datapoints")] = 500
+        self.conn.write_metrics(metrics("alert.m", now + 10, 10))
+        self.assertEqual(self.store.read(["alert.m"], now), None)
+
+    def test_other_writers(self):
+        now = time.time()
+        with PipelinedWriter(self.conn) as w:
+            w.submit(metrics("piped", now + 1, 10))
+        self.assertEqual(self.store.read(["piped"], now + 1, now + 30)["queries"][0]["sample_size"], 10)
+        self.conn.write_metrics(metrics("backfilled", now + 1, 10))
+        bulk_load.bulk_load(self.conn, metrics("backfilled", now - 1000, 10), processes=1)
+        self.assertEqual(self.store.read(["backfilled"], now + 1, now + 30), None)
+
+    def test_horizon_and_memory(self):
+        store = recent.RecentStore(horizon=60, max_bytes=300 * recent.POINT_BYTES + 2 * recent.SERIES_BYTES)
+        start = 1400000000
+        store.add(metrics("a", start, 100), now=start)
+        self.assertEqual(store.read(["a"], start, start + 100, now=start)["queries"][0]["sample_size"], 100)
+        store.add(metrics("a", start + 100, 100), now=start + 200)
+        # only the last minute is kept, and the store only covers that
+        self.assertEqual(store.read(["a"], start + 139, now=start + 200), None)
+        self.assertEqual(store.read(["a"], start + 140, now=start + 200)["queries"][0]["sample_size"], 60)
+        store.add(metrics("b", start + 150, 200), now=start + 200) # over 300 points' room, "a" is dropped
+        self.assertEqual(store.read(["a"], start + 140, now=start + 200), None)
+        self.assertEqual(store.stats["evicted"], 1)
+        self.assertTrue(store.nbytes <= store.max_bytes)
+
+    def test_series_overhead(self):
+        store = recent.RecentStore(horizon=60, max_bytes=150 * recent.SERIES_BYTES)
+        start = 1400000000
+        # a thousand sparse series take far more than their datapoints' 17 bytes each
+        for n in range(10):
+            store.add([ {"name" : "m{0}".format(n), "timestamp" : start, "value" : 1, "tags" : {"host" : str(h)}}
+                        for h in range(100) ], now=start)
+        self.assertEqual(store.stats["evicted"], 9)
+        self.assertTrue(store.nbytes <= store.max_bytes)
+
+    def test_absolute_range(self):
+        self.assertEqual(recent.absolute_range(100, None, None, None), (100, None))
+        self.assertEqual(recent.absolute_range(None, (5, "minutes"), None, (1, "minutes"), now=1000), (700, 940))
+        self.assertEqual(recent.absolute_range(None, (1, "years")), None)
+        self.assertTrue(reader.recent is recent)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+# -*- python -*-
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import pyKairosDB
+from pyKairosDB import resilient_writer
+from pyKairosDB.resilient_writer import ResilientWriter, SegmentLog
+from pyKairosDB.testing import StandInKairosDB
+
+
+def batch(name, n=3):
+    return [{"name" : name, "timestamp" : 1400000000 + t, "value" : t, "tags" : {"host" : "a"}}
+            for t in range(n)]
+
+
+class TestSegmentLog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_records_round_trip_across_segments(self):
+        log = SegmentLog(self.directory, segment_bytes=10)
+        for n in range(3):
+            log.append("record-{0}".format(n))
+        self.assertEqual(len(log.segments()), 3)
+        path = log.seal_oldest()
+        self.assertEqual([r for r, offset in log.read(path)], ["record-0"])
+        log.close()
+        # a new log carries on after the existing segments
+        log = SegmentLog(self.directory, segment_bytes=10)
+        log.append("record-3")
+        self.assertEqual(len(log.segments()), 4)
+
+    def test_truncated_record_is_ignored(self):
+        log = SegmentLog(self.directory)
+        log.append("complete")
+        log.append("cut short")
+        path = log.seal_oldest()
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 2)
+        self.assertEqual([r for r, offset in log.read(path)], ["complete"])
+
+
+class TestPostWithRetry(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInKairosDB().start()
+        self.conn = pyKairosDB.connect("127.0.0.1", str(self.server.port))
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_gives_up_on_5xx(self):
+        self.server.failures[("POST", "/api/v1/datapoints")] = 503
+        self.assertRaises(resilient_writer.RetryableWriteError, resilient_writer.post_with_retry,
+                          self.conn, "[]", retries=2, backoff=0.01)
+        self.assertEqual(self.server.request_counts[("POST", "/api/v1/datapoints")], 3)
+
+    def test_4xx_is_not_retried(self):
+        self.server.failures[("POST", "/api/v1/datapoints")] = 400
+        r = resilient_writer.post_with_retry(self.conn, "[]", retries=2, backoff=0.01)
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(self.server.request_counts[("POST", "/api/v1/datapoints")], 1)
+
+
+class TestResilientWriter(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = StandInKairosDB().start()
+        self.conn = pyKairosDB.connect("127.0.0.1", str(self.server.port))
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def writer(self):
+        return ResilientWriter(self.conn, self.directory, retries=1, backoff=0.01, max_backoff=0.05,
+                               drain_rate=1000, timeout=(0.5, 1))
+
+    def test_writes_go_through(self):
+        w = self.writer()
+        metrics = batch("a")
+        w.write(metrics)
+        self.assertEqual(metrics, batch("a")) # the caller's timestamps are still in seconds
+        self.assertTrue(w.flush(5))
+        w.close()
+        self.assertEqual([p[0] for p in self.server.datapoints["a"]], [1400000000000, 1400000001000, 1400000002000])
+        self.assertEqual(w.stats["sent"], 1)
+
+    def test_outage_spills_then_drains(self):
+        self.server.failures[("POST", "/api/v1/datapoints")] = 503
+        w = self.writer()
+        start = time.time()
+        for n in range(20):
+            w.write(batch("m{0}".format(n)))
+        self.assertTrue(time.time() - start < 0.5) # write() didn't wait for the retries
+        time.sleep(0.2)
+        self.assertTrue(w.stats["spilled"] > 0)
+        self.assertEqual(self.server.points_received, 0)
+        del self.server.failures[("POST", "/api/v1/datapoints")]
+        self.assertTrue(w.flush(10))
+        w.close()
+        self.assertEqual(sorted(self.server.datapoints.keys()), sorted("m{0}".format(n) for n in range(20)))
+        self.assertEqual(w.stats["sent"] + w.stats["drained"], 20)
+
+    def test_spilled_batches_survive_a_restart(self):
+        self.server.stop()
+        w = self.writer()
+        w.write(batch("survivor"))
+        time.sleep(0.3)
+        w.close()
+        self.assertEqual(len(SegmentLog(self.directory).segments()), 1)
+        self.server = StandInKairosDB(port=self.server.port).start()
+        w = self.writer()
+        self.assertTrue(w.flush(5))
+        w.close()
+        self.assertEqual(len(self.server.datapoints["survivor"]), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
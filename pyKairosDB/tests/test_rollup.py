@@ -0,0 +1,139 @@
+# -*- python -*-
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import pyKairosDB
+from pyKairosDB import graphite
+from pyKairosDB import rollup
+from pyKairosDB.testing import StandInKairosDB
+
+HOUR = 3600
+NOW = 1400000000 // HOUR * HOUR
+
+
+class TestParseRetentions(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(rollup.parse_retentions("5m:4w, 60s:1d,1h:1y"),
+                         [(60, 86400, "60s_1d"), (300, 4 * 7 * 86400, "5m_4w"), (3600, 365 * 86400, "1h_1y")])
+        self.assertEqual(rollup.parse_retentions("60:1440"), [(60, 86400, "60_1440")]) # 1440 points
+
+
+class TestRollupManager(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInKairosDB().start()
+        self.conn = pyKairosDB.connect("127.0.0.1", str(self.server.port))
+        self.schemas = [graphite.StorageSchema("hosts", r"^web", "60s:2h,5m:1d,1h:1w")]
+        self.directory = tempfile.mkdtemp()
+        self.checkpoint_file = os.path.join(self.directory, "rollup.json")
+        # four hours of a datapoint a minute, valued by the minute of the hour
+        self.server.datapoints["web01.load"] = [ [(NOW - 4 * HOUR + n * 60) * 1000, n % 60, {"gr-ret" : "60s_2h"}]
+                                                 for n in range(4 * 60) ]
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def manager(self):
+        return rollup.RollupManager(self.conn, self.schemas, self.checkpoint_file, workers=2, settle=0,
+                                    windows_per_read=10)
+
+    def test_rollups_and_retention(self):
+        summary = self.manager().run_once(["web01.load", "db01.load"], now=NOW)
+        self.assertEqual(summary["failed"], {})
+        five = self.server.datapoints[rollup.rollup_name("web01.load", 300)]
+        self.assertEqual(len(five), 48)
+        self.assertEqual(five[0][:2], [(NOW - 4 * HOUR) * 1000, 2.0]) # the average of minutes 0-4
+        self.assertEqual(five[0][2], {"gr-ret" : "5m_1d", "gr-rollup" : "avg"})
+        hourly = self.server.datapoints[rollup.rollup_name("web01.load", 3600)]
+        self.assertEqual([p[1] for p in hourly], [29.5] * 4)
+        self.assertEqual(summary["rollup_points"], 52)
+        # the raw datapoints older than two hours are gone
+        self.assertEqual(min(p[0] for p in self.server.datapoints["web01.load"]), (NOW - 2 * HOUR) * 1000)
+        with open(self.checkpoint_file) as f:
+            self.assertEqual(json.load(f)["web01.load"]["rolled"], {"300" : NOW, "3600" : NOW})
+
+    def test_incremental(self):
+        self.manager().run_once(["web01.load"], now=NOW - HOUR)
+        self.server.deletes[:] = []
+        summary = self.manager().run_once(["web01.load"], now=NOW) # a new manager, from the checkpoint
+        self.assertEqual(summary["rollup_points"], 12 + 1)
+        self.assertEqual(len(self.server.datapoints[rollup.rollup_name("web01.load", 300)]), 48)
+
+    def test_checkpoint_file_is_written_per_interval(self):
+        manager = rollup.RollupManager(self.conn, self.schemas, self.checkpoint_file, settle=0,
+                                       windows_per_read=1, checkpoint_interval=3600)
+        manager.process_metric("web01.load", now=NOW) # dozens of steps, each checkpointed in memory
+        self.assertFalse(os.path.exists(self.checkpoint_file))
+        manager.write_checkpoints()
+        with open(self.checkpoint_file) as f:
+            self.assertEqual(json.load(f), manager.checkpoints)
+        os.unlink(self.checkpoint_file)
+        manager.write_checkpoints() # nothing has changed since
+        self.assertFalse(os.path.exists(self.checkpoint_file))
+        manager.run_once(["web01.load"], now=NOW + HOUR)
+        with open(self.checkpoint_file) as f:
+            self.assertEqual(json.load(f)["web01.load"]["rolled"], {"300" : NOW + HOUR, "3600" : NOW + HOUR})
+
+    def test_rollups_are_hidden_from_graphite(self):
+        self.manager().run_once(["web01.load"], now=NOW)
+        graphite.expand_graphite_wildcard_metric_name.cache_timestamp = 0
+        self.assertEqual(graphite.expand_graphite_wildcard_metric_name(self.conn, "*"), ["web01"])
+
+
+class TestPlannedRead(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInKairosDB().start()
+        self.conn = pyKairosDB.connect("127.0.0.1", str(self.server.port))
+        self.schemas = [graphite.StorageSchema("hosts", r"^web", "60s:2h,5m:1d,1h:1w")]
+        self.archives = rollup.parse_retentions("60s:2h,5m:1d,1h:1w")
+        self.server.datapoints["web01.load"] = [ [(NOW - 2 * HOUR + n * 60) * 1000, n % 60, {"gr-ret" : "60s_2h"}]
+                                                 for n in range(2 * 60) ]
+        # the rollups have been made up to half an hour ago
+        for resolution, value in ((300, 1.0), (3600, 2.0)):
+            self.server.datapoints[rollup.rollup_name("web01.load", resolution)] = [
+                [t * 1000, value, {}] for t in range(NOW - 3 * 86400, NOW - HOUR // 2, resolution) ]
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_plan(self):
+        self.assertEqual(rollup.plan_read(self.archives, NOW - HOUR, NOW, 100, now=NOW)[0], 60)
+        self.assertEqual(rollup.plan_read(self.archives, NOW - HOUR, NOW, 5, now=NOW)[0], 300)
+        self.assertEqual(rollup.plan_read(self.archives, NOW - HOUR, NOW, None, now=NOW)[0], 60)
+        # the raw datapoints don't reach back far enough, and the 5m rollup is fine enough
+        self.assertEqual(rollup.plan_read(self.archives, NOW - 6 * HOUR, NOW, 1000, now=NOW)[0], 300)
+        self.assertEqual(rollup.plan_read(self.archives, NOW - 3 * 86400, NOW, 100, now=NOW)[0], 3600)
+        # nothing reaches back a month
+        self.assertEqual(rollup.plan_read(self.archives, NOW - 30 * 86400, NOW, 100000, now=NOW)[0], 3600)
+
+    def test_stitches_rollup_and_raw(self):
+        (start, end, interval), values = rollup.read_absolute(self.conn, "web01.load", NOW - 6 * HOUR + 10, NOW,
+                                                              self.schemas, max_points=100, now=NOW)
+        self.assertEqual((start, end, interval), (NOW - 6 * HOUR, NOW, 300))
+        self.assertEqual(len(values), 72)
+        self.assertEqual(values[:66], [1.0] * 66)
+        self.assertEqual(values[66:], [ float(sum(range(n, n + 5))) / 5 for n in range(30, 60, 5) ])
+        read = self.conn.instrumentation.snapshot()["read"]
+        self.assertEqual((read["count"], read["points"]), (2, 72))
+
+    def test_aggregator(self):
+        (start, end, interval), values = rollup.read_absolute(self.conn, "web01.load", NOW - 6 * HOUR + 10, NOW,
+                                                              self.schemas, max_points=100, now=NOW, aggregator="max")
+        self.assertEqual(values[:66], [1.0] * 66)
+        self.assertEqual(values[66:], range(34, 60, 5))
+
+    def test_raw(self):
+        (start, end, interval), values = rollup.read_absolute(self.conn, "web01.load", NOW - HOUR, NOW,
+                                                              self.schemas, max_points=1000, now=NOW)
+        self.assertEqual(interval, 60)
+        self.assertEqual(values, [ float(n) for n in range(60) ])
+        read = self.conn.instrumentation.snapshot()["read"]
+        self.assertEqual((read["count"], read["points"]), (1, 60))
+
+
+if __name__ == "__main__":
+    unittest.main()
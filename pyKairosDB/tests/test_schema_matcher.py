@@ -0,0 +1,163 @@
+# -*- python -*-
+
+import sys
+import threading
+import unittest
+
+from pyKairosDB import graphite
+from pyKairosDB import util
+
+
+class CountingSchema(graphite.StorageSchema):
+    """A schema without a pattern attribute, like carbon's DefaultSchema"""
+    def __init__(self, name, pattern, retentions):
+        graphite.StorageSchema.__init__(self, name, pattern, retentions)
+        del self.pattern
+        self.tests = 0
+
+    def test(self, metric_name):
+        self.tests += 1
+        return graphite.StorageSchema.test(self, metric_name)
+
+
+class TestSchemaMatcher(unittest.TestCase):
+    def setUp(self):
+        self.schemas = [graphite.StorageSchema("carbon", r"^carbon\.", "60:90d"),
+                        graphite.StorageSchema("cpu", r"\.cpu$", "10s:6h,1m:7d"),
+                        graphite.StorageSchema("hosts", r"^(web|db)\d+\.", "30s:1d"),
+                        graphite.StorageSchema("default", ".*", "1m:1d,5m:4w")]
+
+    def linear(self, name):
+        for s in self.schemas:
+            if s.test(name):
+                return graphite.SchemaMatcher._retention_for_schema(s)
+
+    def test_first_schema_in_order_wins(self):
+        matcher = graphite.SchemaMatcher(self.schemas)
+        for name in ["carbon.agents.a.cpu", "web01.cpu", "web01.mem", "x.cpu", "db2.disk",
+                     "webby.mem", "other"]:
+            self.assertEqual(matcher.retention(name), self.linear(name), name)
+        self.assertEqual(matcher.retention("x.cpu"), ("10s_6h", 10))
+        self.assertEqual(matcher.retention("web01.cpu"), ("10s_6h", 10))
+        self.assertEqual(matcher.retention("db2.disk"), ("30s_1d", 30))
+
+    def test_no_match(self):
+        matcher = graphite.SchemaMatcher(self.schemas[:2])
+        self.assertEqual(matcher.retention("nothing"), None)
+        self.assertEqual(graphite._graphite_metric_list_retentions([("nothing", 1, 1)], self.schemas[:2]),
+                         [None])
+
+    def test_names_are_cached(self):
+        schemas = [CountingSchema("a", "^a", "60s:1d"), CountingSchema("b", ".*", "10s:1d")]
+        matcher = graphite.SchemaMatcher(schemas)
+        for n in range(10):
+            self.assertEqual(matcher.retention("b.name"), ("10s_1d", 10))
+        self.assertEqual(schemas[0].tests + schemas[1].tests, 2)
+
+    def test_cache_invalidated_when_schemas_change(self):
+        matcher = graphite.SchemaMatcher(self.schemas)
+        self.assertEqual(matcher.retention("other"), ("1m_1d", 60))
+        matcher.set_schemas(self.schemas[:-1] + [graphite.StorageSchema("default", ".*", "5s:1h")])
+        self.assertEqual(matcher.retention("other"), ("5s_1h", 5))
+
+    def test_list_retentions_shares_the_matcher(self):
+        metrics = [("web01.cpu", 1, 1), ("carbon.x", 1, 1)]
+        self.assertEqual(graphite._graphite_metric_list_retentions(metrics, self.schemas), ["10s_6h", "60_90d"])
+        changed = [graphite.StorageSchema("default", ".*", "5s:1h")]
+        self.assertEqual(graphite._graphite_metric_list_retentions(metrics, changed), ["5s_1h", "5s_1h"])
+
+    def test_more_schemas_than_re_has_groups_for(self):
+        schemas = [ graphite.StorageSchema("s{0}".format(n), r"^(app|svc){0}\.".format(n), "{0}s:1d".format(n + 1))
+                    for n in range(150) ] + [graphite.StorageSchema("default", ".*", "1m:1w")]
+        matcher = graphite.SchemaMatcher(schemas)
+        self.assertTrue(len(matcher._state.combined) > 1)
+        for n in (0, 49, 50, 99, 149):
+            self.assertEqual(matcher.retention("svc{0}.x".format(n)), ("{0}s_1d".format(n + 1), n + 1))
+        self.assertEqual(matcher.retention("other"), ("1m_1w", 60))
+
+    def test_lookups_while_the_schemas_change(self):
+        one = [graphite.StorageSchema("default", ".*", "1m:1w")]
+        many = [ graphite.StorageSchema("s{0}".format(n), "^x{0}$".format(n), "10s:1d") for n in range(20) ] + one
+        matcher = graphite.SchemaMatcher(one)
+        errors = list()
+        def look_up():
+            try:
+                for n in range(20000):
+                    # a name that's never cached, that only the default schema matches
+                    if matcher.retention("y{0}".format(n)) != ("1m_1w", 60):
+                        errors.append(n)
+            except Exception, e:
+                errors.append(e)
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1) # switch threads as often as possible
+        try:
+            t = threading.Thread(target=look_up)
+            t.start()
+            while t.is_alive():
+                matcher.set_schemas(many)
+                matcher.set_schemas(one)
+            t.join()
+        finally:
+            sys.setcheckinterval(interval)
+        self.assertEqual(errors, [])
+
+    def test_back_references_are_kept_to_their_own_pattern(self):
+        matcher = graphite.SchemaMatcher([graphite.StorageSchema("a", r"^(a)\1", "60s:1d"),
+                                          graphite.StorageSchema("b", r"^(b)\1", "10s:1d"),
+                                          graphite.StorageSchema("default", ".*", "1m:1w")])
+        self.assertEqual(matcher.retention("bb"), ("10s_1d", 10))
+        self.assertEqual(matcher.retention("aa"), ("60s_1d", 60))
+        self.assertEqual(matcher.retention("ab"), ("1m_1w", 60))
+
+    def test_inline_flags_are_kept_to_their_own_pattern(self):
+        matcher = graphite.SchemaMatcher([graphite.StorageSchema("upper", r"^CPU", "60s:1d"),
+                                          graphite.StorageSchema("mem", r"(?i)^mem", "10s:1d"),
+                                          graphite.StorageSchema("default", ".*", "1m:1w")])
+        self.assertEqual(matcher.retention("cpu.x"), ("1m_1w", 60))
+        self.assertEqual(matcher.retention("CPU.x"), ("60s_1d", 60))
+        self.assertEqual(matcher.retention("MEM.x"), ("10s_1d", 10))
+
+
+class TestConversion(unittest.TestCase):
+    def setUp(self):
+        self.schemas = [graphite.StorageSchema("cpu", r"\.cpu$", "10s:6h"),
+                        graphite.StorageSchema("default", ".*", "1m:1d")]
+
+    def test_sanitized_names(self):
+        self.assertEqual(graphite.sanitize_metric_name("web01.disk:sda1 (root)"), "web01.disk_sda1__root_")
+        self.assertTrue(graphite.sanitize_metric_name("a b") is graphite.sanitize_metric_name("a b"))
+        self.assertEqual(graphite.graphite_metric_to_kairosdb(("a@b", 1, 2), {"x" : "y"}),
+                         {"name" : "a_b", "timestamp" : 1, "value" : 2, "tags" : {"x" : "y"}})
+
+    def test_shared_tags(self):
+        metrics = [("web01.cpu", 1, 1), ("web02.cpu", 1, 2), ("web01.mem", 1, 3), ("bad name", 1, 4)]
+        converted = list(graphite.graphite_metric_list_with_retentions_to_kairosdb_list(
+            metrics, self.schemas, {"graphite" : "true"}))
+        self.assertEqual([m["name"] for m in converted], ["web01.cpu", "web02.cpu", "web01.mem", "bad_name"])
+        self.assertEqual(converted[0]["tags"], {"graphite" : "true", graphite.RETENTION_TAG : "10s_6h"})
+        self.assertEqual(converted[2]["tags"], {"graphite" : "true", graphite.RETENTION_TAG : "1m_1d"})
+        self.assertTrue(converted[0]["tags"] is converted[1]["tags"])
+        self.assertTrue(converted[2]["tags"] is converted[3]["tags"])
+        again = list(graphite.graphite_metric_list_with_retentions_to_kairosdb_list(
+            metrics, self.schemas, {"graphite" : "true"}))
+        self.assertTrue(again[0]["tags"] is converted[0]["tags"]) # shared across batches, too
+        other = list(graphite.graphite_metric_list_with_retentions_to_kairosdb_list(metrics, self.schemas))
+        self.assertEqual(other[0]["tags"], {graphite.RETENTION_TAG : "10s_6h"})
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_recently_used_entries_survive(self):
+        cache = util.LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.put("c", 3) # "a" and "b" are now in the old generation
+        self.assertEqual(cache.get("a"), 1) # and "a" is young again
+        cache.put("d", 4)
+        cache.put("e", 5)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("d"), 4)
+        self.assertEqual(cache.get("missing", "default"), "default")
+
+
+if __name__ == '__main__':
+    unittest.main()
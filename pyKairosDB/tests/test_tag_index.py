@@ -0,0 +1,85 @@
+# -*- python -*-
+
+import time
+import unittest
+
+import pyKairosDB
+from pyKairosDB import util
+from pyKairosDB.tag_index import TagIndex
+from pyKairosDB.testing import StandInKairosDB
+
+
+def content(*results):
+    return {"queries": [{"sample_size": 0, "results": [
+        {"name": name, "tags": tags, "values": []} for name, tags in results]}]}
+
+CONTENT = content(("cpu", {"host": ["web01"], "dc": ["east"]}),
+                  ("cpu", {"host": ["Web02"], "dc": ["west"]}),
+                  ("mem", {"host": ["web01", "db01"], "dc": ["east"]}))
+
+
+class TestTagIndex(unittest.TestCase):
+    def test_lookup_and_filters(self):
+        index = TagIndex()
+        index.add_content(CONTENT)
+        self.assertEqual(index.names(index.series_with("host", "web01")), ["cpu", "mem"])
+        self.assertEqual(index.names(index.select({"host": "web01", "dc": "east"})), ["cpu", "mem"])
+        self.assertEqual(len(index.select({"host": ["web01", "Web02"]})), 3)
+        self.assertEqual(index.select({"host": "db01", "dc": "west"}), frozenset())
+        self.assertEqual(len(index.select({"host": "db01", "dc": "west"}, match_all=False)), 2)
+        self.assertEqual(index.series_with("host", "web02"), frozenset())
+        self.assertEqual(index.values("host"), ["Web02", "db01", "web01"])
+
+    def test_case_insensitive(self):
+        index = TagIndex(case_sensitive=False)
+        index.add_content(CONTENT)
+        self.assertEqual(index.names(index.series_with("HOST", "web02")), ["cpu"])
+        self.assertEqual(index.values("Host"), ["Web02", "db01", "web01"])
+
+    def test_incremental_update_replaces_a_name(self):
+        index = TagIndex()
+        index.add_content(CONTENT)
+        index.add_content(content(("mem", {"host": ["web03"]})))
+        self.assertEqual(index.names(index.series_with("host", "web01")), ["cpu"])
+        self.assertEqual(index.names(index.series_with("host", "web03")), ["mem"])
+        self.assertEqual(index.values("host"), ["Web02", "web01", "web03"])
+        index.remove(["cpu"])
+        self.assertEqual(index.values("dc"), [])
+
+
+class TestTagIndexFromServer(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInKairosDB().start()
+        now = int(time.time() * 1000)
+        self.server.datapoints["cpu"].extend([[now, 1, {"host": "web01"}], [now, 2, {"host": "web02"}]])
+        self.server.datapoints["mem"].append([now, 1, {"host": "web01"}])
+        self.conn = pyKairosDB.connect("127.0.0.1", str(self.server.port))
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_build_and_refresh(self):
+        index = TagIndex.build(self.conn, ["cpu", "mem"], (1, "hours"))
+        self.assertEqual(index.names(index.series_with("host", "web02")), ["cpu"])
+        self.server.datapoints["mem"].append([int(time.time() * 1000), 1, {"host": "web02"}])
+        index.refresh(self.conn, ["mem"], (1, "hours"))
+        self.assertEqual(index.names(index.series_with("host", "web02")), ["cpu", "mem"])
+
+    def test_a_tags_query_indexes_metrics(self):
+        now = int(time.time() * 1000)
+        self.server.datapoints["disk"].extend([[now, 1, {"host": "web01", "dc": "west"}],
+                                               [now, 1, {"host": "web02", "dc": "east"}]])
+        index = TagIndex.build(self.conn, ["disk"], (1, "hours"))
+        # no one series of disk is web01 in east, but the metric has both tags
+        self.assertEqual(index.names(index.select({"host": "web01", "dc": "east"})), ["disk"])
+        self.assertEqual(len(index.series_with("host", "web01")), 1)
+
+
+class TestGetMatchingTagValues(unittest.TestCase):
+    def test_results_are_returned(self):
+        matched = util.get_matching_tag_values(CONTENT, "HOST", ["web02", "nothing"])
+        self.assertEqual(matched, [CONTENT["queries"][0]["results"][1]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+# -*- python -*-
+
+import socket
+import threading
+import time
+import unittest
+
+import requests
+
+import pyKairosDB
+from pyKairosDB import telnet
+from pyKairosDB.testing import StandInKairosDB
+
+
+class TestEncodeLines(unittest.TestCase):
+    def test_lines(self):
+        metrics = [{"name" : "a.b", "timestamp" : 1400000000.5, "value" : 0.1, "tags" : {"host" : "web01"}},
+                   {"name" : "c", "timestamp" : 1400000001, "value" : 7, "tags" : {"dc" : "east"}}]
+        self.assertEqual(telnet.encode_lines(metrics),
+                         "put a.b 1400000000500 0.1 host=web01\nput c 1400000001000 7 dc=east\n")
+        self.assertEqual(metrics[0]["timestamp"], 1400000000.5) # not changed in place
+        self.assertEqual(telnet.encode_lines(metrics[1:], "putm"), "putm c 1400000001000 7 dc=east\n")
+
+    def test_invalid(self):
+        for name, tags in (("a b", {"host" : "x"}), ("a", {}), ("a", {"host" : "x y"}),
+                           ("a", {"host" : "x\nput evil 1 1 a=b"}), ("a", {"k=v" : "x"})):
+            self.assertRaises(ValueError, telnet.encode_lines,
+                              [{"name" : name, "timestamp" : 1, "value" : 1, "tags" : tags}])
+
+
+class TestTelnetTransport(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInKairosDB(telnet_port=0).start()
+        self.transport = telnet.TelnetTransport("127.0.0.1", self.server.telnet_port, pool_size=2,
+                                                backoff=0.01)
+        self.conn = pyKairosDB.connect("127.0.0.1", str(self.server.port), write_transport=self.transport)
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.stop()
+
+    def metrics(self, n, name="m"):
+        now = time.time()
+        return [{"name" : name, "timestamp" : now - i, "value" : float(i), "tags" : {"host" : "a"}}
+                for i in range(n)]
+
+    def test_write_metrics_and_read_back(self):
+        r = self.conn.write_metrics(self.metrics(100))
+        self.assertEqual(r.status_code, 204)
+        self.transport.sync()
+        values = self.conn.read_relative(["m"], (1, "hours"))["queries"][0]["results"][0]["values"]
+        self.assertEqual(sorted(v[1] for v in values), [float(i) for i in range(100)])
+        self.assertEqual(self.conn.instrumentation.snapshot()["write"]["points"], 100)
+
+    def test_confirm(self):
+        self.transport.confirm = True
+        self.conn.write_one_metric("m", time.time(), 1, {"host" : "a"})
+        self.assertEqual(self.server.points_received, 1)
+
+    def test_pool(self):
+        threads = [ threading.Thread(target=self.conn.write_metrics, args=(self.metrics(1000, "m{0}".format(n)),))
+                    for n in range(8) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.transport.sync()
+        self.assertEqual(self.server.points_received, 8000)
+        self.assertTrue(self.transport.stats["connects"] <= 2)
+
+    def test_reconnect(self):
+        self.conn.write_metrics(self.metrics(10))
+        self.transport.sync()
+        self.server.drop_telnet_connections()
+        time.sleep(0.05)
+        self.conn.write_metrics(self.metrics(10, "n"))
+        self.transport.sync()
+        self.assertEqual(self.server.points_received, 20)
+        self.assertEqual(self.transport.stats["connects"], 2)
+
+    def test_unreachable(self):
+        s = socket.socket()
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+        s.close()
+        transport = telnet.TelnetTransport("127.0.0.1", port, retries=1, backoff=0.01)
+        self.assertRaises(requests.ConnectionError, transport.write_metrics, self.metrics(1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,163 @@
+# -*- python -*-
+
+import socket
+import threading
+import time
+import unittest
+
+import requests
+
+import pyKairosDB
+from pyKairosDB import graphite
+from pyKairosDB import transport
+from pyKairosDB.testing import StandInKairosDB
+
+
+class TestDeadline(unittest.TestCase):
+    def test_timeouts_are_cut_to_what_is_left(self):
+        d = transport.Deadline(total=1, connect=5, read=0.5)
+        connect, read = d.timeout()
+        self.assertTrue(0.9 < connect <= 1)
+        self.assertEqual(read, 0.5)
+        self.assertEqual(transport.Deadline(connect=2, read=3).timeout(), (2, 3))
+
+    def test_expired(self):
+        d = transport.Deadline(total=0)
+        self.assertTrue(d.expired())
+        self.assertRaises(transport.DeadlineExceeded, d.timeout)
+
+
+class TestTimeouts(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInKairosDB().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def connect(self, **kwargs):
+        return pyKairosDB.connect("127.0.0.1", str(self.server.port), **kwargs)
+
+    def test_read_timeout_from_the_connection(self):
+        self.server.latency = 0.3
+        conn = self.connect(read_timeout=0.1)
+        self.assertRaises(requests.Timeout, conn.read_relative, ["m"], (1, "hours"))
+
+    def test_per_call_override(self):
+        self.server.latency = 0.3
+        conn = self.connect(read_timeout=0.1)
+        content = conn.read_relative(["m"], (1, "hours"), deadline=conn.new_deadline(read=1))
+        self.assertEqual(len(content["queries"]), 1)
+
+    def test_expired_deadline_sends_nothing(self):
+        conn = self.connect()
+        d = conn.new_deadline(total=0)
+        self.assertRaises(transport.DeadlineExceeded, conn.write_metrics,
+                          [{"name" : "m", "timestamp" : time.time(), "value" : 1, "tags" : {"host" : "a"}}],
+                          deadline=d)
+        self.assertEqual(self.server.points_received, 0)
+
+    def test_graphite_read_shares_one_deadline(self):
+        conn = self.connect()
+        end = int(time.time())
+        conn.write_metrics([{"name" : "a.b", "timestamp" : end - 30, "value" : 1,
+                             "tags" : {graphite.RETENTION_TAG : "60s_1d"}}])
+        self.server.latency = 0.4
+        # Each request fits in the deadline, but the two of them together don't
+        self.assertRaises(requests.Timeout, graphite.read_absolute, conn, "a.b", end - 300, end,
+                          deadline=conn.new_deadline(total=0.6))
+
+    def test_delete_metrics_share_one_deadline(self):
+        self.server.latency = 0.2
+        conn = self.connect()
+        results = conn.delete_metrics(["m{0}".format(n) for n in range(6)], deadline=conn.new_deadline(total=0.5))
+        failed = [ e for e in results.values() if e is not None ]
+        self.assertTrue(failed)
+        self.assertTrue(all(isinstance(e, requests.Timeout) for e in failed))
+        self.assertTrue(len(failed) < len(results))
+
+    def test_total_covers_a_slow_response(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+
+        def trickle():
+            client, address = listener.accept()
+            client.recv(65536)
+            chunk = "x" * transport.BODY_CHUNK_BYTES
+            client.sendall("HTTP/1.1 200 OK\r\nContent-Length: {0}\r\n\r\n".format(20 * len(chunk)))
+            try:
+                for n in range(20): # 2 seconds in all, each chunk well within the read timeout
+                    client.sendall(chunk)
+                    time.sleep(0.1)
+            except socket.error:
+                pass
+            client.close()
+
+        t = threading.Thread(target=trickle)
+        t.start()
+        conn = pyKairosDB.connect("127.0.0.1", str(listener.getsockname()[1]), read_timeout=1)
+        start = time.time()
+        self.assertRaises(requests.Timeout, transport.request, conn, "GET", conn.read_url,
+                          deadline=conn.new_deadline(total=0.5))
+        self.assertTrue(time.time() - start < 1)
+        t.join()
+        listener.close()
+
+    def test_response_read_within_a_total(self):
+        conn = self.connect(total_timeout=5)
+        self.assertEqual(conn.metric_names(ttl=0), [])
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInKairosDB(latency=0.3).start()
+        self.conn = pyKairosDB.connect("127.0.0.1", str(self.server.port), read_timeout=0.1,
+                                       circuit_breaker_threshold=2, circuit_breaker_reset=0.3)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_opens_after_repeated_timeouts_and_recovers(self):
+        for n in range(2):
+            self.assertRaises(requests.Timeout, self.conn.metric_names, ttl=0)
+        sent = sum(self.server.request_counts.values())
+        self.assertRaises(transport.CircuitOpenError, self.conn.metric_names, ttl=0)
+        self.assertEqual(sum(self.server.request_counts.values()), sent)
+
+        self.server.latency = 0
+        time.sleep(0.3)
+        self.assertEqual(self.conn.metric_names(ttl=0), [])
+        self.assertEqual(self.conn.circuit_breaker.state, transport.CircuitBreaker.CLOSED)
+
+    def test_short_deadlines_dont_open_it(self):
+        for n in range(3):
+            self.assertRaises(requests.Timeout, transport.request, self.conn, "GET", self.conn.read_url,
+                              deadline=self.conn.new_deadline(total=0.05))
+        self.assertEqual(self.conn.circuit_breaker.state, transport.CircuitBreaker.CLOSED)
+        self.assertEqual(self.conn.circuit_breaker.failures, 0)
+
+    def test_failed_test_request_reopens(self):
+        for n in range(2):
+            self.assertRaises(requests.Timeout, self.conn.metric_names, ttl=0)
+        time.sleep(0.3)
+        self.assertRaises(requests.Timeout, self.conn.metric_names, ttl=0)
+        self.assertRaises(transport.CircuitOpenError, self.conn.metric_names, ttl=0)
+
+    def test_refused_test_request_reopens(self):
+        for n in range(2):
+            self.assertRaises(requests.Timeout, self.conn.metric_names, ttl=0)
+        self.server.stop()
+        time.sleep(0.3)
+        self.assertRaises(requests.ConnectionError, self.conn.metric_names, ttl=0)
+        self.assertEqual(self.conn.circuit_breaker.state, transport.CircuitBreaker.OPEN)
+
+        # once the server is back, the next test request closes it
+        self.server = StandInKairosDB(port=self.server.port).start()
+        time.sleep(0.3)
+        self.assertEqual(self.conn.metric_names(ttl=0), [])
+        self.assertEqual(self.conn.circuit_breaker.state, transport.CircuitBreaker.CLOSED)
+
+
+
+if __name__ == "__main__":
+    unittest.main()
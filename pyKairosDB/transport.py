@@ -0,0 +1,249 @@
+# -*- python -*-
+
+"""
+Timeouts, deadlines and the circuit breaker for the HTTP requests made
+to KairosDB.
+
+Every request is made through request(), which is given a Deadline.
+A deadline has an overall time limit, and connect and read timeouts
+for each request made under it.  The timeouts of each request are cut
+down to whatever is left of the overall limit, so several requests
+that share one deadline - e.g. the two reads made by
+graphite.read_absolute() - finish within it together::
+
+    d = conn.new_deadline(total=5)
+    graphite.read_absolute(conn, "a.b.c", start, end, deadline=d)
+
+When no deadline is given, each request gets its own from the
+connection's defaults (see KairosDBConnection).
+
+Each connection also has a circuit breaker.  After a number of
+requests in a row have timed out, it opens, and requests fail
+immediately with CircuitOpenError instead of waiting on a server that
+isn't answering.  After reset_timeout seconds one request is let
+through to test the server, and the breaker closes again if it works.
+"""
+
+import threading
+import time
+
+import requests
+
+# A connection that is given no timeouts still won't wait forever on a
+# server that has stopped answering.  Queries over long ranges can take
+# a while before the first byte of the answer, so reads get longer.
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_READ_TIMEOUT    = 60
+
+BODY_CHUNK_BYTES = 64 * 1024 # how much of a response is read between checks of the overall limit
+
+
+class DeadlineExceeded(requests.Timeout):
+    """The deadline ran out before the request could be made"""
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Requests to this server are failing fast after repeated timeouts"""
+
+
+class Deadline(object):
+    """
+    :type total: float
+    :param total: seconds from now until everything done under this deadline must be finished.  None for no limit.
+
+    :type connect: float
+    :param connect: seconds each request may take to connect.  None for no limit.
+
+    :type read: float
+    :param read: seconds each request may wait between bytes of the response.  None for no limit.
+
+    requests applies the read timeout to each read from the socket, not
+    to the whole response.  So when there's an overall limit, request()
+    also checks it after each BODY_CHUNK_BYTES of the body, and a large
+    response that's slow to arrive is cut off.  The check is between
+    chunks, so a response can still overrun total by as long as one
+    chunk takes to arrive.
+    """
+
+    def __init__(self, total=None, connect=None, read=None):
+        self.total = total
+        self.connect = connect
+        self.read = read
+        self.expires = None if total is None else time.time() + total
+
+    def remaining(self):
+        """
+        :rtype: float
+        :return: seconds left, or None if there's no overall limit
+        """
+        if self.expires is None:
+            return None
+        return self.expires - time.time()
+
+    def expired(self):
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def timeout(self):
+        """
+        :rtype: tuple
+        :return: the (connect, read) timeout for a request that starts now, per requests
+
+        :raises: DeadlineExceeded if there's no time left
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return (self.connect, self.read)
+        if remaining <= 0:
+            raise DeadlineExceeded("The deadline of {0}s has passed".format(self.total))
+        return (_min(self.connect, remaining), _min(self.read, remaining))
+
+def _min(timeout, remaining):
+    if timeout is None:
+        return remaining
+    return min(timeout, remaining)
+
+
+class CircuitBreaker(object):
+    """
+    :type failure_threshold: int
+    :param failure_threshold: how many timeouts in a row open the circuit, not counting ones
+        that were down to a caller's deadline running out
+
+    :type reset_timeout: float
+    :param reset_timeout: seconds the circuit stays open before a request is let through to test the server
+    """
+
+    CLOSED    = "closed"
+    OPEN      = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def before_request(self):
+        """
+        :raises: CircuitOpenError if the request shouldn't be made
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN # this request is the test
+                return
+            raise CircuitOpenError("The circuit is {0} after {1} timeouts in a row".format(self.state, self.failures))
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_timeout(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+    def record_error(self):
+        """
+        A request failed some other way than timing out, e.g. the
+        connection was refused.  That doesn't count towards opening the
+        circuit, but a test request that fails opens it again.
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+
+def new_deadline(conn, total=None, connect=None, read=None):
+    """
+    :type conn: KairosDBConnection
+    :param conn: the connection whose defaults are used for anything that isn't given
+
+    :rtype: Deadline
+    :return: a deadline that starts now
+    """
+    if total is None:
+        total = getattr(conn, "total_timeout", None)
+    if connect is None:
+        connect = getattr(conn, "connect_timeout", None)
+    if read is None:
+        read = getattr(conn, "read_timeout", None)
+    return Deadline(total, connect, read)
+
+def request(conn, method, url, data=None, deadline=None):
+    """
+    :type conn: KairosDBConnection
+    :param conn: the connection the request is for
+
+    :type method: str
+    :param method: "GET", "POST" or "DELETE"
+
+    :type url: str
+    :param url: the URL to request
+
+    :type data: str
+    :param data: the body of the request
+
+    :type deadline: Deadline
+    :param deadline: the deadline the request must finish within.  None for the connection's defaults.
+
+    :rtype: requests.Response
+    :return: the response
+
+    :raises: requests.Timeout (or DeadlineExceeded) if the deadline runs out, CircuitOpenError
+        if the connection's circuit breaker is open.
+
+    Only a timeout that isn't down to the deadline's total running out
+    counts towards opening the circuit breaker, so tight deadlines
+    can't open it against a server that's answering normally.
+    """
+    if deadline is None:
+        deadline = new_deadline(conn)
+    timeout = deadline.timeout()
+    breaker = getattr(conn, "circuit_breaker", None)
+    if breaker is not None:
+        breaker.before_request()
+    try:
+        if deadline.expires is None:
+            r = requests.request(method, url, data=data, timeout=timeout)
+        else:
+            r = requests.request(method, url, data=data, timeout=timeout, stream=True)
+            _read_body(r, deadline)
+    except requests.Timeout:
+        if breaker is not None:
+            if deadline.expired():
+                # the caller's own deadline ran out, which says nothing about the server
+                breaker.record_error()
+            else:
+                breaker.record_timeout()
+        raise
+    except Exception:
+        if breaker is not None:
+            breaker.record_error()
+        raise
+    if breaker is not None:
+        breaker.record_success()
+    return r
+
+def _read_body(r, deadline):
+    """Read the body of a streamed response, as r.content would, but within the deadline"""
+    chunks = list()
+    try:
+        for chunk in r.iter_content(BODY_CHUNK_BYTES):
+            chunks.append(chunk)
+            if deadline.expired():
+                raise requests.ReadTimeout("The deadline of {0}s passed while reading the response".format(
+                    deadline.total))
+    finally:
+        r.close()
+    # what reading r.content would have set, so that the response behaves as an unstreamed one
+    r._content = "".join(chunks)
+    r._content_consumed = True
@@ -5,6 +5,8 @@ import sys
 import time
 import itertools
 import fnmatch
+import re
+import threading
 
 from collections import defaultdict
 from . import metadata as metadata
@@ -19,6 +21,87 @@ def tree():
   """
   return defaultdict(tree)
 
+class LRUCache(object):
+    """
+    :type maxsize: int
+    :param maxsize: the number of entries that are guaranteed to be kept
+
+    A bounded cache that approximates least-recently-used eviction
+    with two generations of plain dicts.  Entries are added to the
+    young generation; when it holds maxsize entries it becomes the old
+    generation and the previous old generation is dropped.  An entry
+    found in the old generation is moved back into the young one, so
+    anything used within the last maxsize insertions survives.
+
+    This keeps a hit on a hot entry to a single dict lookup, which
+    matters more here than exact LRU order.  At most 2 * maxsize
+    entries are held.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.clear()
+
+    def clear(self):
+        self._young = dict()
+        self._old = dict()
+
+    def get(self, key, default=None):
+        """
+        :rtype: object
+        :return: the cached value for key, or default if it's not cached
+        """
+        value = self._young.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        value = self._old.get(key, _MISSING)
+        if value is _MISSING:
+            return default
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        if len(self._young) >= self.maxsize:
+            self._old = self._young
+            self._young = dict()
+        self._young[key] = value
+
+_MISSING = object()
+
+class RateLimiter(object):
+    """
+    :type rate: float
+    :param rate: the number of operations allowed per second
+
+    :type burst: float
+    :param burst: how many operations may happen back-to-back before the rate applies
+
+    Limits how often something happens across any number of threads.
+    Each call to acquire() reserves its place in the schedule and
+    then sleeps, outside of the lock, until that place comes up.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def acquire(self, amount=1):
+        """
+        :type amount: float
+        :param amount: how much of the rate this operation uses, e.g. a number of bytes
+
+        Block until the operation is allowed to go ahead.
+        """
+        with self._lock:
+            now = time.time()
+            start = max(self._next, now)
+            self._next = start + amount / self.rate
+            delay = self._next - now - self.burst / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
 def get_content_values_by_name(content, name):
     """
     :type content: dict
@@ -93,16 +176,17 @@ def get_matching_tag_values(content, tag_key, tag_value_list):
     response.
     """
     r_list = list()
+    tag_key = tag_key.lower()
     tag_value_set = frozenset([tv.lower() for tv in tag_value_list])
     for q in content["queries"]:
         for r in q["results"]:
-            for t in r["tags"]:
-                if tag_key.lower() in [ each_tag.lower() for each_tag in t.keys() ]:
-                    # This creates the irritating situation where the tag could have mis-matched
-                    # casing - e.g. apple and Apple match by the comparison above.
-                    content_tag_set = frozenset([ tv.lower() for tv in t.values])
-                    if tag_value_set in content_tag_set:
-                        r_list.append(r_list)
+            for k, values in r["tags"].items():
+                # This creates the irritating situation where the tag could have mis-matched
+                # casing - e.g. apple and Apple match by the comparison below.  See
+                # pyKairosDB.tag_index.TagIndex for repeated lookups in the same content.
+                if k.lower() == tag_key and not tag_value_set.isdisjoint([ v.lower() for v in values ]):
+                    r_list.append(r)
+                    break
     return r_list
 
 def get_matching_tags_from_result(result, tag_key):
@@ -190,106 +274,170 @@ def _match_in_cache(cache_tree, list_of_names):
         tail_list = list_of_names[1:]
         return _match_in_cache(cache_tree[head_item], tail_list)
 
-def _metric_name_wildcard_expansion(cache_tree, name_list):
+GLOB_CHARS = frozenset("*?[{") # characters that make a segment a pattern instead of a literal name
+
+EXPAND_BRACES_RE = re.compile(r'.*(\{.*?[^\\]?\})') # same as graphite-web uses
+
+
+def is_glob_pattern(name):
     """
-    :param cache_tree: defaultdict
-    :description cache_tree: a defaultdict initialized with the tree() function
+    :type name: str
+    :param name: a graphite-style name or a segment of one
+
+    :rtype: bool
+    :return: True if the name contains any of the graphite glob characters
+    """
+    for c in name:
+        if c in GLOB_CHARS:
+            return True
+    return False
 
-    :param name_list: list
-    :description name_list: a list of strings created by splitting a name around e.g. "." boundaries (per graphite)
+def expand_braces(pattern):
+    """
+    :type pattern: str
+    :param pattern: a segment of a graphite-style name, e.g. "{web,api}-0[1-9]"
 
     :rtype: list
-    :return: a list of lists.  Each sub-list is the split-out metric names.
+    :return: a list of strings with each brace alternation expanded, e.g. ["web-0[1-9]", "api-0[1-9]"]
 
-    Given some metrics, break up the list around wildcard entries and
-    return all those that match.
+    This follows graphite-web's expand_braces() so that the same
+    target matches the same metrics whether graphite is backed by
+    whisper or by KairosDB.  A brace group without a comma is just
+    unwrapped, and an escaped "\}" is kept as a literal brace.
+    """
+    def remove_outer_braces(s):
+        if s[0] == '{' and s[-1] == '}':
+            return s[1:-1]
+        return s
+
+    result = list()
+    m = EXPAND_BRACES_RE.search(pattern)
+    if m is not None:
+        sub = m.group(1)
+        open_brace, close_brace = m.span(1)
+        if ',' in sub:
+            for alternative in sub.strip('{}').split(','):
+                result.extend(expand_braces(pattern[:open_brace] + alternative + pattern[close_brace:]))
+        else:
+            result.extend(expand_braces(pattern[:open_brace] + remove_outer_braces(sub) + pattern[close_brace:]))
+    else:
+        result.append(pattern.replace('\\}', '}'))
+    return list(set(result))
 
-    This supports wildcards that match fnmatch rules.
+def _literal_prefix(pattern):
+    """
+    :type pattern: str
+    :param pattern: an fnmatch-style pattern with no braces left in it
 
-    This only returns the prefixes implied by the *.   E.g. for the list::
+    :rtype: str
+    :return: the part of the pattern before the first wildcard character
+    """
+    for i, c in enumerate(pattern):
+        if c in "*?[":
+            return pattern[:i]
+    return pattern
 
-        ['a', 'b', '*']
+def compile_glob_segment(segment):
+    """
+    :type segment: str
+    :param segment: one "."-separated segment of a graphite-style target
 
-    and the tree::
+    :rtype: tuple
+    :return: a tuple of (literals, patterns).  literals is a frozenset of names that can be
+        looked up directly, patterns is a list of (literal_prefix, compiled_regex) pairs.
 
-        {
-          'a' : {
-            'b' : {
-              '1' : {},
-              'c' : {},
-              'd' : {
-                {
-                  'a': {},
-                  'b': {},
-                  'c': {}
-                }
-              }
-            }
-          }
-        }
+    Brace alternations are expanded once here, and each alternative is
+    either a plain name (no scan of the children is needed at all) or
+    an fnmatch pattern with a literal prefix that's checked before the
+    regular expression is tried.
+    """
+    literals = set()
+    patterns = list()
+    for alternative in expand_braces(segment):
+        if is_glob_pattern(alternative):
+            patterns.append((_literal_prefix(alternative),
+                             re.compile(fnmatch.translate(alternative))))
+        else:
+            literals.add(alternative)
+    return (frozenset(literals), patterns)
+
+def _match_children(cache_tree, compiled_segment):
+    """
+    :type cache_tree: defaultdict
+    :param cache_tree: one node of the tree created by the tree() function
 
-    applying the name_list "a.b.d.*" to the cache_tree will return::
+    :type compiled_segment: tuple
+    :param compiled_segment: the return value of compile_glob_segment()
 
-        [['a', 'b', 'd', 'a']], [['a', 'b', 'd', 'b']], [['a', 'b', 'd', 'c']]
+    :rtype: list
+    :return: the keys of cache_tree that match the segment, in sorted order
 
+    Only the children that match are returned, so the caller never
+    descends into a branch that can't match.  Literal alternatives
+    are dict lookups and never look at the other children.
     """
-    if len(name_list) == 0: # Catch an empty list being passed in.
-        return []
-    complete_list = list()
-    names_head = name_list[0]
-    names_rest = name_list[1:]
-    matches = [ n for n in cache_tree.keys() if fnmatch.fnmatch(n, names_head) ]
-    # print "matches are {0}".format(matches)
-    for m in matches:
-        # print "m is {0}".format(m)
-        this_list = [m]
-        expansion = _metric_name_wildcard_expansion(cache_tree[m], names_rest)
-        # print "Expansion is {0}".format(expansion)
-        for e in expansion:
-            this_list.extend(expansion)
-            # print "This_list is now {0}".format(this_list)
-        complete_list.extend([this_list])
-    # print "Returning complete_list of {0}".format(complete_list)
-    return complete_list
-
-def _almost_flatten(metrics):
-    """Turn a nested list (e.g. ['foo', ['bar', 'baz', ['tor, 'tar']]] into
-    a flattened list of names anchored at the first element:
-    [["foo", "bar", "baz", "tor"],
-     ["foo", "bar", "baz", "tar"]]
-
-    Two notes for posterity.: This does extra work, recursinge too
-    often.  Also up the stack, the caller needs to remove duplicates.
-    The order of top-level metrics are expected to be small, maybe
-    10-20, so the extra work shouldn't be explosively bad.  If it ever
-    gets that way, then fix this hack.
+    literals, patterns = compiled_segment
+    # use "in" rather than [] so that the defaultdict doesn't vivify the missing names
+    matches = set([l for l in literals if l in cache_tree])
+    if patterns:
+        for child in cache_tree.keys():
+            if child in matches:
+                continue
+            for prefix, regex in patterns:
+                if child.startswith(prefix) and regex.match(child):
+                    matches.add(child)
+                    break
+    return sorted(matches)
 
+def metric_name_wildcard_expansion(cache_tree, name_list):
     """
-    metric_part_list = list()
-    metric_head = metrics[0]
-    metric_tail = metrics[1:]
-    # print "metric_head, metric_tail: {0}, {1}".format(metric_head, metric_tail)
-    if metric_tail == []:
-        return [metric_head]
-    for mt in metric_tail:
-        result = _almost_flatten(mt)
-        # print "result is {0}".format(result)
-        for r in result:
-            tail_list   = list()
-            tail_list.append(metric_head)
-            if type(r) in (type(list()), type(tuple())):
-                tail_list.extend(r)
-            else:
-                tail_list.append(r)
-            metric_part_list.append(tail_list)
-    return metric_part_list
+    :type cache_tree: defaultdict
+    :param cache_tree: a defaultdict initialized with the tree() function
 
+    :type name_list: list
+    :param name_list: a list of strings created by splitting a name around "." boundaries (per graphite)
 
+    :rtype: list
+    :return: a list of lists.  Each sub-list is the split-out metric name that matched.
 
-def metric_name_wildcard_expansion(cache_tree, name_list):
-    metric_name_list = _metric_name_wildcard_expansion(cache_tree, name_list)
+    Every segment of name_list may use the graphite glob syntax: "*",
+    "?", character classes like "[1-9]" and brace alternation like
+    "{web,api}".  Only names with exactly as many segments as
+    name_list are returned, so "a.b.*" returns the leaves and the
+    branches that are directly under "a.b".
+
+    See metric_name_wildcard_nodes() for how the tree is walked.
+    """
+    return [ path for path, node in metric_name_wildcard_nodes(cache_tree, name_list) ]
+
+def metric_name_wildcard_nodes(cache_tree, name_list):
+    """
+    :type cache_tree: defaultdict
+    :param cache_tree: a defaultdict initialized with the tree() function
+
+    :type name_list: list
+    :param name_list: a list of strings created by splitting a name around "." boundaries (per graphite)
+
+    :rtype: list
+    :return: a list of (path, node) tuples, where path is the list of segments that matched
+        and node is the part of cache_tree under that path.
+
+    Each segment is compiled once, and the tree is walked
+    depth-first, descending only into the children that matched the
+    segment at their level.  Returning the nodes lets the caller see
+    whether a match has children without walking the tree again.
+    """
+    if len(name_list) == 0: # Catch an empty list being passed in.
+        return []
+    compiled = [ compile_glob_segment(n) for n in name_list ]
     return_list = list()
-    for m in metric_name_list:
-        # print "m is {0}".format(m)
-        return_list.extend(_almost_flatten(m))
+    stack = [ (cache_tree, 0, []) ]
+    while stack:
+        node, depth, prefix = stack.pop()
+        for m in _match_children(node, compiled[depth]):
+            path = prefix + [m]
+            if depth + 1 == len(compiled):
+                return_list.append((path, node[m]))
+            else:
+                stack.append((node[m], depth + 1, path))
     return return_list
@@ -25,9 +25,63 @@ We send this via the reuests object that the KairosDBConnection presents.
 
 # import yajl_py as json
 import json # change to using yajl when performance is needed.
+from multiprocessing.pool import ThreadPool
+
 import requests
 
-def write_one_metric(conn, name, timestamp, value, tags):
+from . import instrumentation
+from . import transport
+
+DEFAULT_MAX_REQUEST_BYTES = 4 * 2 ** 20
+DEFAULT_MAX_REQUEST_POINTS = 100000
+
+# How many metrics are encoded at a time when a list may be split.  Encoded slices are
+# joined into requests, so this is only how finely the requests can be sized.
+SLICE_POINTS = 1000
+
+
+class WriteSummary(object):
+    """
+    What write_metrics_list() returns when it split a list into several
+    requests.  Like a requests.Response, it has a status_code, which is
+    204 if every request was accepted and otherwise the first status
+    that wasn't, and content, which is that request's content.  The
+    responses are in the order of the batches they were for.
+
+    A request that raised, e.g. on a refused connection or a timeout,
+    has the exception in place of its response.  Its batch counts as
+    failed, error is the first such exception (None if there wasn't
+    one), and if it's the first batch that failed, status_code is None
+    and content is empty.
+    """
+
+    def __init__(self, batches, responses):
+        self.responses = responses
+        self.batches = len(batches)
+        self.points = sum(points for body, points in batches)
+        self.request_bytes = sum(len(body) for body, points in batches)
+        self.failed_points = sum(points for (body, points), r in zip(batches, responses) if not _accepted(r))
+        failed = [ r for r in responses if not _accepted(r) ]
+        self.failed_batches = len(failed)
+        errors = [ r for r in responses if isinstance(r, Exception) ]
+        self.error = errors[0] if errors else None
+        if not failed:
+            self.status_code, self.content = 204, ""
+        elif isinstance(failed[0], Exception):
+            self.status_code, self.content = None, ""
+        else:
+            self.status_code, self.content = failed[0].status_code, failed[0].content
+
+    def __repr__(self):
+        return "<WriteSummary {0} batches, {1} points, {2} failed>".format(
+            self.batches, self.points, self.failed_points)
+
+
+def _accepted(r):
+    return not isinstance(r, Exception) and r.status_code == 204
+
+
+def write_one_metric(conn, name, timestamp, value, tags, deadline=None):
     """
     :type conn: KairosDBConnection
     :param conn: the interface to the requests library
@@ -41,6 +95,9 @@ def write_one_metric(conn, name, timestamp, value, tags):
     :type value: float
     :param value: The value that will be sent along for this metric
 
+    :type deadline: transport.Deadline
+    :param deadline: the deadline for the request, per pyKairosDB.transport.  None for the connection's defaults.
+
     :rtype: request.response
     :return: a requests.response object with the results of the write
 
@@ -55,9 +112,9 @@ def write_one_metric(conn, name, timestamp, value, tags):
         "value" : value,
         "tags" : tags
     }
-    return write_metrics_list(conn, [metric])
+    return write_metrics_list(conn, [metric], deadline=deadline)
 
-def write_metrics_list(conn, metric_list):
+def write_metrics_list(conn, metric_list, deadline=None):
     """
     :type conn: KairosDBConnection
     :param conn: The interface to the requests library
@@ -65,17 +122,249 @@ def write_metrics_list(conn, metric_list):
     :type metrics_list: list
     :param metrics_list: list of dicts, each dict is a metric that will be sent to KairosDB
 
+    :type deadline: transport.Deadline
+    :param deadline: the deadline for the request, per pyKairosDB.transport.  None for the connection's defaults.
+        When the list is split, it's shared by every request.
+
     :rtype: request.response
-    :return: a requests.response object with the results of the write
+    :return: a requests.response object with the results of the write, or a WriteSummary
+        if the list was split into more than one request
 
     Takes a list of formatted metrics hashes and writes them to the
     api.  This takes each timestamp, which should be a regular python
     time.time() in seconds since the epoch, and multiplies it by 1000,
     and posts the int version (no decimal)  to agree with what kairosdb
     expects.
+
+    A list that encodes to more than the connection's max_request_bytes,
+    or has more than its max_request_points, is split into requests that
+    don't, and up to its write_workers of them are sent at once.  A
+    request that raises is reported in the WriteSummary with the others,
+    unless every one of them raised, when the first exception is raised.
+
+    If the connection has a write_transport, e.g. a telnet.TelnetTransport,
+    the metrics are sent with it instead, and what it returns is returned.
+
+    If the connection has a recent_store, the metrics are added to it
+    once they've been accepted.  After a write that failed, or may only
+    have been partly accepted, the store forgets their metrics.
+    """
+    store = getattr(conn, "recent_store", None)
+    if store is None:
+        return _write_metrics_list(conn, metric_list, deadline)
+    timestamps = [ m["timestamp"] for m in metric_list ] # before encoding converts them in place
+    try:
+        result = _write_metrics_list(conn, metric_list, deadline)
+    except Exception:
+        store.forget(set(m["name"] for m in metric_list))
+        raise
+    if result.status_code == 204:
+        store.add(metric_list, timestamps=timestamps)
+    else:
+        store.forget(set(m["name"] for m in metric_list))
+    return result
+
+def _write_metrics_list(conn, metric_list, deadline):
+    max_bytes = getattr(conn, "max_request_bytes", None)
+    max_points = getattr(conn, "max_request_points", None)
+    if getattr(conn, "write_transport", None) is not None or (max_bytes is None and max_points is None):
+        with instrumentation.operation(conn, "write") as op:
+            with op.phase("encode"):
+                body = encode_for(conn, metric_list)
+            return send_encoded(conn, body, len(metric_list), deadline, op)
+
+    with instrumentation.operation(conn, "write") as op:
+        with op.phase("encode"):
+            batches = encode_metrics_batches(metric_list, max_bytes, max_points)
+        if len(batches) == 1:
+            return send_encoded(conn, batches[0][0], batches[0][1], deadline, op)
+        if deadline is None:
+            deadline = transport.new_deadline(conn)
+        with op.phase("network"):
+            def send(batch):
+                # an exception is kept with the batch, so that the other batches are still reported
+                try:
+                    return transport.request(conn, "POST", conn.write_url, batch[0], deadline)
+                except requests.RequestException, e:
+                    return e
+            pool = ThreadPool(min(len(batches), getattr(conn, "write_workers", 1) or 1))
+            try:
+                responses = pool.map(send, batches)
+            finally:
+                pool.terminate()
+                pool.join()
+        if all(isinstance(r, Exception) for r in responses):
+            # there's nothing to summarize, so it's raised the way an unsplit write's would be
+            raise responses[0]
+        summary = WriteSummary(batches, responses)
+        op.request_bytes = summary.request_bytes
+        op.response_bytes = sum(len(r.content) for r in responses if not isinstance(r, Exception))
+        op.points = summary.points
+        return summary
+
+def series_key(name, tags, frozen_tags=None):
+    """
+    :type name: str
+    :param name: a metric name
+
+    :type tags: dict
+    :param tags: its tags
+
+    :type frozen_tags: dict
+    :param frozen_tags: if given, the frozen tags are cached in it by id(tags), for a batch
+        whose metrics share tag dicts.  It must not outlive the tag dicts.
+
+    :rtype: tuple
+    :return: (the interned name, the tags as a sorted tuple), which hashes and compares cheaply
+    """
+    if type(name) is str:
+        name = intern(name)
+    if frozen_tags is None:
+        return name, tuple(sorted(tags.iteritems()))
+    frozen = frozen_tags.get(id(tags))
+    if frozen is None:
+        frozen = frozen_tags[id(tags)] = tuple(sorted(tags.iteritems()))
+    return name, frozen
+
+def coalesce_metrics(metric_list):
+    """
+    :type metrics_list: list
+    :param metrics_list: list of dicts, per write_metrics_list()
+
+    :rtype: tuple
+    :return: (the metrics with only the last of each series and millisecond timestamp, how many
+        were collapsed).  The metrics keep the order of the first of each.
+
+    KairosDB overwrites a datapoint that's written again with the same
+    series and timestamp, so only the last one needs to be sent.
+    """
+    latest = dict()
+    order = list()
+    frozen_tags = dict()
+    for m in metric_list:
+        key = (series_key(m["name"], m["tags"], frozen_tags), int(m["timestamp"] * 1000))
+        if key not in latest:
+            order.append(key)
+        latest[key] = m
+    return [ latest[key] for key in order ], len(metric_list) - len(order)
+
+def encode_metrics_batches(metric_list, max_bytes=None, max_points=None):
+    """
+    :type metrics_list: list
+    :param metrics_list: list of dicts, per encode_metrics_list(), whose timestamps are converted in place
+
+    :type max_bytes: int
+    :param max_bytes: the most bytes each body should have.  None for no limit.
+
+    :type max_points: int
+    :param max_points: the most metrics each body may have.  None for no limit.
+
+    :rtype: list
+    :return: (body, number of metrics) for each request
+
+    The list is encoded a slice at a time, and the encoded slices are
+    joined into bodies, so each metric is only encoded once unless a
+    single slice is bigger than max_bytes.  A slice that is is encoded
+    again in halves.  A metric that's bigger than max_bytes by itself is
+    sent in a body of its own.
+    """
+    for m in metric_list:
+        m["timestamp"] = int(m["timestamp"] * 1000)
+    if max_points is None:
+        max_points = len(metric_list) or 1
+    if max_bytes is None:
+        max_bytes = float("inf")
+
+    batches = list()
+    parts = list() # encoded slices without their brackets, for the body being built
+    size = points = 0
+
+    def finish():
+        batches.append(("[" + ", ".join(parts) + "]", points))
+        del parts[:]
+
+    slice_points = min(SLICE_POINTS, max_points)
+    start = 0
+    while start < len(metric_list):
+        n = min(slice_points, len(metric_list) - start)
+        encoded = json.dumps(metric_list[start:start + n])
+        if len(encoded) > max_bytes and n > 1:
+            slice_points = max(1, n / 2)
+            continue
+        if parts and (size + len(encoded) > max_bytes or points + n > max_points):
+            finish()
+            size = points = 0
+        parts.append(encoded[1:-1])
+        size += len(encoded)
+        points += n
+        start += n
+    if parts or not batches:
+        finish()
+    return batches
+
+def encode_for(conn, metric_list):
+    """
+    :type conn: KairosDBConnection
+    :param conn: the connection the metrics will be written to
+
+    :type metrics_list: list
+    :param metrics_list: list of dicts, each dict is a metric that will be sent to KairosDB
+
+    :rtype: str
+    :return: the metrics encoded for the connection's write_transport, or as JSON for the REST API
+    """
+    write_transport = getattr(conn, "write_transport", None)
+    if write_transport is None:
+        return encode_metrics_list(metric_list)
+    return write_transport.encode(metric_list)
+
+def send_encoded(conn, body, points, deadline=None, op=None):
+    """
+    :type conn: KairosDBConnection
+    :param conn: the connection to write to
+
+    :type body: str
+    :param body: metrics encoded by encode_for()
+
+    :type points: int
+    :param points: how many metrics are in the body
+
+    :type deadline: transport.Deadline
+    :param deadline: the deadline for the request, per pyKairosDB.transport.  None for the connection's defaults.
+
+    :type op: instrumentation.Operation
+    :param op: the operation the send is measured as part of.  None to measure it as a write by itself.
+
+    :rtype: request.response
+    :return: per write_metrics_list()
+    """
+    if op is None:
+        with instrumentation.operation(conn, "write") as op:
+            return send_encoded(conn, body, points, deadline, op)
+    write_transport = getattr(conn, "write_transport", None)
+    with op.phase("network"):
+        if write_transport is None:
+            r = transport.request(conn, "POST", conn.write_url, body, deadline)
+        else:
+            r = write_transport.send(body, points, deadline)
+    op.request_bytes = len(body)
+    op.response_bytes = len(r.content)
+    op.points = points
+    return r
+
+def encode_metrics_list(metric_list):
+    """
+    :type metrics_list: list
+    :param metrics_list: list of dicts, each dict is a metric that will be sent to KairosDB
+
+    :rtype: str
+    :return: the JSON body of a write request for the metrics
+
+    The timestamps are converted to KairosDB's milliseconds in place,
+    so each list must only be encoded once.  The encoded body can be
+    posted as many times as needed.
     """
     for m in metric_list:
         m["timestamp"] = int(m["timestamp"] * 1000)
 
-    metrics = json.dumps(metric_list)
-    return requests.post(conn.write_url, metrics)
+    return json.dumps(metric_list)